@@ -0,0 +1,117 @@
+#!/usr/bin/python
+####################################################################
+# FILENAME: store_dispatch.py
+# PROJECT: Twisted Riak w/ Indexes
+# DESCRIPTION: Microbenchmark of the per-store index dispatch CPU cost.
+#
+#
+########################################################################################
+# (C)2011 DigiTar, All Rights Reserved
+# Distributed under the BSD License
+# 
+# Redistribution and use in source and binary forms, with or without modification, 
+#    are permitted provided that the following conditions are met:
+#
+#        * Redistributions of source code must retain the above copyright notice, 
+#          this list of conditions and the following disclaimer.
+#        * Redistributions in binary form must reproduce the above copyright notice, 
+#          this list of conditions and the following disclaimer in the documentation 
+#          and/or other materials provided with the distribution.
+#        * Neither the name of DigiTar nor the names of its contributors may be
+#          used to endorse or promote products derived from this software without 
+#          specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY 
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES 
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT 
+# SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, 
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED 
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR 
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN 
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+#
+########################################################################################
+
+# Compares the CPU txRiakIdx spends per store() working out which index
+# entries to write, before (lookups and formatting on every store) and
+# after (plans compiled by RiakClient.add_index()). No Riak server is
+# needed: only the dispatch work is timed, not the HTTP requests.
+#
+#   python benchmarks/store_dispatch.py [--fields 6] [--stores 20000]
+
+import timeit
+from argparse import ArgumentParser
+from txriak import riak
+from txriakidx import riakidx
+
+parser = ArgumentParser()
+parser.add_argument("--fields", dest="fields", type=int, default=6)
+parser.add_argument("--stores", dest="stores", type=int, default=20000)
+
+BUCKET = "diner_bucket"
+PREFIX = "order"
+
+def legacy_dispatch(obj, client, data, old_data):
+    "Per-store dispatch as done before plans were compiled."
+    key_prefix, key_name = obj._key.split("_", 1)
+    bucket = obj.get_bucket().get_name()
+    
+    if client._indexes.has_key(bucket+"="+key_prefix):
+        for field in client._indexes[bucket+"="+key_prefix].keys():
+            index = client._indexes[bucket+"="+key_prefix][field]
+            idx_bucket = index.idx_bkt_form % {"bucket": bucket,
+                                               "field" : field,
+                                               "key_prefix" : key_prefix}
+            idx_bucket = client.bucket(idx_bucket)
+            
+            old_value = obj._escval(old_data[field])
+            idx_old = index.idx_key_form % {"key" : key_name,
+                                            "field_val" : old_value}
+            riak.RiakUtils.build_rest_path(client, idx_bucket, idx_old,
+                                           None, {"dw": idx_bucket.get_dw(None)})
+            
+            new_value = obj._escval(data[field])
+            idx_new = index.idx_key_form % {"key": key_name,
+                                            "field_val" : new_value}
+            idx_new = idx_bucket.new(idx_new)
+            idx_new.add_link(obj)
+            riak.RiakUtils.build_rest_path(client, idx_bucket, idx_new._key,
+                                           None, {"returnbody": "true",
+                                                  "w": idx_bucket.get_w(None),
+                                                  "dw": idx_bucket.get_dw(None)})
+
+def compiled_dispatch(obj, client, data, old_data):
+    "Per-store dispatch through the compiled plans."
+    found = obj._get_plans()
+    old_values = obj._index_values(old_data, found)
+    new_values = obj._index_values(data, found)
+    
+    key_name, plans = found
+    for plan in plans:
+        plan.index._entry_op("delete", key_name, old_values[plan.field])
+        plan.index._entry_op("put", key_name, new_values[plan.field])
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    
+    client = riakidx.RiakClient()
+    fields = ["field_%d" % i for i in range(args.fields)]
+    for field in fields:
+        client.add_index(riakidx.RiakIndex(bucket=BUCKET,
+                                           key_prefix=PREFIX,
+                                           indexed_field=field,
+                                           field_type="str"))
+    
+    old_data = dict([(field, u"old value/%s" % field) for field in fields])
+    data = dict([(field, u"new value/%s" % field) for field in fields])
+    obj = client.bucket(BUCKET).new(PREFIX + "_1299648212", data)
+    
+    print "Index dispatch CPU per store (%d indexed fields, %d stores):" % \
+          (args.fields, args.stores)
+    for name, func in [("before (per-store lookups)", legacy_dispatch),
+                       ("after (compiled plans)", compiled_dispatch)]:
+        timer = timeit.Timer(lambda: func(obj, client, data, old_data))
+        best = min(timer.repeat(repeat=3, number=args.stores))
+        print "  %-28s %8.2f usec" % (name, best / args.stores * 1000000)
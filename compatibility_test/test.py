@@ -53,38 +53,46 @@ parser.add_argument("--prefix", dest="prefix", default="prefix")
 parser.add_argument("--keyname", dest="keyname", default="test_key")
 parser.add_argument("--load", dest="load", action="store_true", default=False)
 parser.add_argument("--validate", dest="validate", action="store_true", default=False)
+parser.add_argument("--scheme", dest="scheme", type=int, choices=[1, 2], default=1,
+                    help="Index scheme: 1 (original) or 2 (sortable numbers)")
 
 @defer.inlineCallbacks
-def load_reference_samples(result, host, port, bucket, prefix, keyname):
+def load_reference_samples(result, host, port, bucket, prefix, keyname, scheme):
     "Load the sample record and create reference indexes."
     
     client = riakidx.RiakClient(host, port)
     bkt = client.bucket(bucket)
+    sortable = scheme == 2
     
     idx_string = riakidx.RiakIndex(bucket=bucket,
                                    key_prefix=prefix,
                                    indexed_field="string",
-                                   field_type="str")
+                                   field_type="str",
+                                   sortable=sortable)
     
     idx_integer = riakidx.RiakIndex(bucket=bucket,
                                     key_prefix=prefix,
                                     indexed_field="integer",
-                                    field_type="int")
+                                    field_type="int",
+                                    sortable=sortable)
     
     idx_float = riakidx.RiakIndex(bucket=bucket,
                                   key_prefix=prefix,
                                   indexed_field="float",
-                                  field_type="float")
+                                  field_type="float",
+                                  sortable=sortable)
     
     idx_bool = riakidx.RiakIndex(bucket=bucket,
                                  key_prefix=prefix,
                                  indexed_field="boolean",
-                                 field_type="bool")
+                                 field_type="bool",
+                                 sortable=sortable)
     
     idx_unicode = riakidx.RiakIndex(bucket=bucket,
                                     key_prefix=prefix,
                                     indexed_field="unicode",
-                                    field_type="unicode")
+                                    field_type="unicode",
+                                    sortable=sortable)
     
     client.add_index(idx_string)
     client.add_index(idx_integer)
@@ -96,21 +104,32 @@ def load_reference_samples(result, host, port, bucket, prefix, keyname):
     
 
 @defer.inlineCallbacks
-def reference_validate(result, host, port, bucket, prefix, keyname):
+def reference_validate(result, host, port, bucket, prefix, keyname, scheme):
     "Validate indexes for keyname against reference."
     
     client = riakidx.RiakClient(host, port)
     
+    # Scheme 2 keeps its entries in separate buckets and stores ints
+    # and floats with their sortable encodings.
+    if scheme == 2:
+        idx_form = "idxv2=%s=%s=%s"
+        integer_val = riakidx._encode_sortable_int(1)
+        float_val = riakidx._encode_sortable_float(4.1)
+    else:
+        idx_form = "idx=%s=%s=%s"
+        integer_val = "1"
+        float_val = "4.1"
+    
     print "Validating integer index...",
-    integer_bkt = client.bucket("idx=%s=%s=integer" % (bucket, prefix))
-    integer_idx = yield integer_bkt.get("%s/1" % keyname)
+    integer_bkt = client.bucket(idx_form % (bucket, prefix, "integer"))
+    integer_idx = yield integer_bkt.get("%s/%s" % (keyname, integer_val))
     if integer_idx.exists():
         print "good."
     else:
-        print "failed. Should be %s%%2F1" % keyname
+        print "failed. Should be %s%%2F%s" % (keyname, integer_val)
         
     print "Validating string index...",
-    string_bkt = client.bucket("idx=%s=%s=string" % (bucket, prefix))
+    string_bkt = client.bucket(idx_form % (bucket, prefix, "string"))
     string_idx =  yield string_bkt.get("%s/test" % keyname)
     if string_idx.exists():
         print "good."
@@ -119,7 +138,7 @@ def reference_validate(result, host, port, bucket, prefix, keyname):
     
     
     print "Validating bool index...",
-    bool_bkt = client.bucket("idx=%s=%s=boolean" % (bucket, prefix))
+    bool_bkt = client.bucket(idx_form % (bucket, prefix, "boolean"))
     bool_idx = yield bool_bkt.get("%s/1" % keyname)
     if bool_idx.exists():
         print "good."
@@ -127,15 +146,15 @@ def reference_validate(result, host, port, bucket, prefix, keyname):
         print "failed. Should be %s%%2F1" % keyname
     
     print "Validating float index...",
-    float_bkt = client.bucket("idx=%s=%s=float" % (bucket, prefix))
-    float_idx = yield float_bkt.get("%s/4.1" % keyname)
+    float_bkt = client.bucket(idx_form % (bucket, prefix, "float"))
+    float_idx = yield float_bkt.get("%s/%s" % (keyname, float_val))
     if float_idx.exists():
         print "good."
     else:
-        print "failed. Should be %s%%2F4.1" % keyname
+        print "failed. Should be %s%%2F%s" % (keyname, float_val)
     
     print "Validating unicode index...",
-    unicode_bkt = client.bucket("idx=%s=%s=unicode" % (bucket, prefix))
+    unicode_bkt = client.bucket(idx_form % (bucket, prefix, "unicode"))
     unicode_idx =  yield unicode_bkt.get(keyname + "/" + urllib.quote(u"日本人!".encode("utf-8")))
     if unicode_idx.exists():
         print "good."
@@ -160,7 +179,8 @@ if __name__ == "__main__":
                       args.port,
                       args.bucket,
                       args.prefix,
-                      args.keyname)
+                      args.keyname,
+                      args.scheme)
 
     if args.validate:
          d.addCallback(reference_validate,
@@ -168,7 +188,8 @@ if __name__ == "__main__":
                        args.port,
                        args.bucket,
                        args.prefix,
-                       args.keyname)
+                       args.keyname,
+                       args.scheme)
 
     d.addCallback(all_done)
     d.addErrback(eb_failed)
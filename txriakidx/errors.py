@@ -57,4 +57,16 @@ class IllegalDatatypeError(txRiakIdxError):
 class IndexError(txRiakIdxError):
     """
     A general error occurred working with an index.
-    """
\ No newline at end of file
+    """
+
+class IndexMaintenanceError(txRiakIdxError):
+    """
+    One or more index entries could not be updated.
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        self._msg = "Index maintenance failed for field(s): " + \
+                    "; ".join(["%s (%s)" % (field,
+                                            getattr(failures[field], "value",
+                                                    failures[field]))
+                               for field in sorted(failures.keys())])
@@ -0,0 +1,309 @@
+#!/usr/bin/python
+####################################################################
+# FILENAME: journal.py
+# PROJECT: Twisted Riak w/ Indexes
+# DESCRIPTION: Durable write-behind journal for index maintenance.
+#
+#
+########################################################################################
+# (C)2011 DigiTar, All Rights Reserved
+# Distributed under the BSD License
+# 
+# Redistribution and use in source and binary forms, with or without modification, 
+#    are permitted provided that the following conditions are met:
+#
+#        * Redistributions of source code must retain the above copyright notice, 
+#          this list of conditions and the following disclaimer.
+#        * Redistributions in binary form must reproduce the above copyright notice, 
+#          this list of conditions and the following disclaimer in the documentation 
+#          and/or other materials provided with the distribution.
+#        * Neither the name of DigiTar nor the names of its contributors may be
+#          used to endorse or promote products derived from this software without 
+#          specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY 
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES 
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT 
+# SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, 
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED 
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR 
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN 
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+#
+########################################################################################
+
+import os, json
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+
+class IndexJournal(object):
+    """
+    Append-only journal of pending index entry operations.
+    
+    Operations are written (and fsync'd) to the journal file before the
+    caller's store() or delete() returns, then applied to Riak in the
+    background by a worker that batches and retries them. The sequence
+    number of the last applied operation is kept in *<path>.checkpoint*,
+    so operations that hadn't been applied when the process died are
+    replayed by start(). Applied operations are compacted out of the
+    journal at checkpoints once they outnumber the pending ones, so it
+    stays proportional to the backlog even if it never empties.
+    
+    Failed operations are logged and retried, up to *max_retries* times,
+    after which they're appended to *<path>.dead* so later batches aren't
+    held up behind them.
+    
+    Operations are JSON dictionaries with an "op" ("put" or "delete"),
+    the index entry "bucket" and "key", and whatever else *apply_op*
+    needs. Within a batch only the last operation on each entry is
+    applied, since it alone decides whether the entry exists.
+    """
+    
+    def __init__(self, path, apply_op, batch_size=100, concurrency=8,
+                 retry_delay=1.0, max_retry_delay=60.0, max_retries=10,
+                 fsync=True):
+        """
+        Construct a new IndexJournal object.
+        
+        :param path: Path of the journal file.
+        :param apply_op: Callable taking an operation dictionary and returning
+                         a Deferred that fires once it's applied to Riak.
+        :param batch_size: Maximum number of operations applied per batch.
+        :param concurrency: Maximum number of operations in flight.
+        :param retry_delay: Seconds to wait before retrying failed operations.
+                            Doubles on each retry up to *max_retry_delay*.
+        :param max_retries: Retries before a failing operation is given up on
+                            and moved to the dead letter file (None to retry
+                            forever).
+        :param fsync: fsync the journal after every append.
+        
+        :returns: None
+        """
+        
+        self._path = path
+        self._checkpoint_path = path + ".checkpoint"
+        self._dead_path = path + ".dead"
+        self._apply_op = apply_op
+        self._batch_size = batch_size
+        self._concurrency = concurrency
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._max_retries = max_retries
+        self._fsync = fsync
+        
+        self._pending = []
+        self._seq = 0
+        self._applied_seq = 0
+        self._file = None
+        self._lines = 0
+        self._draining = False
+        self._waiting = []
+    
+    def start(self):
+        """
+        Open the journal, queueing any operations that weren't applied
+        before the last shutdown, and start applying them.
+        
+        :returns: Number of replayed operations.
+        """
+        
+        if os.path.exists(self._checkpoint_path):
+            self._applied_seq = int(open(self._checkpoint_path).read().strip() or 0)
+        self._seq = self._applied_seq
+        
+        if os.path.exists(self._path):
+            f = open(self._path, "r+")
+            lines = f.read().split("\n")
+            if lines[-1]:
+                # Torn write from a crash mid-append. Cut it off so the
+                # next append doesn't land on the same line.
+                f.truncate(f.tell() - len(lines[-1]))
+            f.close()
+            
+            for line in lines[:-1]:
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    continue
+                
+                self._seq = max(self._seq, op["seq"])
+                if op["seq"] > self._applied_seq:
+                    self._pending.append(op)
+                self._lines += 1
+        
+        self._file = open(self._path, "a")
+        self._schedule()
+        
+        return len(self._pending)
+    
+    def stop(self):
+        """
+        Close the journal. Operations not applied yet stay in the journal
+        and are replayed by the next start().
+        
+        :returns: None
+        """
+        
+        if self._file:
+            self._file.close()
+            self._file = None
+    
+    def append(self, ops):
+        """
+        Durably record operations and queue them for the worker.
+        
+        :param ops: List of operation dictionaries.
+        
+        :returns: None
+        """
+        
+        if not self._file:
+            raise IOError("Index journal %s isn't open." % self._path)
+        
+        lines = []
+        for op in ops:
+            self._seq += 1
+            op = dict(op, seq=self._seq)
+            lines.append(json.dumps(op) + "\n")
+            self._pending.append(op)
+        
+        self._file.write("".join(lines))
+        self._file.flush()
+        if self._fsync:
+            os.fsync(self._file.fileno())
+        self._lines += len(lines)
+        
+        self._schedule()
+    
+    def pending(self):
+        """
+        Number of operations waiting to be applied.
+        
+        :returns: integer
+        """
+        
+        return len(self._pending)
+    
+    def flush(self):
+        """
+        Wait for every queued operation to be applied.
+        
+        :returns: None -- via deferred
+        """
+        
+        if not self._pending and not self._draining:
+            return defer.succeed(None)
+        
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+    
+    def _schedule(self):
+        """
+        Start the worker if there's work and it isn't running.
+        """
+        
+        if self._pending and not self._draining:
+            self._draining = True
+            reactor.callLater(0, self._drain)
+    
+    @defer.inlineCallbacks
+    def _drain(self):
+        """
+        Apply queued operations batch by batch until the queue is empty.
+        """
+        
+        while self._pending:
+            batch = self._pending[:self._batch_size]
+            
+            # Only the last operation on an entry matters
+            latest = {}
+            for op in batch:
+                latest[(op["bucket"], op["key"])] = op
+            ops = sorted(latest.values(), key=lambda op: op["seq"])
+            
+            delay = self._retry_delay
+            retries = 0
+            while ops:
+                sem = defer.DeferredSemaphore(self._concurrency)
+                results = yield defer.DeferredList([sem.run(self._apply_op, op)
+                                                    for op in ops],
+                                                   consumeErrors=True)
+                failed = []
+                for op, (success, result) in zip(ops, results):
+                    if not success:
+                        log.err(result, "Error applying journaled index " \
+                                        "operation %s" % json.dumps(op))
+                        failed.append(op)
+                ops = failed
+                
+                if ops and self._max_retries is not None and \
+                   retries >= self._max_retries:
+                    self._bury(ops)
+                    break
+                if ops:
+                    retries += 1
+                    yield task.deferLater(reactor, delay, lambda: None)
+                    delay = min(delay * 2, self._max_retry_delay)
+            
+            del self._pending[:len(batch)]
+            self._checkpoint(batch[-1]["seq"])
+        
+        self._draining = False
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+    
+    def _bury(self, ops):
+        """
+        Give up on operations that keep failing, appending them to the
+        dead letter file so they can be inspected and replayed by hand.
+        """
+        
+        log.msg("Giving up on %d journaled index operation(s), see %s" % \
+                (len(ops), self._dead_path))
+        f = open(self._dead_path, "a")
+        f.write("".join([json.dumps(op) + "\n" for op in ops]))
+        f.flush()
+        if self._fsync:
+            os.fsync(f.fileno())
+        f.close()
+    
+    def _checkpoint(self, seq):
+        """
+        Record *seq* as the last applied operation, and compact the journal
+        once it holds more applied operations than pending ones.
+        """
+        
+        self._applied_seq = seq
+        tmp_path = self._checkpoint_path + ".tmp"
+        f = open(tmp_path, "w")
+        f.write(str(seq))
+        f.flush()
+        if self._fsync:
+            os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp_path, self._checkpoint_path)
+        
+        if self._file and self._lines - len(self._pending) >= len(self._pending):
+            self._compact()
+    
+    def _compact(self):
+        """
+        Replace the journal with one holding only the pending operations.
+        """
+        
+        tmp_path = self._path + ".tmp"
+        f = open(tmp_path, "w")
+        f.write("".join([json.dumps(op) + "\n" for op in self._pending]))
+        f.flush()
+        if self._fsync:
+            os.fsync(f.fileno())
+        f.close()
+        
+        self._file.close()
+        os.rename(tmp_path, self._path)
+        self._file = open(self._path, "a")
+        self._lines = len(self._pending)
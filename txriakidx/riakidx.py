@@ -36,304 +36,3486 @@
 #
 ########################################################################################
 
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import zlib
+import bisect
+import struct
 import urllib
+import tempfile
 import errors
-from copy import copy
+import journal
+from collections import namedtuple, OrderedDict, deque
 from txriak import riak
-from twisted.internet import defer
+from twisted.internet import defer, task, reactor, protocol, threads
+from twisted.python import failure, log
+from twisted.web import client as web_client
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from twisted.web._newclient import ResponseDone
 
-# Make a copy of original RiakObject so subclassing stays stable
-# when we monkey patch.
+# Make a copy of original RiakObject and RiakBucket so subclassing
+# stays stable when we monkey patch.
 riak.RiakObjectOrig = riak.RiakObject
+riak.RiakBucketOrig = riak.RiakBucket
+
+# Everything store() and delete() need to maintain one indexed field,
+# compiled once by RiakClient.add_index().
+_IndexPlan = namedtuple("_IndexPlan", ["field",        # Indexed field name
+                                       "fields",       # Fields making up
+                                                       # the indexed value
+                                       "index",        # RiakIndex
+                                       "idx_bucket",   # Entry bucket name
+                                       "path_prefix",  # Entry bucket URL path
+                                       "link_prefix",  # Link header up to
+                                                       # the data key
+                                       "link_suffix",  # Rest of Link header
+                                       "encoders",     # (<field>, <escaper>)
+                                                       # for each field
+                                       "type",         # Field datatype
+                                       "include",      # Fields copied into
+                                                       # the entry body
+                                       "header",       # 2i header sent with
+                                                       # the data key (native
+                                                       # backend only)
+                                       "shards"])      # (<idx_bucket>,
+                                                       # <path_prefix>) of
+                                                       # each shard, if sharded
+
+# Index backends. "keyfilter" keeps an entry key per indexed value and
+# queries them with key filtered MapReduce. "native" uses Riak's own
+# secondary indexes (2i), sent as headers with the data key.
+_INDEX_BACKENDS = ("keyfilter", "native")
+
+# Bounds of the native 2i ranges used for open ended comparisons. Native
+# string values never contain a space or anything above '~', so these
+# sort before and after all of them.
+_NATIVE_INT_MIN = -(2 ** 63)
+_NATIVE_INT_MAX = 2 ** 63 - 1
+_NATIVE_BIN_MIN = " "
+_NATIVE_BIN_MAX = "\x7f"
+_NATIVE_SAFE = "".join([chr(c) for c in range(0x21, 0x7f)
+                        if not chr(c) in "%,"])
+
+# Sortable (index scheme v2) encodings of numbers, whose string order is
+# their numeric order. Ints are a sign marker and 20 zero padded digits,
+# offset so negative ints sort in order too. Floats are the hex of their
+# IEEE 754 bits, with the sign bit flipped for positive numbers and every
+# bit flipped for negative ones.
+_SORTABLE_INT_OFFSET = 10 ** 20
+_FLOAT_SIGN = 1 << 63
+_FLOAT_MASK = (1 << 64) - 1
+
+def _encode_sortable_int(value):
+    number = int(value)
+    if number != value:
+        raise ValueError("%r is not an integer." % (value,))
+    if not -_SORTABLE_INT_OFFSET < number < _SORTABLE_INT_OFFSET:
+        raise ValueError("%d is out of range for a sortable index." % number)
+    
+    if number < 0:
+        return "n%020d" % (_SORTABLE_INT_OFFSET + number)
+    return "p%020d" % number
+
+def _decode_sortable_int(value):
+    if value[:1] == "n":
+        return int(value[1:]) - _SORTABLE_INT_OFFSET
+    return int(value[1:])
+
+def _encode_sortable_float(value):
+    bits = struct.unpack(">Q", struct.pack(">d", float(value)))[0]
+    if bits & _FLOAT_SIGN:
+        bits = ~bits & _FLOAT_MASK
+    else:
+        bits |= _FLOAT_SIGN
+    return "%016x" % bits
+
+def _decode_sortable_float(value):
+    bits = int(value, 16)
+    if bits & _FLOAT_SIGN:
+        bits &= ~_FLOAT_SIGN
+    else:
+        bits = ~bits & _FLOAT_MASK
+    return struct.unpack(">d", struct.pack(">Q", bits))[0]
+
+def _escape_native(value):
+    """
+    Escape a string for a native 2i header. Only characters a header value
+    can't carry (and ',', which separates values) are escaped, so printable
+    ASCII values keep their order.
+    
+    :param value: Value to escape.
+    
+    :returns: string
+    """
+    
+    return urllib.quote(unicode(value).encode("utf-8"), safe=_NATIVE_SAFE)
+
+def _run_bounded(iterable, func, concurrency, abort=None):
+    """
+    Call *func* on every item of *iterable* with at most *concurrency*
+    calls in flight. Items are pulled from *iterable* lazily, so it can
+    be a generator over a very large data set.
+    
+    :param iterable: Items to process.
+    :param func: Callable taking one item and returning a Deferred (or value).
+    :param concurrency: Maximum number of calls in flight.
+    :param abort: Optional callable taking a Failure. When it returns True
+                  no new calls are started and the returned Deferred
+                  fails with that Failure once the calls in flight finish.
+    
+    :returns: List of (<success>, <result or exception>) tuples in the order
+              of *iterable* -- via deferred
+    """
+    
+    results = []
+    aborted = []
+    
+    def cb_record(result, slot):
+        if isinstance(result, failure.Failure):
+            if abort and not aborted and abort(result):
+                aborted.append(result)
+            results[slot] = (False, result.value)
+        else:
+            results[slot] = (True, result)
+    
+    def work():
+        for item in iterable:
+            if aborted:
+                return
+            results.append(None)
+            d = defer.maybeDeferred(func, item)
+            yield d.addBoth(cb_record, len(results) - 1)
+    
+    def cb_done(ignored):
+        if aborted:
+            return aborted[0]
+        return results
+    
+    work = work()
+    workers = [task.coiterate(work) for i in range(concurrency)]
+    return defer.DeferredList(workers).addCallback(cb_done)
+
+def _copy_rows(rows):
+    """
+    Copy query result rows so callers can't modify shared results.
+    
+    :param rows: List of query result rows.
+    
+    :returns: list
+    """
+    
+    return [[dict(item) if isinstance(item, dict) else item for item in row]
+            for row in rows]
+
+def _match_predicate(compare_op, arg, value):
+    """
+    Evaluate a key filter predicate locally against a value the way
+    Riak would after the index key has been tokenized and converted.
+    
+    :param compare_op: Key filter predicate name (eq, less_than, etc.)
+    :param arg: Argument of the predicate.
+    :param value: Converted indexed value.
+    
+    :returns: True/False, or None if the predicate can't be evaluated here.
+    """
+    
+    if isinstance(compare_op, Predicate):
+        return compare_op._matches(value)
+    
+    try:
+        if compare_op == "eq":
+            return value == arg
+        elif compare_op == "neq":
+            return value != arg
+        elif compare_op == "less_than":
+            return value < arg
+        elif compare_op == "greater_than":
+            return value > arg
+        elif compare_op == "less_than_eq":
+            return value <= arg
+        elif compare_op == "greater_than_eq":
+            return value >= arg
+        elif compare_op == "starts_with":
+            return value.startswith(arg)
+        elif compare_op == "ends_with":
+            return value.endswith(arg)
+        elif compare_op == "matches":
+            return re.search(arg, value) is not None
+        elif compare_op == "set_member":
+            return value == arg
+    except (TypeError, ValueError, AttributeError, re.error):
+        pass
+    
+    return None
+
+def _match_range(compare_op, arg):
+    """
+    Find the range of values a key filter predicate can match.
+    
+    :param compare_op: Key filter predicate name (eq, less_than, etc.)
+    :param arg: Argument of the predicate.
+    
+    :returns: (<low>, <high>), either end None if it's unbounded.
+    """
+    
+    if isinstance(compare_op, Predicate):
+        return compare_op._range()
+    
+    if compare_op == "eq":
+        return (arg, arg)
+    elif compare_op in ["less_than", "less_than_eq"]:
+        return (None, arg)
+    elif compare_op in ["greater_than", "greater_than_eq"]:
+        return (arg, None)
+    
+    return (None, None)
+
+class Predicate(object):
+    """
+    Query predicate expression. Predicates combine with & (and),
+    | (or) and ~ (not), and compile into a single key filter job.
+    """
+    
+    _args = ()
+    
+    def __and__(self, other):
+        return And(self, other)
+    
+    def __or__(self, other):
+        return Or(self, other)
+    
+    def __invert__(self):
+        return Not(self)
+    
+    def __eq__(self, other):
+        return type(self) is type(other) and self._args == other._args
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        return hash((type(self).__name__, self._args))
+    
+    def __repr__(self):
+        return "%s%r" % (type(self).__name__, self._args)
+    
+    def _bind(self, convert):
+        """
+        :param convert: Callable converting query values for the index.
+        
+        :returns: Copy of the predicate with its values converted.
+        """
+        
+        raise NotImplementedError
+    
+    def _key_filters(self, leaf):
+        """
+        :param leaf: Callable taking a predicate name and its arguments and
+                     returning the key filters that extract, convert and
+                     compare the indexed value.
+        
+        :returns: List of key filters
+        """
+        
+        raise NotImplementedError
+    
+    def _matches(self, value):
+        """
+        :param value: Converted indexed value.
+        
+        :returns: True/False, or None if it can't be evaluated locally.
+        """
+        
+        raise NotImplementedError
+    
+    def _range(self):
+        """
+        :returns: (<low>, <high>) bounds of the values the predicate can
+                  match, either end None if it's unbounded.
+        """
+        
+        raise NotImplementedError
+
+class Match(Predicate):
+    """
+    Compare the indexed value with a key filter predicate
+    (eq, less_than, starts_with, etc.)
+    """
+    
+    def __init__(self, compare_op, value):
+        self._args = (compare_op, value)
+    
+    def _bind(self, convert):
+        return Match(self._args[0], convert(self._args[1]))
+    
+    def _key_filters(self, leaf):
+        return leaf(self._args[0], [self._args[1]])
+    
+    def _matches(self, value):
+        return _match_predicate(self._args[0], self._args[1], value)
+    
+    def _range(self):
+        return _match_range(self._args[0], self._args[1])
+
+class Between(Predicate):
+    """
+    Indexed value lies between *low* and *high*.
+    """
+    
+    def __init__(self, low, high, inclusive=True):
+        self._args = (low, high, bool(inclusive))
+    
+    def _bind(self, convert):
+        return Between(convert(self._args[0]), convert(self._args[1]),
+                       self._args[2])
+    
+    def _key_filters(self, leaf):
+        return leaf("between", list(self._args))
+    
+    def _matches(self, value):
+        low, high, inclusive = self._args
+        try:
+            if inclusive:
+                return low <= value <= high
+            return low < value < high
+        except TypeError:
+            return None
+    
+    def _range(self):
+        return self._args[:2]
+
+class And(Predicate):
+    """
+    All of the predicates match.
+    """
+    
+    _op = "and"
+    
+    def __init__(self, *predicates):
+        if not predicates:
+            raise errors.IndexError("And() needs at least one predicate.")
+        self._args = predicates
+    
+    def _bind(self, convert):
+        return type(self)(*[p._bind(convert) for p in self._args])
+    
+    def _key_filters(self, leaf):
+        # Riak's logical filters take two branches, so nest the rest.
+        # Each branch extracts and converts the value itself.
+        filters = self._args[-1]._key_filters(leaf)
+        for p in reversed(self._args[:-1]):
+            filters = [[self._op, p._key_filters(leaf), filters]]
+        return filters
+    
+    def _matches(self, value):
+        results = [p._matches(value) for p in self._args]
+        if False in results:
+            return False
+        if None in results:
+            return None
+        return True
+    
+    def _range(self):
+        # Only values inside every range can match
+        ranges = [p._range() for p in self._args]
+        lows = [low for low, high in ranges if low is not None]
+        highs = [high for low, high in ranges if high is not None]
+        return (max(lows) if lows else None, min(highs) if highs else None)
+
+class Or(And):
+    """
+    Any of the predicates match.
+    """
+    
+    _op = "or"
+    
+    def _matches(self, value):
+        results = [p._matches(value) for p in self._args]
+        if True in results:
+            return True
+        if None in results:
+            return None
+        return False
+    
+    def _range(self):
+        # Values inside any of the ranges can match
+        ranges = [p._range() for p in self._args]
+        lows = [low for low, high in ranges]
+        highs = [high for low, high in ranges]
+        return (None if None in lows else min(lows),
+                None if None in highs else max(highs))
+
+class Not(Predicate):
+    """
+    The predicate doesn't match.
+    """
+    
+    def __init__(self, predicate):
+        self._args = (predicate,)
+    
+    def _bind(self, convert):
+        return Not(self._args[0]._bind(convert))
+    
+    def _key_filters(self, leaf):
+        return [["not", self._args[0]._key_filters(leaf)]]
+    
+    def _matches(self, value):
+        result = self._args[0]._matches(value)
+        if result is None:
+            return None
+        return not result
+    
+    def _range(self):
+        return (None, None)
+
+class _QueryCache(object):
+    """
+    Size bounded LRU cache of index query results with an optional TTL.
+    """
+    
+    def __init__(self, size, ttl=None, clock=time.time):
+        """
+        :param size: Maximum number of cached queries.
+        :param ttl: Seconds a cached result stays valid (None for no expiry).
+        :param clock: Callable returning the current time in seconds.
+        """
+        
+        self._size = size
+        self._ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._stats = {"hits": 0,
+                       "misses": 0,
+                       "evictions": 0,
+                       "expirations": 0,
+                       "invalidations": 0}
+    
+    def get(self, cache_key):
+        """
+        :returns: Cached result or None on a miss.
+        """
+        
+        entry = self._entries.pop(cache_key, None)
+        if entry is not None and self._ttl is not None and \
+           self._clock() - entry[0] >= self._ttl:
+            self._stats["expirations"] += 1
+            entry = None
+        
+        if entry is None:
+            self._stats["misses"] += 1
+            return None
+        
+        self._entries[cache_key] = entry
+        self._stats["hits"] += 1
+        return entry[1]
+    
+    def put(self, cache_key, result):
+        self._entries.pop(cache_key, None)
+        self._entries[cache_key] = (self._clock(), result)
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+    
+    def invalidate(self, value):
+        """
+        Drop every cached query whose result could contain *value*.
+        Queries with predicates that can't be evaluated locally are
+        dropped as well.
+        
+        :param value: Converted indexed value that was added or removed.
+        """
+        
+        for cache_key in self._entries.keys():
+            compare_op, arg = cache_key[:2]
+            if _match_predicate(compare_op, arg, value) is not False:
+                del self._entries[cache_key]
+                self._stats["invalidations"] += 1
+    
+    def clear(self):
+        self._entries.clear()
+    
+    def stats(self):
+        stats = dict(self._stats)
+        stats["size"] = len(self._entries)
+        return stats
+
+# Reduce phase ordering index entries by their decoded values (then data key),
+# dropping those not after the cursor and keeping only the first arg.keep.
+# It outputs entries in the same form it takes, so Riak can re-reduce it.
+_PAGE_REDUCE_JS = """function(values, arg) {
+    function parse(v) {
+        var key = decodeURIComponent(v[1]);
+        var i = key.indexOf("/");
+        var vals = key.substring(i + 1).split("/");
+        for (var n = 0; n < vals.length; n++) {
+            vals[n] = decodeURIComponent(vals[n]);
+            if (arg.numeric[n]) { vals[n] = Number(vals[n]); }
+        }
+        return [vals, key.substring(0, i)];
+    }
+    function cmp1(a, b) {
+        return a < b ? -1 : (a > b ? 1 : 0);
+    }
+    function cmp(a, b) {
+        var c = 0;
+        for (var n = 0; c == 0 && n < a[0].length; n++) {
+            c = cmp1(a[0][n], b[0][n]);
+        }
+        if (c == 0) { c = cmp1(a[1], b[1]); }
+        return arg.desc ? -c : c;
+    }
+    var rows = [];
+    for (var j = 0; j < values.length; j++) {
+        var row = parse(values[j]);
+        if (arg.after === null || cmp(row, arg.after) > 0) {
+            rows.push([row, values[j]]);
+        }
+    }
+    rows.sort(function(a, b) { return cmp(a[0], b[0]); });
+    if (arg.keep !== null) { rows = rows.slice(0, arg.keep); }
+    return rows.map(function(r) { return r[1]; });
+}"""
+
+# Map phase returning [bucket, key, document] for each data key reached by
+# the entry links, keeping only the fields listed in arg (if any).
+_OBJECTS_MAP_JS = """function(v, keydata, arg) {
+    if (v.not_found) { return []; }
+    var doc;
+    try { doc = JSON.parse(v.values[0].data); } catch (e) { return []; }
+    if (arg && doc !== null && typeof doc === "object") {
+        var projected = {};
+        for (var i = 0; i < arg.length; i++) {
+            if (doc.hasOwnProperty(arg[i])) { projected[arg[i]] = doc[arg[i]]; }
+        }
+        doc = projected;
+    }
+    return [[v.bucket, v.key, doc]];
+}"""
+
+# Map phase returning [bucket, key, body] for each index entry.
+_ENTRY_MAP_JS = """function(v) {
+    if (v.not_found) { return []; }
+    return [[v.bucket, v.key, JSON.parse(v.values[0].data)]];
+}"""
+
+# Mirrored index snapshot layout: a header (magic, time of the last load
+# from Riak, length of the index name, number of entries), the index name,
+# then for every entry in sorted order the lengths of its data key name and
+# escaped value followed by the two strings.
+_SNAPSHOT_MAGIC = "TXRIDXS1"
+_SNAPSHOT_HEADER = struct.Struct(">8sdII")
+_SNAPSHOT_ENTRY = struct.Struct(">II")
+
+def _write_snapshot(path, data):
+    """
+    Replace a mirrored index snapshot file atomically. Safe to call from
+    a thread.
+    
+    :param path: Snapshot path.
+    :param data: Serialized snapshot.
+    
+    :returns: None
+    """
+    
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+    f = os.fdopen(fd, "wb")
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(tmp_path, path)
+
+class _MultipartParser(object):
+    """
+    Incremental multipart/mixed parser for Riak's chunked MapReduce output.
+    Only the part currently arriving is buffered.
+    """
+    
+    def __init__(self, boundary):
+        self._delim = "\r\n--" + boundary
+        # The first delimiter isn't preceded by a CRLF.
+        self._buf = "\r\n"
+        self._scan = 0
+    
+    def feed(self, data):
+        """
+        :param data: Next bytes of the response body.
+        
+        :returns: List of the bodies of parts completed by *data*.
+        """
+        
+        self._buf += data
+        bodies = []
+        while True:
+            start = self._buf.find(self._delim)
+            if start < 0:
+                break
+            
+            end = self._buf.find(self._delim,
+                                 max(start + len(self._delim), self._scan))
+            if end < 0:
+                self._buf = self._buf[start:]
+                self._scan = max(len(self._buf) - len(self._delim), 0)
+                break
+            
+            part = self._buf[start + len(self._delim):end]
+            self._buf = self._buf[end:]
+            self._scan = 0
+            headers, sep, body = part.partition("\r\n\r\n")
+            if sep:
+                bodies.append(body)
+        
+        return bodies
+
+class _QueryStreamReceiver(protocol.Protocol):
+    """
+    Feeds decoded rows of a chunked MapReduce response to a consumer,
+    pausing the response while the consumer works on a row.
+    """
+    
+    def __init__(self, boundary, decode, consumer, finished):
+        self._parser = _MultipartParser(boundary)
+        self._decode = decode
+        self._consumer = consumer
+        self._finished = finished
+        self._rows = deque()
+        self._waiting = False
+        self._paused = False
+        self._delivering = False
+        self._ended = None
+        self._count = 0
+    
+    def dataReceived(self, data):
+        if self._finished.called:
+            return
+        
+        try:
+            for body in self._parser.feed(data):
+                result = json.loads(body)
+                if isinstance(result, dict) and result.has_key("error"):
+                    raise errors.IndexError(str(result["error"]))
+                self._rows.extend(result.get("data", []))
+        except Exception:
+            return self._fail(failure.Failure())
+        
+        self._deliver()
+    
+    def _deliver(self):
+        # Deferreds that have already fired resume delivery from inside
+        # this loop, so don't start a nested one.
+        if self._delivering:
+            return
+        
+        self._delivering = True
+        try:
+            while self._rows and not self._waiting and not self._finished.called:
+                row = self._rows.popleft()
+                try:
+                    result = self._consumer(self._decode(row))
+                except Exception:
+                    return self._fail(failure.Failure())
+                
+                self._count += 1
+                if isinstance(result, defer.Deferred):
+                    self._waiting = True
+                    result.addCallbacks(self._resume, self._fail)
+                    if self._waiting and not self._ended:
+                        self._paused = True
+                        self.transport.pauseProducing()
+        finally:
+            self._delivering = False
+        
+        if self._ended and not self._rows and not self._waiting and \
+           not self._finished.called:
+            if self._ended.check(ResponseDone, PotentialDataLoss):
+                self._finished.callback(self._count)
+            else:
+                self._finished.errback(errors.IndexError(str(self._ended.value)))
+    
+    def _resume(self, ignored):
+        self._waiting = False
+        if self._paused:
+            self._paused = False
+            if not self._ended:
+                self.transport.resumeProducing()
+        self._deliver()
+    
+    def _fail(self, err):
+        self._rows.clear()
+        if not self._ended:
+            self.transport.stopProducing()
+        if not self._finished.called:
+            self._finished.errback(err)
+    
+    def connectionLost(self, reason):
+        self._ended = reason
+        self._deliver()
 
 class RiakClient(riak.RiakClient):
     """
-    Sub-class of RiakClient extended to build the index definitions.
+    Sub-class of RiakClient extended to build the index definitions.
+    """
+    
+    # Seconds after registering a width partition before the next entry
+    # put into it registers it again, in case another client dropped it.
+    index_marker_ttl = 60
+    
+    def __init__(self, host='127.0.0.1', port=8098,
+                prefix='riak', mapred_prefix='mapred',
+                client_id=None, r_value=2, w_value=2, dw_value=0,
+                index_concurrency=8, index_journal=None,
+                index_backend="keyfilter"):
+        """
+        Construct a new RiakClient object.
+        
+        :param index_concurrency: Maximum number of index requests a single
+                                  store() or delete() keeps in flight.
+        :param index_journal: Optional path of a write-behind journal. When
+                              set, store() and delete() return once the data
+                              key is written and the index changes are
+                              journaled. The index entries are then written
+                              in the background, and any left over from a
+                              previous run are replayed now.
+        :param index_backend: Backend of indexes added without one of their
+                              own ("keyfilter" or "native").
+        """
+        
+        if not index_backend in _INDEX_BACKENDS:
+            raise errors.IndexError("Unknown index backend: %s" % index_backend)
+        
+        self._index_backend = index_backend
+        self._indexes = {}
+        self._index_plans = {}
+        self._entry_indexes = {}
+        # Width partition registry paths -> when this client last registered them
+        self._index_markers = {}
+        self._index_concurrency = index_concurrency
+        riak.RiakClient.__init__(self, host, port, prefix, mapred_prefix,
+                                 client_id, r_value, w_value, dw_value)
+        
+        self._journal = None
+        if index_journal:
+            self._journal = journal.IndexJournal(index_journal,
+                                                 self._apply_index_op,
+                                                 concurrency=index_concurrency)
+            self._journal.start()
+    
+    def get_index_journal(self):
+        """
+        Get the write-behind index journal.
+        
+        :returns: journal.IndexJournal or None if the client writes its
+                  index entries synchronously.
+        """
+        
+        return self._journal
+    
+    def add_index(self, index):
+        """
+        Add a defined secondary index to the Riak client.
+        
+        :param index: - RiakIndex object defining the index.
+        
+        :returns: None
+        """
+        
+        if not isinstance(index, RiakIndex):
+            raise errors.IndexError("Not a RiakIndex instance.")
+        
+        if index._backend is None:
+            index._backend = self._index_backend
+        if index._backend == "native" and \
+           (len(index._fields) > 1 or index._include):
+            raise errors.IndexError("Native indexes can't be compound or " \
+                                    "include fields.")
+        
+        if index._backend == "native" and \
+           (index._shards > 1 or index._part_width or index._part_bounds):
+            raise errors.IndexError("Native indexes can't be sharded or " \
+                                    "partitioned.")
+        
+        if not self._indexes.has_key(index._bucket+"="+index._prefix):
+            self._indexes[index._bucket+"="+index._prefix] = {}
+        
+        self._indexes[index._bucket+"="+index._prefix][index._field] = index
+        index._client = self
+        if index._backend != "native":
+            self._entry_indexes[index._entry_bucket()] = index
+            for idx_bucket in index._shard_buckets():
+                self._entry_indexes[idx_bucket] = index
+        
+        # Recompile the dispatch plan store() and delete() use for
+        # keys of this bucket and prefix.
+        fields = self._indexes[index._bucket+"="+index._prefix]
+        self._index_plans[(index._bucket, index._prefix)] = \
+            tuple([fields[field]._compile() for field in sorted(fields.keys())])
+    
+    @defer.inlineCallbacks
+    def _apply_index_op(self, op):
+        """
+        Put or delete an index entry with a single raw request to its
+        precomputed URL. Entries are put with their JSON body (null unless
+        the index copies fields into it) and a link back to their data
+        key, without asking Riak to return the body. Entries are deleted
+        without being fetched, and one that's already gone counts as
+        deleted. The first entry this client puts into a width partition
+        registers the partition, and so does the first one after
+        *index_marker_ttl* seconds.
+        
+        :param op: Operation dictionary built by *RiakIndex._entry_op()*.
+        
+        :returns: None -- via deferred
+        """
+        
+        dw = op["dw"]
+        if dw is None:
+            dw = self.get_dw()
+        
+        if op["op"] == "put":
+            w = op["w"]
+            if w is None:
+                w = self.get_w()
+            url = "%s?returnbody=false&w=%s&dw=%s" % (op["path"],
+                                                      urllib.quote_plus(str(w)),
+                                                      urllib.quote_plus(str(dw)))
+            headers = {"Content-Type": "text/json",
+                       "X-Riak-ClientId": self.get_client_id(),
+                       "Link": op["link"]}
+            
+            # Register a partition before its first entry, and again every
+            # so often so a drop_partition() elsewhere doesn't hide it
+            marker = op.get("marker")
+            registered = self._index_markers.get(marker)
+            if marker and (registered is None or
+                           time.time() - registered >= self.index_marker_ttl):
+                response = yield riak.RiakUtils.http_request_deferred("PUT",
+                                                                      self._host,
+                                                                      self._port,
+                                                                      marker + "?returnbody=false",
+                                                                      {"Content-Type": "text/json"},
+                                                                      "null")
+                if not response[0]["http_code"] in [200, 204, 300]:
+                    raise errors.IndexError("Error registering index partition " \
+                                            "%s. Status: %s" % (marker,
+                                                                response[0]["http_code"]))
+                self._index_markers[marker] = time.time()
+            
+            response = yield riak.RiakUtils.http_request_deferred("PUT",
+                                                                  self._host,
+                                                                  self._port,
+                                                                  url, headers,
+                                                                  op.get("body", "null"))
+            expected = [200, 204, 300]
+        else:
+            url = op["path"] + "?dw=" + urllib.quote_plus(str(dw))
+            response = yield riak.RiakUtils.http_request_deferred("DELETE",
+                                                                  self._host,
+                                                                  self._port,
+                                                                  url)
+            expected = [204, 404]
+        
+        if not response[0]["http_code"] in expected:
+            raise errors.IndexError("Error %s index entry %s/%s. " \
+                                    "Status: %s" % ({"put": "storing",
+                                                     "delete": "deleting"}[op["op"]],
+                                                    op["bucket"], op["key"],
+                                                    response[0]["http_code"]))
+        
+        index = self._entry_indexes.get(op.get("index", op["bucket"]))
+        if index:
+            index._entry_changed(op.get("value"), op)
+    
+    def store_many(self, bucket, items, concurrency=10, w=None, dw=None,
+                   collect_index_errors=False):
+        """
+        Store many keys in *bucket*. See *RiakBucket.store_many()*.
+        
+        :param bucket: Name of the bucket to store the keys in.
+        
+        :returns: List of (<key>, <success>, <RiakObject or exception>)
+                  tuples -- via deferred
+        """
+        
+        return self.bucket(bucket).store_many(items, concurrency, w, dw,
+                                              collect_index_errors)
+    
+    def delete_many(self, bucket, keys, documents=None, concurrency=10,
+                    dw=None, collect_index_errors=False):
+        """
+        Delete many keys from *bucket*. See *RiakBucket.delete_many()*.
+        
+        :param bucket: Name of the bucket to delete the keys from.
+        
+        :returns: List of (<key>, <success>, <RiakObject or exception>)
+                  tuples -- via deferred
+        """
+        
+        return self.bucket(bucket).delete_many(keys, documents, concurrency,
+                                               dw, collect_index_errors)
+    
+    def get_many(self, bucket, keys, concurrency=10, r=None):
+        """
+        Fetch many keys from *bucket*. See *RiakBucket.get_many()*.
+        
+        :param bucket: Name of the bucket to fetch the keys from.
+        
+        :returns: (<list of RiakObjects>, <list of missing keys>) -- via deferred
+        """
+        
+        return self.bucket(bucket).get_many(keys, concurrency, r)
+
+class RiakBucket(riak.RiakBucketOrig):
+    """
+    Sub-class of RiakBucket extended with bulk operations.
+    """
+    
+    def store_many(self, items, concurrency=10, w=None, dw=None,
+                   collect_index_errors=False):
+        """
+        Store many JSON keys, keeping up to *concurrency* keys (each with
+        their index entries) being written at once. Every key goes
+        through *RiakObject.store()*, so indexes are maintained exactly
+        as for a single store.
+        
+        :param items: Iterable of (<key>, <data>) pairs.
+        :param concurrency: Maximum number of keys being stored at once.
+        :param w: W-value of the data and index writes.
+        :param dw: DW-value of the data and index writes.
+        :param collect_index_errors: If True, keys whose indexes couldn't be
+                                     maintained are reported in the results.
+                                     If False (default), the first
+                                     *errors.IndexMaintenanceError* stops
+                                     the batch and is raised. Failed data
+                                     writes always stop the batch.
+        
+        :returns: List of (<key>, <success>, <RiakObject or exception>)
+                  tuples in the order of *items* -- via deferred
+        """
+        
+        keys = []
+        
+        def store_one(item):
+            key, data = item
+            keys.append(key)
+            return self.new(key, data).store(w, dw)
+        
+        def is_fatal(err):
+            return not (collect_index_errors and
+                        err.check(errors.IndexMaintenanceError))
+        
+        def cb_results(results):
+            return [(key, success, result) for key, (success, result) \
+                                           in zip(keys, results)]
+        
+        d = _run_bounded(items, store_one, concurrency, is_fatal)
+        return d.addCallback(cb_results)
+    
+    def delete_many(self, keys, documents=None, concurrency=10, dw=None,
+                    collect_index_errors=False):
+        """
+        Delete many keys and their index entries, keeping up to
+        *concurrency* keys being fetched and deleted at once. Keys are
+        pipelined: as soon as a key's document is fetched its data and
+        index deletes are issued.
+        
+        :param keys: Iterable of key names.
+        :param documents: Optional dictionary of {<key> : <data>} for keys
+                          whose current data the caller already has.
+                          These keys aren't fetched before deleting.
+        :param concurrency: Maximum number of keys being deleted at once.
+        :param dw: DW-value of the data and index deletes.
+        :param collect_index_errors: If True, keys whose index entries
+                                     couldn't be deleted are reported in the
+                                     results. If False (default), the first
+                                     *errors.IndexMaintenanceError* stops
+                                     the batch and is raised. Failed fetches
+                                     and data deletes always stop the batch.
+        
+        :returns: List of (<key>, <success>, <RiakObject or exception>)
+                  tuples in the order of *keys* -- via deferred
+        """
+        
+        if documents is None:
+            documents = {}
+        deleted = []
+        
+        @defer.inlineCallbacks
+        def delete_one(key):
+            deleted.append(key)
+            if documents.has_key(key):
+                obj = self.new(key, documents[key])
+            else:
+                obj = yield self.get(key)
+            obj = yield obj.delete(dw)
+            defer.returnValue(obj)
+        
+        def is_fatal(err):
+            return not (collect_index_errors and
+                        err.check(errors.IndexMaintenanceError))
+        
+        def cb_results(results):
+            return [(key, success, result) for key, (success, result) \
+                                           in zip(deleted, results)]
+        
+        d = _run_bounded(keys, delete_one, concurrency, is_fatal)
+        return d.addCallback(cb_results)
+    
+    def get_many(self, keys, concurrency=10, r=None):
+        """
+        Fetch many keys, keeping up to *concurrency* GETs in flight. Useful
+        for loading the data keys returned by an index query.
+        
+        :param keys: Iterable of key names.
+        :param concurrency: Maximum number of keys being fetched at once.
+        :param r: R-value of the fetches.
+        
+        :returns: (<list of RiakObjects>, <list of missing keys>), both in
+                  the order of *keys* -- via deferred
+        """
+        
+        fetched = []
+        
+        def get_one(key):
+            fetched.append(key)
+            return self.get(key, r)
+        
+        def cb_results(results):
+            objects = []
+            missing = []
+            for key, (success, obj) in zip(fetched, results):
+                if obj.exists():
+                    objects.append(obj)
+                else:
+                    missing.append(key)
+            return (objects, missing)
+        
+        d = _run_bounded(keys, get_one, concurrency, lambda err: True)
+        return d.addCallback(cb_results)
+
+class RiakObject(riak.RiakObjectOrig):
+    """
+    RiakObjectIndex implements transparent indexing for Riak keys.
+    """
+    
+    
+    
+    def __init__(self, client, bucket, key=None):
+        """
+        Construct a new RiakObject object.
+        """
+        
+        self._idx_values = None
+        self._idx_included = None
+        self._reindexed = []
+        riak.RiakObjectOrig.__init__(self, client, bucket, key)
+    
+    @staticmethod
+    def _escval(value):
+        """
+        Escape '=' and '/' characters in value.
+        
+        :param value: String value to be escaped.
+        
+        :returns: string
+        """
+        
+        # Convert booleans to integers
+        if isinstance(value, bool):
+            value = int(value)
+        
+        return urllib.quote(unicode(value).encode("utf-8"), safe="")
+    
+    @staticmethod
+    def _unescval(value):
+        """
+        Convert escaped '=' and '/' characters back to
+        '=' and '/'.
+        
+        :param value: String value to be unescaped.
+        
+        :returns: string
+        """
+        return urllib.unquote(str(value)).decode("utf-8")
+    
+    def _get_plans(self):
+        """
+        Find the compiled index plans for this key's bucket and key prefix.
+        
+        :returns: (<key_name>, (<_IndexPlan>, ...)) or None if the key
+                  isn't indexed.
+        """
+        
+        key_prefix, sep, key_name = (self._key or "").partition("_")
+        plans = getattr(self._client, "_index_plans", {}).get((self._bucket._name,
+                                                               key_prefix))
+        if not sep or not plans:
+            return None
+        
+        return (key_name, plans)
+    
+    def _index_values(self, data, found=None, failures=None):
+        """
+        Escape the value of every indexed field in *data*.
+        
+        :param data: JSON dictionary
+        :param found: Result of *_get_plans()* if the caller already has it.
+        :param failures: Optional dictionary to record why each field that
+                         can't be indexed couldn't be, keyed on field.
+        
+        :returns: {<field> : <escaped value>} or None if the key isn't
+                  indexed or *data* isn't a dictionary. Fields missing
+                  from *data*, or whose value the index can't encode,
+                  map to None.
+        """
+        
+        if found is None:
+            found = self._get_plans()
+        if not found or not isinstance(data, dict):
+            return None
+        
+        values = {}
+        for plan in found[1]:
+            try:
+                values[plan.field] = "/".join([escape(data[field])
+                                               for field, escape in plan.encoders])
+            except (KeyError, TypeError, ValueError), e:
+                values[plan.field] = None
+                if failures is not None:
+                    failures[plan.field] = e
+        
+        return values
+    
+    def _included_values(self, data, found=None):
+        """
+        Build the entry body of every index copying fields into its entries.
+        
+        :param data: JSON dictionary
+        :param found: Result of *_get_plans()* if the caller already has it.
+        
+        :returns: {<field> : <JSON entry body>} or None if the key isn't
+                  indexed or *data* isn't a dictionary.
+        """
+        
+        if found is None:
+            found = self._get_plans()
+        if not found or not isinstance(data, dict):
+            return None
+        
+        bodies = {}
+        for plan in found[1]:
+            if plan.include:
+                bodies[plan.field] = json.dumps(dict([(field, data.get(field))
+                                                      for field in plan.include]),
+                                                sort_keys=True)
+        
+        return bodies
+    
+    def _populate(self, response, expected_statuses):
+        """
+        Overrides *riak.RiakObject._populate()* to remember the indexed
+        field values Riak holds for this key, so store() only rewrites
+        the index entries of fields that changed.
+        """
+        
+        riak.RiakObjectOrig._populate(self, response, expected_statuses)
+        
+        if self.exists():
+            self._idx_values = self._index_values(self._data)
+            self._idx_included = self._included_values(self._data)
+        else:
+            self._idx_values = None
+            self._idx_included = None
+        
+        return self
+    
+    def set_data(self, data):
+        """
+        Set the data stored in this key. The indexed field values Riak
+        holds are only remembered when the key is fetched or stored, so
+        data that was set but never stored isn't mistaken for them.
+        
+        :param data: JSON dictionary
+        
+        :returns: self
+        """
+        self._data = data
+        
+        return self
+    
+    def get_reindexed_fields(self):
+        """
+        Get the fields whose index entries the last store() or delete()
+        rewrote. Fields whose value didn't change are left out.
+        
+        :returns: list of field names
+        """
+        
+        return list(self._reindexed)
+    
+    @defer.inlineCallbacks
+    def _gather_index_updates(self, updates):
+        """
+        Wait for concurrently running per-field index updates to finish.
+        
+        :param updates: Dictionary of {<field> : <Deferred>} index updates.
+        
+        :returns: None -- via deferred. Raises *errors.IndexMaintenanceError*
+                  naming every field whose update failed.
+        """
+        
+        fields = updates.keys()
+        results = yield defer.DeferredList([updates[field] for field in fields],
+                                           consumeErrors=True)
+        
+        failures = {}
+        for field, (success, result) in zip(fields, results):
+            if not success:
+                failures[field] = result
+        
+        if failures:
+            raise errors.IndexMaintenanceError(failures)
+    
+    @defer.inlineCallbacks
+    def _update_index_entry(self, sem, field, ops, new_value=None,
+                            new_included=None):
+        """
+        Apply, in order, the operations moving a single field's index
+        entry. Every Riak request is made through *sem* so a store never
+        has more than the client's *index_concurrency* index requests
+        in flight.
+        
+        :param sem: DeferredSemaphore shared by all fields of this call.
+        :param field: Indexed field name.
+        :param ops: List of operations built by *RiakIndex._entry_op()*.
+        :param new_value: Escaped value now indexed for *field* or None.
+        :param new_included: Entry body now stored for *field* or None.
+        
+        :returns: None -- via deferred
+        """
+        
+        for op in ops:
+            yield sem.run(self._client._apply_index_op, op)
+        
+        if new_value is not None:
+            self._idx_values[field] = new_value
+        if new_included is not None:
+            self._idx_included[field] = new_included
+    
+    def _maintain_indexes(self, field_ops, new_values=None, missing=None,
+                          new_included=None):
+        """
+        Apply the index entry operations of a store() or delete(), or
+        journal them if the client has a write-behind journal.
+        
+        :param field_ops: Dictionary of {<field> : [<operation>, ...]}.
+        :param new_values: Dictionary of {<field> : <escaped value>} now
+                           indexed, or None for a delete.
+        :param missing: Dictionary of {<field> : <exception>} for indexed
+                        fields that couldn't be read from the data.
+        :param new_included: Dictionary of {<field> : <entry body>} now
+                             stored by covering indexes.
+        
+        :returns: None -- via deferred. Raises *errors.IndexMaintenanceError*
+                  naming every field that failed or is missing.
+        """
+        
+        updates = {}
+        for field in (missing or {}).keys():
+            updates[field] = defer.fail(missing[field])
+        
+        if self._client._journal:
+            ops = []
+            for field in field_ops.keys():
+                ops.extend(field_ops[field])
+            self._client._journal.append(ops)
+            
+            if new_values is not None:
+                for field in field_ops.keys():
+                    self._idx_values[field] = new_values[field]
+                    if (new_included or {}).has_key(field):
+                        self._idx_included[field] = new_included[field]
+        else:
+            sem = defer.DeferredSemaphore(self._client._index_concurrency)
+            for field in field_ops.keys():
+                updates[field] = self._update_index_entry(sem, field,
+                                                          field_ops[field],
+                                                          (new_values or {}).get(field),
+                                                          (new_included or {}).get(field))
+        
+        return self._gather_index_updates(updates)
+    
+    @defer.inlineCallbacks
+    def _store_data(self, w, dw, index_headers):
+        """
+        Store the key like *riak.RiakObject.store()*, sending the native
+        secondary index values of the key along with it.
+        
+        :param w: W-value of the put (defaults to the bucket's W)
+        :param dw: DW-value of the put (defaults to the bucket's DW)
+        :param index_headers: Dictionary of {<2i header> : <value>}.
+        
+        :returns: self -- via deferred
+        """
+        
+        w = self._bucket.get_w(w)
+        dw = self._bucket.get_dw(dw)
+        host, port, url = riak.RiakUtils.build_rest_path(self._client,
+                                                         self._bucket,
+                                                         self._key, None,
+                                                         {"returnbody": "true",
+                                                          "w": w, "dw": dw})
+        
+        headers = {"Accept": "text/plain, */*; q=0.5",
+                   "Content-Type": self.get_content_type(),
+                   "X-Riak-ClientId": self._client.get_client_id(),
+                   "Link": ", ".join([link._to_link_header(self._client)
+                                      for link in self._links])}
+        if self.vclock() != None:
+            headers["X-Riak-Vclock"] = self.vclock()
+        for key in self._metas.keys():
+            headers["X-Riak-Meta-%s" % key] = self._metas[key]
+        headers.update(index_headers)
+        
+        if self._jsonize:
+            content = json.dumps(self.get_data())
+        else:
+            content = self.get_data()
+        
+        response = yield riak.RiakUtils.http_request_deferred("PUT", host, port,
+                                                              url, headers,
+                                                              content)
+        self._populate(response, [200, 300])
+        defer.returnValue(self)
+    
+    @defer.inlineCallbacks
+    def store(self, w=None, dw=None):
+        """
+        Overrides *riak.RiakObject.store()* to automatically create
+        and update indexes. Only fields whose escaped value changed
+        get their index entry rewritten, and the entries of those
+        fields are maintained concurrently. Native indexes are written
+        along with the key itself.
+        """
+        
+        # Remember what's indexed now, since storing reloads the object
+        found = self._get_plans()
+        old_values = self._idx_values or {}
+        old_included = self._idx_included or {}
+        unindexable = {}
+        new_values = self._index_values(self.get_data(), found,
+                                        unindexable) or {}
+        new_included = self._included_values(self.get_data(), found) or {}
+        
+        # Store the key, with its native index values if it has any
+        index_headers = {}
+        for plan in (found or (None, ()))[1]:
+            if plan.header and new_values.get(plan.field) is not None:
+                index_headers[plan.header] = new_values[plan.field]
+        
+        if index_headers:
+            yield self._store_data(w, dw, index_headers)
+        else:
+            yield riak.RiakObjectOrig.store(self, w, dw)
+        
+        # Maintain the indexes if the data key belongs to an index
+        self._reindexed = []
+        
+        if found:
+            key_name, plans = found
+            
+            # Fields stay at their old value until their entry is rewritten
+            self._idx_values = dict(old_values)
+            self._idx_included = dict(old_included)
+            
+            # Maintain indexes for each changed field
+            field_ops = {}
+            missing = {}
+            for plan in plans:
+                field = plan.field
+                old_value = old_values.get(field)
+                if new_values.get(field) is None:
+                    missing[field] = unindexable.get(field, KeyError(field))
+                    continue
+                if old_value == new_values[field] and \
+                   old_included.get(field) == new_included.get(field):
+                    continue
+                
+                self._reindexed.append(field)
+                if plan.header:
+                    # Already written with the key
+                    self._idx_values[field] = new_values[field]
+                    if old_value is not None:
+                        plan.index._entry_changed(old_value)
+                    plan.index._entry_changed(new_values[field])
+                    continue
+                
+                field_ops[field] = []
+                if old_value is not None and old_value != new_values[field]:
+                    field_ops[field].append(plan.index._entry_op("delete",
+                                                                 key_name,
+                                                                 old_value,
+                                                                 dw=dw))
+                field_ops[field].append(plan.index._entry_op("put", key_name,
+                                                             new_values[field],
+                                                             w, dw,
+                                                             new_included.get(field)))
+            
+            yield self._maintain_indexes(field_ops, new_values, missing,
+                                         new_included)
+        
+        defer.returnValue(self)
+    
+    @defer.inlineCallbacks
+    def delete(self, dw=None):
+        """
+        Overrides *riak.RiakObject.delete()* to automatically
+        delete indexes for deleted data keys.
+        """
+        
+        # Delete the key
+        found = self._get_plans()
+        curr_values = self._idx_values
+        if curr_values is None:
+            curr_values = self._index_values(self.get_data(), found) or {}
+        yield riak.RiakObjectOrig.delete(self, dw)
+        
+        # Delete the old index key if the data key belongs to an index
+        self._reindexed = []
+        
+        if found:
+            key_name, plans = found
+            
+            field_ops = {}
+            for plan in plans:
+                field = plan.field
+                if curr_values.get(field) is None:
+                    continue
+                
+                self._reindexed.append(field)
+                if plan.header:
+                    # Deleted along with the key
+                    plan.index._entry_changed(curr_values[field])
+                    continue
+                
+                field_ops[field] = [plan.index._entry_op("delete", key_name,
+                                                         curr_values[field],
+                                                         dw=dw)]
+            
+            yield self._maintain_indexes(field_ops)
+        
+        defer.returnValue(self)
+
+
+class RiakIndex(object):
+    """
+    Riak secondary index object.
+    
+    Defines and queries a Riak secondary index.
+    """
+    
+    idx_bkt_form = "idx=%(bucket)s=%(key_prefix)s=%(field)s"
+    idx_bkt_form_v2 = "idxv2=%(bucket)s=%(key_prefix)s=%(field)s"
+    idx_key_form = "%(key)s/%(field_val)s"
+    idx_shard_form = "%(idx_bucket)s=shard%(shard)d"
+    idx_part_form = "%(idx_bucket)s=part%(part)d"
+    idx_part_registry_form = "%(idx_bucket)s=parts"
+    
+    # Seconds the width partition registry is cached before queries list
+    # it again. Partitions this client writes to are added straight away.
+    partition_registry_ttl = 60
+    
+    def __init__(self, bucket, key_prefix, indexed_field, field_type="str",
+                 cache_size=0, cache_ttl=None, include_fields=None,
+                 sortable=False, backend=None, shards=1,
+                 partition_width=None, partition_bounds=None):
+        """
+        Define a new secondary index. Any keys stored that start with
+        *key_prefix* will be detected and an index value automatically
+        stored.
+        
+        :param bucket: Bucket containing the keys to be included in the index.
+        :param key_prefix: Key prefix of keys to be included in the index.
+        :param indexed_field: Field name in JSON dictionary to be indexed, or
+                              a list of field names for a compound index.
+        :param field_type: Data type of field (int, float, bool, str, unicode),
+                           or a list of types matching the fields of a
+                           compound index.
+        :param cache_size: Number of query results to cache (0 disables the cache)
+        :param cache_ttl: Seconds a cached query result stays valid (None for
+                          no expiry). Entries written through this process
+                          invalidate matching cached results immediately;
+                          the TTL bounds staleness from other writers.
+        :param include_fields: Optional list of other fields whose values are
+                               copied into each index entry and returned by
+                               query(), so listing them needs no data GETs.
+        :param sortable: If True, int and float values are stored with an
+                         encoding whose string order is their numeric order
+                         (index scheme v2, kept in separate "idxv2=" buckets),
+                         so range queries compare strings without converting
+                         every key.
+        :param backend: "keyfilter" to keep an entry key per indexed value
+                        and query them with key filtered MapReduce, or
+                        "native" to send the value as a Riak secondary
+                        index (2i) header with the data key and query it
+                        through the index endpoint. Defaults to the
+                        client's *index_backend*.
+        :param shards: Number of buckets to spread the index entries over,
+                       by a hash of the data key. Queries run one job per
+                       shard concurrently and merge the results.
+        :param partition_width: Split the entries of an int or float index
+                                into buckets each holding a range of this
+                                width, so queries skip the ranges that
+                                can't match and old ranges can be dropped.
+        :param partition_bounds: Split the entries into buckets at these
+                                 sorted values instead of a fixed width.
+        
+        :returns: None
+        """
+        
+        if not backend in (None,) + _INDEX_BACKENDS:
+            raise errors.IndexError("Unknown index backend: %s" % backend)
+        
+        self._bucket = bucket
+        self._prefix = key_prefix
+        self._client = None
+        
+        # Compound indexes store their values in field order, joined by '/'
+        if isinstance(indexed_field, (list, tuple)):
+            self._fields = tuple(indexed_field)
+            if not self._fields:
+                raise errors.IndexError("No fields to index.")
+        else:
+            self._fields = (indexed_field,)
+        self._field = "+".join(self._fields)
+        
+        if isinstance(field_type, (list, tuple)):
+            if len(field_type) != len(self._fields):
+                raise errors.IndexError("Got %d field types for %d fields." % \
+                                        (len(field_type), len(self._fields)))
+            field_types = field_type
+        else:
+            field_types = [field_type] * len(self._fields)
+        
+        # Make sure field isn't a complex datatype
+        self._types = []
+        for field_type in field_types:
+            field_type = str(field_type).lower()
+            if not field_type in ["int", "float", "bool", "str", "unicode"]:
+                raise errors.IllegalDatatypeError(field_type)
+            self._types.append(field_type)
+        
+        self._types = tuple(self._types)
+        self._type = "+".join(self._types)
+        self._include = tuple(include_fields or ())
+        self._sortable = bool(sortable)
+        self._backend = backend
+        self._shards = int(shards)
+        if self._shards < 1:
+            raise errors.IndexError("An index needs at least one shard.")
+        
+        self._part_width = partition_width
+        self._part_bounds = tuple(partition_bounds or ())
+        if partition_width is not None or partition_bounds is not None:
+            if len(self._types) > 1 or not self._types[0] in ["int", "float"]:
+                raise errors.IndexError("Only int and float indexes can be " \
+                                        "partitioned.")
+            if self._shards > 1:
+                raise errors.IndexError("An index can't be both sharded " \
+                                        "and partitioned.")
+            if (partition_width is None) == (partition_bounds is None):
+                raise errors.IndexError("Partition by width or by bounds, " \
+                                        "not both.")
+            if partition_width is not None and not partition_width > 0:
+                raise errors.IndexError("Partition width must be positive.")
+            if partition_bounds is not None and \
+               (not self._part_bounds or
+                list(self._part_bounds) != sorted(set(self._part_bounds))):
+                raise errors.IndexError("Partition bounds must be sorted " \
+                                        "and distinct.")
+        self._partitions = None
+        self._partitions_at = None
+        self._plan = None
+        
+        self._cache = None
+        if cache_size:
+            self._cache = _QueryCache(cache_size, cache_ttl)
+        
+        # Queries running now, keyed on (compare_op, value), so identical
+        # concurrent queries share one MapReduce job. Bumping the generation
+        # when an entry changes keeps queries started after a write from
+        # sharing (or caching) results read before it.
+        self._inflight = {}
+        self._generation = 0
+    
+    def _entry_bucket(self):
+        """
+        Name of the bucket holding this index's entries.
+        
+        :returns: string
+        """
+        
+        if self._sortable:
+            bkt_form = self.idx_bkt_form_v2
+        else:
+            bkt_form = self.idx_bkt_form
+        
+        return bkt_form % {"bucket": self._bucket,
+                           "field": self._field,
+                           "key_prefix": self._prefix}
+    
+    def _shard_buckets(self):
+        """
+        Names of the buckets holding this index's entries, one per shard.
+        
+        :returns: list of strings
+        """
+        
+        idx_bucket = self._entry_bucket()
+        if self._shards == 1:
+            return [idx_bucket]
+        
+        return [self.idx_shard_form % {"idx_bucket": idx_bucket,
+                                       "shard": shard}
+                for shard in range(self._shards)]
+    
+    def _shard_of(self, key_name):
+        """
+        Pick the shard holding a data key's entries. CRC32 is stable across
+        processes and platforms, unlike hash().
+        
+        :param key_name: Data key name without the prefix.
+        
+        :returns: Shard number
+        """
+        
+        if isinstance(key_name, unicode):
+            key_name = key_name.encode("utf-8")
+        
+        return (zlib.crc32(key_name) & 0xffffffff) % self._shards
+    
+    def _partition_of(self, value):
+        """
+        Pick the partition holding an indexed value.
+        
+        :param value: Indexed number.
+        
+        :returns: Partition number
+        """
+        
+        if self._part_bounds:
+            return bisect.bisect_right(self._part_bounds, value)
+        
+        return int(value // self._part_width)
+    
+    def _partition_range(self, partition):
+        """
+        Values held by a partition, from *low* up to but not including *high*.
+        
+        :param partition: Partition number.
+        
+        :returns: (<low>, <high>), either end None if it's unbounded.
+        """
+        
+        if self._part_bounds:
+            bounds = self._part_bounds
+            return (bounds[partition - 1] if partition > 0 else None,
+                    bounds[partition] if partition < len(bounds) else None)
+        
+        return (partition * self._part_width, (partition + 1) * self._part_width)
+    
+    def _partition_bucket(self, partition):
+        """
+        Name of the bucket holding a partition's entries.
+        
+        :param partition: Partition number.
+        
+        :returns: string
+        """
+        
+        return self.idx_part_form % {"idx_bucket": self._entry_bucket(),
+                                     "part": partition}
+    
+    def _registry_path(self, partition):
+        """
+        URL path of the key registering a partition of a width partitioned
+        index, so queries can find it.
+        
+        :param partition: Partition number.
+        
+        :returns: string
+        """
+        
+        registry = self.idx_part_registry_form % {"idx_bucket": self._entry_bucket()}
+        return "/%s/%s/%d" % (self._client._prefix,
+                              urllib.quote_plus(registry), partition)
+    
+    @defer.inlineCallbacks
+    def get_partitions(self, refresh=False):
+        """
+        Get the partitions of a partitioned index. With *partition_bounds*
+        that's every partition; with *partition_width* it's the partitions
+        entries have been written to, as listed from the registry at most
+        *partition_registry_ttl* seconds ago.
+        
+        :param refresh: List the registry again even if it's cached.
+        
+        :returns: Sorted list of (<partition>, <low>, <high>) tuples, where
+                  the partition holds values from *low* up to but not
+                  including *high* (None if unbounded) -- via deferred
+        """
+        
+        if not self._client:
+            raise errors.IndexError("The index has not been added to " \
+                                    "a RiakClient instance.")
+        
+        if self._part_bounds:
+            partitions = range(len(self._part_bounds) + 1)
+        elif self._part_width:
+            if refresh or self._partitions is None or \
+               time.time() - self._partitions_at >= self.partition_registry_ttl:
+                registry = self.idx_part_registry_form % {"idx_bucket": self._entry_bucket()}
+                listed_at = time.time()
+                keys = yield self._client.bucket(registry).list_keys()
+                self._partitions = set([int(key) for key in keys])
+                self._partitions_at = listed_at
+            partitions = sorted(self._partitions)
+        else:
+            raise errors.IndexError("Index on %s isn't partitioned." % self._field)
+        
+        defer.returnValue([(partition,) + self._partition_range(partition)
+                           for partition in partitions])
+    
+    @defer.inlineCallbacks
+    def _query_buckets(self, compare_op, value):
+        """
+        Find the entry buckets a query has to search. Partitions whose
+        values can't match the comparison are left out.
+        
+        :param compare_op: (string) Comparison/predicate operation.
+        :param value: Value already converted by *_filter_arg()*.
+        
+        :returns: List of bucket names -- via deferred
+        """
+        
+        if not (self._part_width or self._part_bounds):
+            defer.returnValue(self._shard_buckets())
+        
+        low, high = _match_range(compare_op, value)
+        
+        # Sortable values are compared encoded
+        if self._sortable:
+            low, high = [end if end is None else self._decode_value(0, end)
+                         for end in (low, high)]
+        
+        partitions = yield self.get_partitions()
+        defer.returnValue([self._partition_bucket(partition)
+                           for partition, part_low, part_high in partitions
+                           if (high is None or part_low is None or part_low <= high) and
+                              (low is None or part_high is None or low < part_high)])
+    
+    @defer.inlineCallbacks
+    def _each_bucket(self, compare_op, value, func):
+        """
+        Call *func* with every entry bucket a query has to search,
+        concurrently.
+        
+        :param compare_op: (string) Comparison/predicate operation.
+        :param value: Value already converted by *_filter_arg()*.
+        :param func: Callable taking a bucket name and returning a Deferred.
+        
+        :returns: List of results in bucket order -- via deferred. Fails
+                  with the first bucket's failure.
+        """
+        
+        buckets = yield self._query_buckets(compare_op, value)
+        try:
+            results = yield defer.gatherResults([defer.maybeDeferred(func, idx_bucket)
+                                                 for idx_bucket in buckets],
+                                                consumeErrors=True)
+        except defer.FirstError, e:
+            e.subFailure.raiseException()
+        
+        defer.returnValue(results)
+    
+    @defer.inlineCallbacks
+    def drop_partition(self, partition, concurrency=10, dw=None):
+        """
+        Delete every entry of a partition, leaving the data keys alone.
+        A width partition is unregistered first, so queries stop searching
+        it before its entries are deleted. Storing a key whose value falls
+        in the partition again brings it back.
+        
+        :param partition: Partition number (see *get_partitions()*)
+        :param concurrency: Maximum number of entry deletes in flight.
+        :param dw: DW-value of the deletes (defaults to the client's DW)
+        
+        :returns: Number of entries deleted -- via deferred
+        """
+        
+        if not self._client:
+            raise errors.IndexError("The index has not been added to " \
+                                    "a RiakClient instance.")
+        if not (self._part_width or self._part_bounds):
+            raise errors.IndexError("Index on %s isn't partitioned." % self._field)
+        
+        if self._part_width:
+            path = self._registry_path(partition)
+            registry = self.idx_part_registry_form % {"idx_bucket": self._entry_bucket()}
+            yield self._client._apply_index_op({"op": "delete",
+                                                "bucket": registry,
+                                                "key": str(partition),
+                                                "path": path,
+                                                "dw": dw})
+            self._client._index_markers.pop(path, None)
+            if self._partitions is not None:
+                self._partitions.discard(partition)
+        
+        part_bucket = self._partition_bucket(partition)
+        path_prefix = "/%s/%s/" % (self._client._prefix,
+                                   urllib.quote_plus(part_bucket))
+        keys = yield self._client.bucket(part_bucket).list_keys()
+        results = yield _run_bounded(keys,
+                                     lambda key: self._client._apply_index_op(
+                                                    {"op": "delete",
+                                                     "bucket": part_bucket,
+                                                     "index": self._plan.idx_bucket,
+                                                     "key": key,
+                                                     "path": path_prefix +
+                                                             urllib.quote_plus(key),
+                                                     "value": key.split("/", 1)[1],
+                                                     "dw": dw}),
+                                     concurrency)
+        self.clear_cache()
+        
+        failed = [result for success, result in results if not success]
+        if failed:
+            raise errors.IndexError("Failed deleting %d of %d entries of " \
+                                    "partition %s: %s" % (len(failed), len(keys),
+                                                          partition, failed[0]))
+        
+        defer.returnValue(len(keys))
+    
+    def _compile(self):
+        """
+        Precompute everything store() and delete() need for this index,
+        so the per-store path does no name formatting or lookups.
+        
+        :returns: _IndexPlan
+        """
+        
+        idx_bucket = self._entry_bucket()
+        prefix = self._client._prefix
+        self._plan = _IndexPlan(field=self._field,
+                                fields=self._fields,
+                                index=self,
+                                idx_bucket=idx_bucket,
+                                path_prefix="/%s/%s/" % (prefix,
+                                                         urllib.quote_plus(idx_bucket)),
+                                link_prefix="</%s/%s/" % (prefix,
+                                                          urllib.quote_plus(self._bucket)),
+                                link_suffix='>; riaktag="%s"' % urllib.quote_plus(self._bucket),
+                                encoders=tuple([(field, self._encoder(pos))
+                                                for pos, field
+                                                in enumerate(self._fields)]),
+                                type=self._type,
+                                include=self._include,
+                                header=None,
+                                shards=())
+        if self._shards > 1:
+            self._plan = self._plan._replace(
+                shards=tuple([(shard_bucket,
+                               "/%s/%s/" % (prefix, urllib.quote_plus(shard_bucket)))
+                              for shard_bucket in self._shard_buckets()]))
+        if self._backend == "native":
+            self._plan = self._plan._replace(header="X-Riak-Index-" +
+                                                    self._native_name())
+        
+        return self._plan
+    
+    def _native_name(self):
+        """
+        Name of this index's native secondary index, typed by its suffix.
+        
+        :returns: string
+        """
+        
+        if self._types[0] in ["int", "bool"]:
+            suffix = "int"
+        else:
+            suffix = "bin"
+        
+        return "%s_%s" % (urllib.quote(self._field, safe="").lower(), suffix)
+    
+    def _entry_op(self, op, key_name, field_val, w=None, dw=None, body=None):
+        """
+        Describe a put or delete of one of this index's entries.
+        
+        :param op: "put" or "delete"
+        :param key_name: Data key name without the prefix.
+        :param field_val: Escaped indexed value of the entry (the escaped
+                          values joined by '/' for a compound index).
+        :param w: W-value of the put (defaults to the client's W)
+        :param dw: DW-value of the put or delete (defaults to the client's DW)
+        :param body: JSON body of the put (defaults to null)
+        
+        :returns: Operation dictionary for *RiakClient._apply_index_op()*
+        """
+        
+        idx_key = self.idx_key_form % {"key": key_name,
+                                       "field_val": field_val}
+        partition = None
+        if self._plan.shards:
+            idx_bucket, path_prefix = self._plan.shards[self._shard_of(key_name)]
+        elif self._part_width or self._part_bounds:
+            partition = self._partition_of(self._decode_value(0, field_val))
+            idx_bucket = self._partition_bucket(partition)
+            path_prefix = "/%s/%s/" % (self._client._prefix,
+                                       urllib.quote_plus(idx_bucket))
+        else:
+            idx_bucket, path_prefix = self._plan.idx_bucket, self._plan.path_prefix
+        entry = {"op": op,
+                 "bucket": idx_bucket,
+                 "index": self._plan.idx_bucket,
+                 "key": idx_key,
+                 "path": path_prefix + urllib.quote_plus(idx_key),
+                 "value": field_val,
+                 "w": w,
+                 "dw": dw}
+        
+        # Width partitions are registered before their first entry is put
+        if op == "put" and partition is not None and self._part_width:
+            entry["marker"] = self._registry_path(partition)
+            entry["partition"] = partition
+        
+        if op == "put":
+            entry["body"] = body or "null"
+            entry["link"] = self._plan.link_prefix + \
+                            urllib.quote_plus(self._prefix + "_" + key_name) + \
+                            self._plan.link_suffix
+        
+        return entry
+    
+    def _decode_index_key(self, key_name):
+        """
+        Splits and decodes an index key into the data key
+        name and the indexed value.
+        
+        :param key_name: Index key name to decode.
+        
+        :returns: (<data_key_name>, <indexed_value>)
+        """
+        
+        key, value = key_name.split("/", 1)
+        return (key, urllib.unquote(value))
+    
+    def _encoder(self, pos):
+        """
+        Get the function escaping one field's values for index keys.
+        
+        :param pos: Position of the field in the index.
+        
+        :returns: Callable taking a value and returning a string
+        """
+        
+        field_type = self._types[pos]
+        if self._backend == "native":
+            if field_type in ["int", "bool"]:
+                return lambda value: str(int(value))
+            elif field_type == "float":
+                return _encode_sortable_float
+            return _escape_native
+        
+        if self._sortable and field_type == "int":
+            return lambda value: RiakObject._escval(_encode_sortable_int(value))
+        elif self._sortable and field_type == "float":
+            return lambda value: RiakObject._escval(_encode_sortable_float(value))
+        
+        return RiakObject._escval
+    
+    def _convert_arg(self, pos, value):
+        """
+        Convert a query value for one field to what the key filter
+        compares against.
+        
+        :param pos: Position of the field in the index.
+        :param value: Value to compare against the field.
+        
+        :returns: Converted value
+        """
+        
+        field_type = self._types[pos]
+        if self._backend == "native" and field_type in ["int", "bool"]:
+            return int(value)
+        elif self._sortable or self._backend == "native":
+            return self._encoder(pos)(value)
+        elif field_type in ["int", "float"]:
+            return value
+        elif field_type == "bool":
+            return int(value)
+        else:
+            return RiakObject._escval(value)
+    
+    def _filter_arg(self, value):
+        """
+        Convert a query value to what the key filter compares against.
+        A compound index takes a tuple of values for its leading fields.
+        
+        :param value: Value to compare against the indexed field.
+        
+        :returns: Converted value
+        """
+        
+        if len(self._fields) == 1:
+            return self._convert_arg(0, value)
+        
+        if not isinstance(value, (list, tuple)):
+            value = (value,)
+        if not 0 < len(value) <= len(self._fields):
+            raise errors.IndexError("Compound index on %s queried with %d " \
+                                    "values." % (self._field, len(value)))
+        
+        return tuple([self._convert_arg(pos, field_value)
+                      for pos, field_value in enumerate(value)])
+    
+    def _value_filters(self, pos):
+        """
+        Key filters extracting and converting the value of one field
+        from an index key.
+        
+        :param pos: Position of the field in the index.
+        
+        :returns: List of key filters
+        """
+        
+        key_filters = [["urldecode"],
+                       ["tokenize", "/", pos + 2]]
+        
+        # Sortable values compare as strings
+        if not self._sortable:
+            if self._types[pos] in ["int", "bool"]:
+                key_filters.append(["string_to_int"])
+            elif self._types[pos] == "float":
+                key_filters.append(["string_to_float"])
+        
+        return key_filters
+    
+    def _leaf_filters(self, compare_op, args):
+        """
+        Key filters for a single predicate. On a compound index the
+        leading values of the arguments must be equal, and the predicate
+        compares the field after them.
+        
+        :param compare_op: Key filter predicate name.
+        :param args: Converted predicate arguments.
+        
+        :returns: List of key filters
+        """
+        
+        if len(self._fields) == 1:
+            return self._value_filters(0) + [[compare_op] + list(args)]
+        
+        values = [arg for arg in args if isinstance(arg, tuple)]
+        leading = values[0][:-1]
+        for arg in values:
+            if arg[:-1] != leading:
+                raise errors.IndexError("Compound index values must share " \
+                                        "their leading values.")
+        
+        key_filters = self._value_filters(len(leading)) + \
+                      [[compare_op] + [arg[-1] if isinstance(arg, tuple) else arg
+                                       for arg in args]]
+        for pos in reversed(range(len(leading))):
+            key_filters = [["and",
+                            self._value_filters(pos) + [["eq", leading[pos]]],
+                            key_filters]]
+        
+        return key_filters
+    
+    def _bind_query(self, compare_op, value):
+        """
+        Convert the comparison of a query for this index.
+        
+        :param compare_op: (string) Comparison/predicate operation or a Predicate.
+        :param value: Value to compare against (ignored for a Predicate).
+        
+        :returns: (<compare_op>, <converted value>)
+        """
+        
+        if isinstance(compare_op, Predicate):
+            return (compare_op._bind(self._filter_arg), None)
+        
+        return (compare_op, self._filter_arg(value))
+    
+    def _filter_value(self, field_val):
+        """
+        Convert an escaped indexed value the way the query key filter does.
+        
+        :param field_val: Escaped indexed value of an entry.
+        
+        :returns: Converted value
+        """
+        
+        if self._sortable or \
+           (self._backend == "native" and self._types[0] == "float"):
+            return field_val
+        
+        try:
+            if self._types[0] in ["int", "bool"]:
+                return int(field_val)
+            elif self._types[0] == "float":
+                return float(field_val)
+        except ValueError:
+            pass
+        
+        return field_val
+    
+    def _entry_changed(self, field_val=None, op=None):
+        """
+        Called once one of this index's entries has been written or
+        deleted. Drops the cached queries that could match the entry.
+        
+        :param field_val: Escaped indexed value of the entry (None if unknown)
+        :param op: Operation dictionary that changed the entry, if any.
+        
+        :returns: None
+        """
+        
+        self._generation += 1
+        if op is not None and op.has_key("marker") and \
+           self._partitions is not None:
+            self._partitions.add(op["partition"])
+        if self._cache:
+            # Compound values aren't matched locally
+            if field_val is None or len(self._fields) > 1:
+                self._cache.clear()
+            else:
+                self._cache.invalidate(self._filter_value(field_val))
+    
+    def get_cache_stats(self):
+        """
+        Get the query cache counters.
+        
+        :returns: Dictionary of hits, misses, evictions, expirations,
+                  invalidations and size, or None if caching is disabled.
+        """
+        
+        if not self._cache:
+            return None
+        
+        return self._cache.stats()
+    
+    def clear_cache(self):
+        """
+        Drop all cached query results.
+        
+        :returns: None
+        """
+        
+        self._generation += 1
+        if self._cache:
+            self._cache.clear()
+    
+    @defer.inlineCallbacks
+    def query(self, compare_op, value=None, timeout=300000, order=None,
+              limit=None, offset=0, after=None):
+        """
+        Query the index to find keys where the indexed field
+        matches the spec'd value according to the spec'd
+        comparison operation (i.e. eq, less_than_eq, etc.)
+        
+        NB: Comparison operations are any of the predicate
+        functions listed on the Basho Wiki:
+        
+        `Predicate Functions <http://wiki.basho.com/Key-Filters.html#Predicate-functions>`
+        
+        Results can be sorted and trimmed in Riak, so at most *offset* +
+        *limit* rows are sent back. Rows are ordered by indexed value, then
+        data key. Passing the last row of a page as *after* fetches the
+        next page without any rows having to be skipped.
+        
+        :param compare_op: (string) Comparison/predicate operation, or a
+                           Predicate expression.
+        :param value: (undefined) Value to compare against the indexed field
+                      (unused with a Predicate).
+        :param timeout: (integer in secs) How long the query should be allowed to run.
+        :param order: "asc" or "desc" to sort by indexed value (defaults to
+                      "asc" when *limit*, *offset* or *after* are given)
+        :param limit: Maximum number of rows to return.
+        :param offset: Number of rows to skip.
+        :param after: Row returned by an earlier query. Only rows sorting
+                      after it are returned.
+        
+        :returns: List of (<data_bucket>, <data_key>, <value>) tuples
+        """
+        
+        if not self._client:
+            raise errors.IndexError("The index has not been added to " \
+                                    "a RiakClient instance.")
+        
+        if order is None and (limit is not None or offset or after is not None):
+            order = "asc"
+        
+        if not order in [None, "asc", "desc"]:
+            raise errors.IndexError("Unknown sort order: %s" % order)
+        
+        page = None
+        if order:
+            if after is not None:
+                after = tuple(after)
+            page = (order, limit, offset, after)
+        
+        compare_op, value = self._bind_query(compare_op, value)
+        
+        query_key = (compare_op, value, page)
+        try:
+            hash(query_key)
+        except TypeError:
+            query_key = None
+        
+        if query_key and self._cache:
+            result = self._cache.get(query_key)
+            if result is not None:
+                defer.returnValue(_copy_rows(result))
+        
+        # Join an identical query that's already running
+        generation = self._generation
+        flight = self._inflight.get(query_key)
+        if flight and flight[0] == generation:
+            waiter = defer.Deferred()
+            flight[1].append(waiter)
+            result = yield waiter
+            defer.returnValue(_copy_rows(result))
+        
+        flight = (generation, [])
+        if query_key:
+            self._inflight[query_key] = flight
+        
+        try:
+            result = yield self._run_query(compare_op, value, timeout, page)
+        except:
+            err = failure.Failure()
+            if self._inflight.get(query_key) is flight:
+                del self._inflight[query_key]
+            for waiter in flight[1]:
+                waiter.errback(err)
+            raise
+        
+        if self._inflight.get(query_key) is flight:
+            del self._inflight[query_key]
+        
+        if query_key and self._cache and self._generation == generation:
+            self._cache.put(query_key, _copy_rows(result))
+        
+        for waiter in flight[1]:
+            waiter.callback(result)
+        
+        defer.returnValue(result)
+    
+    @defer.inlineCallbacks
+    def _run_query(self, compare_op, value, timeout, page=None):
+        """
+        Run a key filtered MapReduce query against the index entries.
+        
+        :param compare_op: (string) Comparison/predicate operation.
+        :param value: Value already converted by *_filter_arg()*.
+        :param timeout: (integer in secs) How long the query should be allowed to run.
+        :param page: Optional (<order>, <limit>, <offset>, <after>) tuple.
+        
+        :returns: List of (<data_bucket>, <data_key>, <value>) tuples, with
+                  a dictionary of the included fields appended for indexes
+                  that have them.
+        """
+        
+        if self._backend == "native":
+            result = yield self._run_native_query(compare_op, value)
+            defer.returnValue(self._page_rows(result, page))
+        
+        results = yield self._each_bucket(compare_op, value,
+                                          lambda idx_bucket:
+                                          self._run_query_job(compare_op, value,
+                                                              timeout, page,
+                                                              idx_bucket))
+        result = [row for rows in results for row in rows]
+        
+        # Map phase output isn't ordered, and each shard's page is trimmed
+        # on its own, so those pages are re-sorted and trimmed here
+        if page and (self._include or len(results) > 1):
+            defer.returnValue(self._page_rows(result, page))
+        elif page:
+            defer.returnValue(result[page[2]:])
+        
+        defer.returnValue(result)
+    
+    @defer.inlineCallbacks
+    def _run_query_job(self, compare_op, value, timeout, page, idx_bucket):
+        """
+        Run the key filtered MapReduce job of a query against one shard.
+        
+        :param compare_op: (string) Comparison/predicate operation.
+        :param value: Value already converted by *_filter_arg()*.
+        :param timeout: (integer in secs) How long the query should be allowed to run.
+        :param page: Optional (<order>, <limit>, <offset>, <after>) tuple.
+        :param idx_bucket: Name of the shard's entry bucket.
+        
+        :returns: List of decoded rows, sorted and trimmed to *offset* +
+                  *limit* rows when paging -- via deferred
+        """
+        
+        # Create key filtered MapReduce job
+        job = self._client.add(self._query_inputs(compare_op, value, idx_bucket))
+        
+        # Use the built-in Riak identity reduce
+        if page or not self._include:
+            job.reduce(["riak_kv_mapreduce", "reduce_identity"])
+        
+        if page:
+            order, limit, offset, after = page
+            keep = None
+            if limit is not None:
+                keep = offset + limit
+            if after is not None:
+                after_values = after[2]
+                if len(self._fields) == 1:
+                    after_values = [after_values]
+                if self._sortable:
+                    after_values = [RiakObject._unescval(self._encoder(pos)(field_value))
+                                    for pos, field_value in enumerate(after_values)]
+                after = [list(after_values), after[1][len(self._prefix) + 1:]]
+            job.reduce(_PAGE_REDUCE_JS,
+                       {"arg": {"numeric": [field_type in ["int", "float", "bool"] and
+                                            not self._sortable
+                                            for field_type in self._types],
+                                "desc": order == "desc",
+                                "keep": keep,
+                                "after": after}})
+        
+        # Read the included fields from the entry bodies
+        if self._include:
+            job.map(_ENTRY_MAP_JS)
+        
+        # Run the query and parse the results
+        try:
+            result = yield job.run(timeout)
+        except Exception, e:
+            raise errors.IndexError(str(e))
+        
+        defer.returnValue([self._decode_match(match) for match in result])
+    
+    def _native_range(self, compare_op, value):
+        """
+        Translate a comparison to the bounds of a native 2i query, which
+        matches either one value or an inclusive range of them.
+        
+        :param compare_op: (string) Comparison/predicate operation, Match or
+                           Between.
+        :param value: Value already converted by *_filter_arg()*.
+        
+        :returns: [<value>] or [<start>, <end>]
+        """
+        
+        numeric = self._types[0] in ["int", "bool"]
+        if numeric:
+            lowest, highest = _NATIVE_INT_MIN, _NATIVE_INT_MAX
+        else:
+            lowest, highest = _NATIVE_BIN_MIN, _NATIVE_BIN_MAX
+        
+        if isinstance(compare_op, Between):
+            low, high, inclusive = compare_op._args
+            if inclusive:
+                return [low, high]
+            elif numeric:
+                return [low + 1, high - 1]
+        elif isinstance(compare_op, Match):
+            return self._native_range(*compare_op._args)
+        elif compare_op == "eq":
+            return [value]
+        elif compare_op == "greater_than_eq":
+            return [value, highest]
+        elif compare_op == "less_than_eq":
+            return [lowest, value]
+        elif compare_op == "greater_than":
+            # No native value sorts between a string and itself plus a space
+            if numeric:
+                return [value + 1, highest]
+            return [value + " ", highest]
+        elif compare_op == "less_than" and numeric:
+            return [lowest, value - 1]
+        
+        raise errors.IndexError("Native index on %s can't answer the " \
+                                "query: %r" % (self._field, compare_op))
+    
+    @defer.inlineCallbacks
+    def _run_native_query(self, compare_op, value):
+        """
+        Query the native secondary index through Riak's index endpoint.
+        Ranges ask Riak to return the matched values. Riak versions that
+        can't leave the value of those rows None.
+        
+        :param compare_op: (string) Comparison/predicate operation, Match or
+                           Between.
+        :param value: Value already converted by *_filter_arg()*.
+        
+        :returns: List of (<data_bucket>, <data_key>, <value>) tuples
+                  -- via deferred
+        """
+        
+        bounds = self._native_range(compare_op, value)
+        url = "/buckets/%s/index/%s/%s" % (urllib.quote_plus(self._bucket),
+                                           urllib.quote(self._native_name(),
+                                                        safe=""),
+                                           "/".join([urllib.quote(str(bound),
+                                                                  safe="")
+                                                     for bound in bounds]))
+        if len(bounds) > 1:
+            url += "?return_terms=true"
+        
+        response = yield riak.RiakUtils.http_request_deferred("GET",
+                                                              self._client._host,
+                                                              self._client._port,
+                                                              url)
+        if response[0]["http_code"] != 200:
+            raise errors.IndexError("Error querying native index %s. " \
+                                    "Status: %s" % (self._native_name(),
+                                                    response[0]["http_code"]))
+        
+        body = json.loads(response[1])
+        if body.has_key("results"):
+            matches = [item.items()[0] for item in body["results"]]
+        elif len(bounds) == 1:
+            matches = [(bounds[0], key) for key in body.get("keys", [])]
+        else:
+            matches = [(None, key) for key in body.get("keys", [])]
+        
+        # Other key prefixes of the bucket can share the index name
+        key_prefix = self._prefix + "_"
+        result = []
+        for term, key in matches:
+            if not key.startswith(key_prefix):
+                continue
+            if term is not None:
+                term = self._decode_value(0, str(term))
+            result.append([self._bucket, key, term])
+        
+        defer.returnValue(result)
+    
+    @staticmethod
+    def _page_rows(rows, page):
+        """
+        Sort and trim query rows locally, for backends that can't do it
+        in Riak.
+        
+        :param rows: List of (<data_bucket>, <data_key>, <value>) tuples.
+        :param page: Optional (<order>, <limit>, <offset>, <after>) tuple.
+        
+        :returns: list
+        """
+        
+        if not page:
+            return rows
+        
+        order, limit, offset, after = page
+        desc = order == "desc"
+        rows = sorted(rows, key=lambda row: (row[2], row[1]), reverse=desc)
+        
+        if after is not None:
+            mark = (after[2], after[1])
+            if desc:
+                rows = [row for row in rows if (row[2], row[1]) < mark]
+            else:
+                rows = [row for row in rows if (row[2], row[1]) > mark]
+        
+        if limit is None:
+            return rows[offset:]
+        return rows[offset:offset + limit]
+    
+    @defer.inlineCallbacks
+    def count(self, compare_op, value=None, timeout=300000):
+        """
+        Count the keys matching a query without sending them back.
+        
+        :param compare_op: (string) Comparison/predicate operation, or a
+                           Predicate expression.
+        :param value: (undefined) Value to compare against the indexed field
+                      (unused with a Predicate).
+        :param timeout: (integer in secs) How long the query should be allowed to run.
+        
+        :returns: Number of matching keys -- via deferred
+        """
+        
+        if not self._client:
+            raise errors.IndexError("The index has not been added to " \
+                                    "a RiakClient instance.")
+        
+        if self._backend == "native":
+            result = yield self._run_native_query(*self._bind_query(compare_op,
+                                                                    value))
+            defer.returnValue(len(result))
+        
+        compare_op, value = self._bind_query(compare_op, value)
+        
+        @defer.inlineCallbacks
+        def count_shard(idx_bucket):
+            job = self._client.add(self._query_inputs(compare_op, value,
+                                                      idx_bucket))
+            job.reduce(["riak_kv_mapreduce", "reduce_count_inputs"])
+            
+            try:
+                result = yield job.run(timeout)
+            except Exception, e:
+                raise errors.IndexError(str(e))
+            
+            if not result:
+                defer.returnValue(0)
+            defer.returnValue(result[0])
+        
+        counts = yield self._each_bucket(compare_op, value, count_shard)
+        defer.returnValue(sum(counts))
+    
+    @defer.inlineCallbacks
+    def exists(self, compare_op, value=None, timeout=300000):
+        """
+        Check whether any key matches a query. At most one match is
+        sent back.
+        
+        :param compare_op: (string) Comparison/predicate operation, or a
+                           Predicate expression.
+        :param value: (undefined) Value to compare against the indexed field
+                      (unused with a Predicate).
+        :param timeout: (integer in secs) How long the query should be allowed to run.
+        
+        :returns: bool -- via deferred
+        """
+        
+        if not self._client:
+            raise errors.IndexError("The index has not been added to " \
+                                    "a RiakClient instance.")
+        
+        if self._backend == "native":
+            result = yield self._run_native_query(*self._bind_query(compare_op,
+                                                                    value))
+            defer.returnValue(len(result) > 0)
+        
+        compare_op, value = self._bind_query(compare_op, value)
+        
+        @defer.inlineCallbacks
+        def exists_shard(idx_bucket):
+            job = self._client.add(self._query_inputs(compare_op, value,
+                                                      idx_bucket))
+            job.reduce("function(values) { return values.slice(0, 1); }")
+            
+            try:
+                result = yield job.run(timeout)
+            except Exception, e:
+                raise errors.IndexError(str(e))
+            
+            defer.returnValue(len(result) > 0)
+        
+        found = yield self._each_bucket(compare_op, value, exists_shard)
+        defer.returnValue(True in found)
+    
+    @defer.inlineCallbacks
+    def query_objects(self, compare_op, value=None, fields=None,
+                      timeout=300000):
+        """
+        Query the index and fetch the matching data documents in the same
+        MapReduce job, by following each index entry's link back to its
+        data key.
+        
+        :param compare_op: (string) Comparison/predicate operation, or a
+                           Predicate expression.
+        :param value: (undefined) Value to compare against the indexed field
+                      (unused with a Predicate).
+        :param fields: Optional list of fields to return from each document.
+        :param timeout: (integer in secs) How long the query should be allowed to run.
+        
+        :returns: List of (<data_bucket>, <data_key>, <document>) tuples
+                  -- via deferred
+        """
+        
+        if not self._client:
+            raise errors.IndexError("The index has not been added to " \
+                                    "a RiakClient instance.")
+        
+        if self._backend == "native":
+            # Native matches are data keys already, so fetch them directly
+            rows = yield self._run_native_query(*self._bind_query(compare_op,
+                                                                  value))
+            objects, missing = yield self._client.get_many(self._bucket,
+                                                           [row[1] for row in rows])
+            result = []
+            for obj in objects:
+                doc = obj.get_data()
+                if fields and isinstance(doc, dict):
+                    doc = dict([(field, doc[field]) for field in fields
+                                if doc.has_key(field)])
+                result.append([self._bucket, obj.get_key(), doc])
+            defer.returnValue(result)
+        
+        compare_op, value = self._bind_query(compare_op, value)
+        
+        @defer.inlineCallbacks
+        def fetch_shard(idx_bucket):
+            job = self._client.add(self._query_inputs(compare_op, value,
+                                                      idx_bucket))
+            job.link("_", "_")
+            job.map(_OBJECTS_MAP_JS, {"arg": fields and list(fields) or None})
+            
+            try:
+                result = yield job.run(timeout)
+            except Exception, e:
+                raise errors.IndexError(str(e))
+            
+            defer.returnValue(result)
+        
+        results = yield self._each_bucket(compare_op, value, fetch_shard)
+        defer.returnValue([[urllib.unquote(match[0]), urllib.unquote(match[1]),
+                            match[2]] for result in results for match in result])
+    
+    def _query_inputs(self, compare_op, value, idx_bucket=None):
+        """
+        Build the key filtered MapReduce inputs selecting the index entries
+        that match.
+        
+        :param compare_op: (string) Comparison/predicate operation.
+        :param value: Value already converted by *_filter_arg()*.
+        :param idx_bucket: Entry bucket to query (defaults to the unsharded one)
+        
+        :returns: MapReduce inputs dictionary
+        """
+        
+        if idx_bucket is None:
+            idx_bucket = self._entry_bucket()
+        
+        if isinstance(compare_op, Predicate):
+            key_filters = compare_op._key_filters(self._leaf_filters)
+        else:
+            key_filters = self._leaf_filters(compare_op, [value])
+        
+        return {"bucket" : urllib.quote(idx_bucket),
+                "key_filters" : key_filters}
+    
+    def _decode_value(self, pos, value):
+        """
+        Decode one escaped value from an index key.
+        
+        :param pos: Position of the field in the index.
+        :param value: Escaped value.
+        
+        :returns: Decoded value
+        """
+        
+        field_type = self._types[pos]
+        value = RiakObject._unescval(value)
+        
+        if self._backend == "native":
+            if field_type in ["int", "bool"]:
+                value = int(value)
+                if field_type == "bool":
+                    value = bool(value)
+            elif field_type == "float":
+                value = _decode_sortable_float(value)
+            return value
+        
+        if self._sortable and field_type == "int":
+            value = _decode_sortable_int(value)
+        elif self._sortable and field_type == "float":
+            value = _decode_sortable_float(value)
+        elif self._sortable and field_type == "bool":
+            value = bool(int(value))
+        elif field_type == "int":
+            value = int(value)
+        elif field_type == "float":
+            value = float(value)
+        elif field_type == "bool":
+            value = bool(value)
+        
+        return value
+    
+    def _decode_match(self, match):
+        """
+        Decode a [<index_bucket>, <index_key>] query match, or an
+        [<index_bucket>, <index_key>, <entry body>] one for indexes with
+        included fields.
+        
+        :returns: [<data_bucket>, <data_key>, <value>] plus the dictionary
+                  of included fields for indexes that have them. The value
+                  of a compound index is a tuple.
+        """
+        
+        x, data_bucket, prefix, y = urllib.unquote(match[0]).split("=", 3)
+        data_key, value = urllib.unquote(match[1]).split("/", 1)
+        
+        if len(self._fields) == 1:
+            value = self._decode_value(0, value)
+        else:
+            value = tuple([self._decode_value(pos, field_value)
+                           for pos, field_value
+                           in enumerate(value.split("/"))])
+        
+        if self._include:
+            included = match[2] if len(match) > 2 else None
+            if not isinstance(included, dict):
+                included = {}
+            return [data_bucket, prefix+"_"+data_key, value,
+                    dict([(field, included.get(field)) for field in self._include])]
+        
+        return [data_bucket, prefix+"_"+data_key, value]
+    
+    @defer.inlineCallbacks
+    def query_stream(self, compare_op, value, consumer, timeout=300000):
+        """
+        Query the index like *query()*, but hand each match to *consumer*
+        as Riak streams it back instead of building the whole result list.
+        If *consumer* returns a Deferred, reading the response pauses until
+        it fires, so a slow consumer holds back Riak rather than piling up
+        rows in memory. The shards of a sharded index stream concurrently,
+        so their rows arrive interleaved.
+        
+        :param compare_op: (string) Comparison/predicate operation, or a
+                           Predicate expression.
+        :param value: (undefined) Value to compare against the indexed field
+                      (unused with a Predicate).
+        :param consumer: Callable taking a [<data_bucket>, <data_key>, <value>] row.
+        :param timeout: (integer in secs) How long the query should be allowed to run.
+        
+        :returns: Number of rows handed to *consumer* -- via deferred
+        """
+        
+        if not self._client:
+            raise errors.IndexError("The index has not been added to " \
+                                    "a RiakClient instance.")
+        
+        # Native queries come back in a single response
+        if self._backend == "native":
+            rows = yield self._run_native_query(*self._bind_query(compare_op,
+                                                                  value))
+            for row in rows:
+                yield defer.maybeDeferred(consumer, row)
+            defer.returnValue(len(rows))
+        
+        # Map phases emit as their inputs complete; a reduce phase would
+        # hold everything back until the end.
+        if self._include:
+            source = _ENTRY_MAP_JS
+        else:
+            source = "function(v) { return v.not_found ? [] : [[v.bucket, v.key]]; }"
+        
+        compare_op, value = self._bind_query(compare_op, value)
+        counts = yield self._each_bucket(compare_op, value,
+                                         lambda idx_bucket:
+                                         self._stream_shard(self._query_inputs(compare_op,
+                                                                               value,
+                                                                               idx_bucket),
+                                                            source, consumer,
+                                                            timeout))
+        defer.returnValue(sum(counts))
+    
+    @defer.inlineCallbacks
+    def _stream_shard(self, inputs, source, consumer, timeout):
+        """
+        Run a streamed MapReduce job over one shard's matching entries.
+        
+        :param inputs: MapReduce inputs built by *_query_inputs()*.
+        :param source: JavaScript source of the map phase.
+        :param consumer: Callable taking a [<data_bucket>, <data_key>, <value>] row.
+        :param timeout: (integer in secs) How long the query should be allowed to run.
+        
+        :returns: Number of rows handed to *consumer* -- via deferred
+        """
+        
+        job = {"inputs": inputs,
+               "query": [{"map": {"language": "javascript",
+                                  "source": source,
+                                  "keep": True}}],
+               "timeout": timeout}
+        
+        url = "http://%s:%d/%s?chunked=true" % (self._client._host,
+                                                 self._client._port,
+                                                 self._client._mapred_prefix)
+        response = yield web_client.Agent(reactor).request(
+                            "POST", url,
+                            Headers({"Content-Type": ["application/json"]}),
+                            riak.StringProducer(json.dumps(job)))
+        
+        content_type = response.headers.getRawHeaders("content-type", [""])[0]
+        boundary = re.search(r'boundary="?([^";]+)"?', content_type)
+        if response.code != 200 or not boundary:
+            body = defer.Deferred()
+            response.deliverBody(riak.ResponseReceiver(body))
+            body = yield body
+            raise errors.IndexError("Error running map/reduce job. " \
+                                    "Status: %s Error: %s" % (response.code, body))
+        
+        finished = defer.Deferred()
+        response.deliverBody(_QueryStreamReceiver(boundary.group(1),
+                                                  self._decode_match,
+                                                  consumer, finished))
+        count = yield finished
+        defer.returnValue(count)
+
+class MirroredIndex(RiakIndex):
+    """
+    Secondary index mirrored in memory, so queries it can evaluate
+    locally are answered without a MapReduce job.
+    
+    The mirror keeps the indexed values sorted in one list, with the data
+    keys in a parallel list, so lookups are a bisect of the values. It is
+    loaded from the index entries by start(), kept current by the entries
+    this client writes, and reloaded every *resync_interval* seconds to
+    pick up other writers.
+    
+    With a *snapshot_path*, the mirror is saved to a binary file after
+    every reload, and start() loads that file without asking Riak, then
+    reloads the mirror in the background. Until that reload finishes,
+    queries see the index as it was when the snapshot was saved.
     """
     
-    def __init__(self, host='127.0.0.1', port=8098,
-                prefix='riak', mapred_prefix='mapred',
-                client_id=None, r_value=2, w_value=2, dw_value=0):
+    def __init__(self, bucket, key_prefix, indexed_field, field_type="str",
+                 resync_interval=None, snapshot_path=None, **kwargs):
         """
-        Construct a new RiakClient object.
+        Define a new mirrored secondary index. Takes the arguments of
+        *RiakIndex*, except that it can't be compound, include fields,
+        or use the native backend.
+        
+        :param resync_interval: Seconds between reloads of the mirror from
+                                Riak (None to only reload on resync()).
+        :param snapshot_path: Optional path of a file to save the mirror to
+                              and start from.
+        
+        :returns: None
         """
         
-        self._indexes = {}
-        riak.RiakClient.__init__(self, host, port, prefix, mapred_prefix,
-                                 client_id, r_value, w_value, dw_value)
+        if kwargs.get("backend") == "native":
+            raise errors.IndexError("Mirrored indexes need the keyfilter backend.")
+        kwargs["backend"] = "keyfilter"
+        RiakIndex.__init__(self, bucket, key_prefix, indexed_field,
+                           field_type, **kwargs)
+        
+        if len(self._fields) > 1 or self._include:
+            raise errors.IndexError("Mirrored indexes can't be compound or " \
+                                    "include fields.")
+        if self._types[0] == "bool":
+            raise errors.IndexError("Mirrored indexes can't be bool.")
+        
+        self._resync_interval = resync_interval
+        self._snapshot_path = snapshot_path
+        self._hwm = None
+        self._resync_loop = None
+        self._values = None
+        self._keys = None
+        self._by_key = None
+        self._synced_at = None
+        self._updates = 0
+        self._resyncing = None
+        self._resync_waiting = None
+        self._save_lock = defer.DeferredLock()
     
-    def add_index(self, index):
+    def start(self):
         """
-        Add a defined secondary index to the Riak client.
+        Load the mirror and start reloading it every *resync_interval*
+        seconds. If there's a snapshot, it's loaded straight away and the
+        mirror is reloaded from Riak in the background.
         
-        :param index: - RiakIndex object defining the index.
+        :returns: Number of entries loaded -- via deferred
+        """
         
-        :returns: None
+        def cb_loop(ignored):
+            if self._resync_interval and not self._resync_loop:
+                self._resync_loop = task.LoopingCall(self._background_resync)
+                self._resync_loop.start(self._resync_interval, now=False)
+            return len(self._values)
+        
+        if self._snapshot_path and self.load_snapshot():
+            self._background_resync()
+            d = defer.succeed(None)
+        else:
+            d = self.resync()
+        
+        return d.addCallback(cb_loop)
+    
+    def stop(self):
         """
+        Stop reloading the mirror, saving it to the snapshot if there is
+        one. Queries keep using it as last loaded.
         
-        if not isinstance(index, RiakIndex):
-            raise errors.IndexError("Not a RiakIndex instance.")
+        :returns: None -- via deferred
+        """
         
-        if not self._indexes.has_key(index._bucket+"="+index._prefix):
-            self._indexes[index._bucket+"="+index._prefix] = {}
+        if self._resync_loop and self._resync_loop.running:
+            self._resync_loop.stop()
+        self._resync_loop = None
         
-        self._indexes[index._bucket+"="+index._prefix][index._field] = index
-        index._client = self
-
-class RiakObject(riak.RiakObjectOrig):
-    """
-    RiakObjectIndex implements transparent indexing for Riak keys.
-    """
+        if self._snapshot_path and self._values is not None:
+            return self._save_in_thread()
+        return defer.succeed(None)
     
+    def _background_resync(self):
+        """
+        Reload the mirror from the looping call or after loading a
+        snapshot, logging failures rather than raising them.
+        """
+        
+        return self.resync().addErrback(log.err, "Error resyncing mirrored " \
+                                                 "index on %s" % self._field)
     
+    def resync(self):
+        """
+        Reload the mirror from the index entries in Riak. Entries this
+        client writes while the entries are listed are applied on top.
+        Calls made while a reload is running wait for that one.
+        
+        :returns: Number of entries loaded -- via deferred
+        """
+        
+        if self._resync_waiting is not None:
+            d = defer.Deferred()
+            self._resync_waiting.append(d)
+            return d
+        
+        def cb_done(result):
+            waiting, self._resync_waiting = self._resync_waiting, None
+            for d in waiting:
+                if isinstance(result, failure.Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+            return result
+        
+        self._resync_waiting = []
+        return self._resync().addBoth(cb_done)
     
-    def __init__(self, client, bucket, key=None):
+    @defer.inlineCallbacks
+    def _resync(self):
         """
-        Construct a new RiakObject object.
+        List the index entries and replace the mirror with them.
+        
+        :returns: Number of entries loaded -- via deferred
         """
         
-        self._old_data = None
-        riak.RiakObjectOrig.__init__(self, client, bucket, key)
+        if not self._client:
+            raise errors.IndexError("The index has not been added to " \
+                                    "a RiakClient instance.")
+        
+        started = time.time()
+        self._resyncing = []
+        try:
+            listings = yield self._each_bucket(None, None,
+                                               lambda idx_bucket:
+                                               self._client.bucket(idx_bucket).list_keys())
+        except:
+            self._resyncing = None
+            raise
+        
+        entries = []
+        for keys in listings:
+            for idx_key in keys:
+                key_name, field_val = idx_key.split("/", 1)
+                entries.append((self._decode_value(0, field_val),
+                                self._prefix + "_" + key_name))
+        entries.sort()
+        
+        self._values = [entry[0] for entry in entries]
+        self._keys = [entry[1] for entry in entries]
+        self._by_key = dict([(entry[1], entry[0]) for entry in entries])
+        self._updates = 0
+        self._synced(started)
+        
+        defer.returnValue(len(entries))
     
-    @staticmethod
-    def _escval(value):
+    def _synced(self, started):
         """
-        Escape '=' and '/' characters in value.
+        Finish a reload of the mirror: apply the entries this client wrote
+        while it ran, and save the snapshot unless a save is still running.
         
-        :param value: String value to be escaped.
+        :param started: Time the reload started listing entries.
+        
+        :returns: None
+        """
+        
+        updates, self._resyncing = self._resyncing, None
+        for op in updates:
+            self._mirror_op(op)
+        
+        self._hwm = started
+        self._synced_at = time.time()
+        
+        if self._snapshot_path and not self._save_lock.locked:
+            self._save_in_thread().addErrback(log.err, "Error saving mirrored " \
+                                                       "index snapshot to %s" % \
+                                                       self._snapshot_path)
+    
+    def save_snapshot(self, path=None):
+        """
+        Write the mirror and the time it was loaded from Riak to a binary
+        snapshot file. The file is replaced atomically.
+        
+        :param path: Snapshot path (defaults to *snapshot_path*)
+        
+        :returns: Number of entries saved
+        """
+        
+        _write_snapshot(path or self._snapshot_path, self._snapshot_data())
+        return len(self._values)
+    
+    def _save_in_thread(self):
+        """
+        Save the snapshot from a thread, so writing and fsyncing a large
+        mirror doesn't hold up the reactor. The mirror is serialized now,
+        and written once any save already running has finished.
+        
+        :returns: Number of entries saved -- via deferred
+        """
+        
+        count = len(self._values)
+        d = self._save_lock.run(threads.deferToThread, _write_snapshot,
+                                self._snapshot_path, self._snapshot_data())
+        return d.addCallback(lambda ignored: count)
+    
+    def _snapshot_data(self):
+        """
+        Serialize the mirror in the snapshot layout.
         
         :returns: string
         """
         
-        # Convert booleans to integers
-        if isinstance(value, bool):
-            value = int(value)
+        if self._values is None:
+            raise errors.IndexError("The mirror hasn't been loaded.")
         
-        return urllib.quote(unicode(value).encode("utf-8"), safe="")
+        name = self._snapshot_name()
+        encode = self._encoder(0)
+        key_start = len(self._prefix) + 1
+        
+        parts = [_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, self._hwm, len(name),
+                                       len(self._values)), name]
+        for value, key in zip(self._values, self._keys):
+            key_name = key[key_start:].encode("utf-8")
+            field_val = encode(value)
+            parts.append(_SNAPSHOT_ENTRY.pack(len(key_name), len(field_val)))
+            parts.append(key_name)
+            parts.append(field_val)
+        
+        return "".join(parts)
     
-    @staticmethod
-    def _unescval(value):
+    def load_snapshot(self, path=None):
         """
-        Convert escaped '=' and '/' characters back to
-        '=' and '/'.
+        Load the mirror from a snapshot file by memory-mapping it. The
+        snapshot is ignored if it's missing, damaged, or was saved for a
+        different index.
         
-        :param value: String value to be unescaped.
+        :param path: Snapshot path (defaults to *snapshot_path*)
+        
+        :returns: True if the snapshot was loaded
+        """
+        
+        path = path or self._snapshot_path
+        if not os.path.exists(path):
+            return False
+        
+        f = open(path, "rb")
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < _SNAPSHOT_HEADER.size:
+                return False
+            
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                magic, hwm, name_len, count = _SNAPSHOT_HEADER.unpack_from(data, 0)
+                offset = _SNAPSHOT_HEADER.size
+                if magic != _SNAPSHOT_MAGIC or \
+                   data[offset:offset + name_len] != self._snapshot_name():
+                    return False
+                offset += name_len
+                
+                key_prefix = unicode(self._prefix + "_")
+                values = []
+                keys = []
+                for i in xrange(count):
+                    key_len, value_len = _SNAPSHOT_ENTRY.unpack_from(data, offset)
+                    offset += _SNAPSHOT_ENTRY.size
+                    keys.append(key_prefix + data[offset:offset + key_len].decode("utf-8"))
+                    offset += key_len
+                    values.append(self._decode_value(0, data[offset:offset + value_len]))
+                    offset += value_len
+                
+                if offset != size:
+                    return False
+            except (struct.error, ValueError):
+                return False
+            finally:
+                data.close()
+        finally:
+            f.close()
+        
+        self._values = values
+        self._keys = keys
+        self._by_key = dict(zip(keys, values))
+        self._hwm = hwm
+        self._synced_at = hwm
+        self._updates = 0
+        
+        return True
+    
+    def _snapshot_name(self):
+        """
+        Identify the index a snapshot belongs to.
         
         :returns: string
         """
-        return urllib.unquote(str(value)).decode("utf-8")
+        
+        return "%s;%s" % (self._entry_bucket(), self._type)
     
-    def set_data(self, data):
+    def _entry_changed(self, field_val=None, op=None):
+        """
+        Overrides *RiakIndex._entry_changed()* to apply entry writes to
+        the mirror too.
         """
-        Set the data stored in this key. If the object is already
-        set store the old value in *self._old_data* so we can 
-        delete the old index at store time.
         
-        :param data: JSON dictionary
+        RiakIndex._entry_changed(self, field_val, op)
         
-        :returns: self
+        if op is not None and op.has_key("value"):
+            if self._resyncing is not None:
+                self._resyncing.append(op)
+            if self._values is not None:
+                self._mirror_op(op)
+    
+    def _mirror_op(self, op):
         """
-        if self._data:
-            self._old_data = copy(self._data)
-        self._data = data
+        Apply an entry put or delete to the mirror.
         
-        return self
+        :param op: Operation dictionary built by *RiakIndex._entry_op()*.
+        
+        :returns: None
+        """
+        
+        key = self._prefix + "_" + op["key"].split("/", 1)[0]
+        value = self._decode_value(0, op["value"])
+        
+        if op["op"] == "put":
+            self._mirror_remove(key)
+            low = bisect.bisect_left(self._values, value)
+            high = bisect.bisect_right(self._values, value)
+            pos = low + bisect.bisect_left(self._keys[low:high], key)
+            self._values.insert(pos, value)
+            self._keys.insert(pos, key)
+            self._by_key[key] = value
+        elif self._by_key.get(key) == value:
+            self._mirror_remove(key)
+        
+        self._updates += 1
     
-    @defer.inlineCallbacks
-    def store(self, w=None, dw=None):
+    def _mirror_remove(self, key):
         """
-        Overrides *riak.RiakObject.store()* to automatically create
-        and update indexes.
+        Remove a data key's value from the mirror, if it has one.
+        
+        :param key: Data key name.
+        
+        :returns: None
         """
         
-        # Store the key
-        yield riak.RiakObjectOrig.store(self, w, dw)
+        if not self._by_key.has_key(key):
+            return
         
-        # Maintain the indexes if the data key belongs to an index
-        key_prefix, key_name = self._key.split("_", 1)
-        bucket = self.get_bucket().get_name()
+        value = self._by_key.pop(key)
+        low = bisect.bisect_left(self._values, value)
+        high = bisect.bisect_right(self._values, value)
+        pos = low + self._keys[low:high].index(key)
+        del self._values[pos]
+        del self._keys[pos]
+    
+    def _mirror_rows(self, compare_op, value):
+        """
+        Find the mirrored entries matching a query. The values the query
+        can match are found by bisection, then checked one by one.
         
+        :param compare_op: (string) Comparison/predicate operation, or a
+                           Predicate expression.
+        :param value: Value to compare against (unused with a Predicate).
         
-        if self._client._indexes.has_key(bucket+"="+key_prefix):
-            
-            # Maintain indexes for each indexed field
-            for field in self._client._indexes[bucket+"="+key_prefix].keys():
-                index = self._client._indexes[bucket+"="+key_prefix][field]
-                idx_bucket = index.idx_bkt_form % {"bucket": bucket,
-                                                   "field" : field,
-                                                   "key_prefix" : key_prefix}
-                idx_bucket = self._client.bucket(idx_bucket)
-            
-                # Delete the old index key if there's a previous value
-                if self._old_data:
-                    old_value = self._escval(self._old_data[field])
-                    idx_old = index.idx_key_form % {"key" : key_name,
-                                                    "field_val" : old_value}
-                    idx_old = yield idx_bucket.get(idx_old)
-                    yield riak.RiakObjectOrig.delete(idx_old)
+        :returns: List of [<data_bucket>, <data_key>, <value>] rows, or None
+                  if the mirror isn't loaded or can't evaluate the query.
+        """
+        
+        if self._values is None:
+            return None
+        
+        values = self._values
+        prefix = None
+        if isinstance(compare_op, Match) and compare_op._args[0] == "starts_with":
+            prefix = compare_op._args[1]
+        elif compare_op == "starts_with":
+            prefix = value
+        
+        if prefix is not None:
+            low, high = prefix, None
+        else:
+            low, high = _match_range(compare_op, value)
+        
+        start = 0
+        if low is not None:
+            start = bisect.bisect_left(values, low)
+        end = len(values)
+        if high is not None:
+            end = bisect.bisect_right(values, high)
+        
+        rows = []
+        for pos in xrange(start, end):
+            if prefix is not None:
+                # Values with the prefix sort together
+                if not isinstance(values[pos], basestring) or \
+                   not values[pos].startswith(prefix):
+                    break
+                matched = True
+            else:
+                matched = _match_predicate(compare_op, value, values[pos])
             
-                # Create the new index key
-                new_value = self._escval(self.get_data()[field])
-                idx_new = index.idx_key_form % {"key": key_name, 
-                                                "field_val" : new_value}
-                idx_new = idx_bucket.new(idx_new)
-                idx_new.add_link(self)
-                yield riak.RiakObjectOrig.store(idx_new, w, dw)
+            if matched is None:
+                return None
+            if matched:
+                rows.append([self._bucket, self._keys[pos], values[pos]])
         
-        defer.returnValue(self)
+        return rows
     
     @defer.inlineCallbacks
-    def delete(self, dw=None):
+    def query(self, compare_op, value=None, timeout=300000, order=None,
+              limit=None, offset=0, after=None):
         """
-        Overrides *riak.RiakObject.delete()* to automatically
-        delete indexes for deleted data keys.
+        Overrides *RiakIndex.query()* to answer from the mirror when it's
+        loaded and can evaluate the query, and from Riak otherwise.
         """
         
-        # Delete the key
-        curr_data = self.get_data()
-        yield riak.RiakObjectOrig.delete(self, dw)
+        rows = self._mirror_rows(compare_op, value)
+        if rows is None:
+            result = yield RiakIndex.query(self, compare_op, value, timeout,
+                                           order, limit, offset, after)
+            defer.returnValue(result)
         
-        # Delete the old index key if the data key belongs to an index
-        key_prefix, key_name = self._key.split("_", 1)
-        bucket = self.get_bucket().get_name()
-        if self._client._indexes.has_key(bucket+"="+key_prefix):
-            
-            for field in self._client._indexes[bucket+"="+key_prefix].keys():
-                index = self._client._indexes[bucket+"="+key_prefix][field]
-                curr_value = self._escval(curr_data[field])
-                idx_bucket = index.idx_bkt_form % {"bucket": bucket,
-                                                   "field" : field, 
-                                                   "key_prefix" : key_prefix}
-                idx_bucket = self._client.bucket(idx_bucket)
-            
-                idx_curr = index.idx_key_form % {"key": key_name,
-                                                 "field_val" : curr_value}
-                idx_curr = yield idx_bucket.get(idx_curr)
-                yield riak.RiakObjectOrig.delete(idx_curr)
+        if order is None and (limit is not None or offset or after is not None):
+            order = "asc"
+        if not order in [None, "asc", "desc"]:
+            raise errors.IndexError("Unknown sort order: %s" % order)
         
-        defer.returnValue(self)
-
-
-class RiakIndex(object):
-    """
-    Riak secondary index object.
+        if order:
+            if after is not None:
+                after = tuple(after)
+            rows = self._page_rows(rows, (order, limit, offset, after))
+        
+        defer.returnValue(rows)
     
-    Defines and queries a Riak secondary index.
-    """
+    @defer.inlineCallbacks
+    def count(self, compare_op, value=None, timeout=300000):
+        """
+        Overrides *RiakIndex.count()* to count in the mirror when it can.
+        """
+        
+        rows = self._mirror_rows(compare_op, value)
+        if rows is None:
+            result = yield RiakIndex.count(self, compare_op, value, timeout)
+            defer.returnValue(result)
+        
+        defer.returnValue(len(rows))
     
-    idx_bkt_form = "idx=%(bucket)s=%(key_prefix)s=%(field)s"
-    idx_key_form = "%(key)s/%(field_val)s"
+    @defer.inlineCallbacks
+    def exists(self, compare_op, value=None, timeout=300000):
+        """
+        Overrides *RiakIndex.exists()* to check the mirror when it can.
+        """
+        
+        rows = self._mirror_rows(compare_op, value)
+        if rows is None:
+            result = yield RiakIndex.exists(self, compare_op, value, timeout)
+            defer.returnValue(result)
+        
+        defer.returnValue(len(rows) > 0)
     
-    def __init__(self, bucket, key_prefix, indexed_field, field_type="str"):
+    @defer.inlineCallbacks
+    def query_stream(self, compare_op, value, consumer, timeout=300000):
+        """
+        Overrides *RiakIndex.query_stream()* to feed the consumer from the
+        mirror when it can.
         """
-        Define a new secondary index. Any keys stored that start with
-        *key_prefix* will be detected and an index value automatically
-        stored.
         
-        :param bucket: Bucket containing the keys to be included in the index.
-        :param key_prefix: Key prefix of keys to be included in the index.
-        :param indexed_field: Field name in JSON dictionary to be indexed.
-        :param field_type: Data type of field (int, float, bool, str, unicode)
+        rows = self._mirror_rows(compare_op, value)
+        if rows is None:
+            result = yield RiakIndex.query_stream(self, compare_op, value,
+                                                  consumer, timeout)
+            defer.returnValue(result)
         
-        :returns: None
+        for row in rows:
+            yield defer.maybeDeferred(consumer, row)
+        defer.returnValue(len(rows))
+    
+    def get_mirror_stats(self):
         """
+        Get the size and staleness of the mirror, to help decide which
+        indexes are worth mirroring.
         
-        self._bucket = bucket
-        self._prefix = key_prefix
-        self._field = indexed_field
-        self._client = None
+        :returns: Dictionary of entries, bytes (approximate memory used by
+                  the mirror), age (seconds since it was loaded from Riak,
+                  or None if it hasn't been) and updates (entry writes
+                  applied since then).
+        """
         
-        # Make sure field isn't a complex datatype
-        field_type = str(field_type).lower()
-        if not field_type in ["int", "float", "bool", "str", "unicode"]:
-            raise errors.IllegalDatatypeError(field_type)
+        if self._values is None:
+            return {"entries": 0, "bytes": 0, "age": None, "updates": 0}
         
-        self._type = field_type
+        size = sys.getsizeof(self._values) + sys.getsizeof(self._keys) + \
+               sys.getsizeof(self._by_key)
+        size += sum([sys.getsizeof(value) for value in self._values])
+        size += sum([sys.getsizeof(key) for key in self._keys])
+        
+        return {"entries": len(self._values),
+                "bytes": size,
+                "age": time.time() - self._synced_at,
+                "updates": self._updates}
+
+class MultiIndexQuery(object):
+    """
+    Query several indexes at once and combine the keys they match.
+    """
     
-    def _decode_index_key(self, key_name):
+    def __init__(self, mode="and"):
         """
-        Splits and decodes an index key into the data key
-        name and the indexed value.
+        :param mode: "and" to return keys matched by every query, or "or"
+                     to return keys matched by any of them.
         
-        :param key_name: Index key name to decode.
+        :returns: None
+        """
         
-        :returns: (<data_key_name>, <indexed_value>)
+        if not mode in ["and", "or"]:
+            raise errors.IndexError("Unknown multi-index query mode: %s" % mode)
+        
+        self._mode = mode
+        self._terms = []
+    
+    def add(self, index, compare_op, value=None):
         """
+        Add a query against one index.
         
-        key, value = key_name.split("/", 1)
-        return (key, urllib.unquote(value))
+        :param index: RiakIndex to query.
+        :param compare_op: (string) Comparison/predicate operation, or a
+                           Predicate expression.
+        :param value: (undefined) Value to compare against the indexed field
+                      (unused with a Predicate).
+        
+        :returns: self
+        """
+        
+        if not isinstance(index, RiakIndex):
+            raise errors.IndexError("Not a RiakIndex instance.")
+        
+        self._terms.append((index, compare_op, value))
+        return self
     
     @defer.inlineCallbacks
-    def query(self, compare_op, value, timeout=300000):
+    def run(self, limit=None, timeout=300000):
         """
-        Query the index to find keys where the indexed field
-        matches the spec'd value according to the spec'd
-        comparison operation (i.e. eq, less_than_eq, etc.)
-        
-        NB: Comparison operations are any of the predicate
-        functions listed on the Basho Wiki:
+        Run the index queries and combine their matches.
         
-        `Predicate Functions <http://wiki.basho.com/Key-Filters.html#Predicate-functions>`
+        The queries run concurrently. With "and", the smallest result is
+        then hashed and probed with the others, and *limit* caps the keys
+        taken from it. With "or", the results are merged.
         
-        :param compare_op: (string) Comparison/predicate operation.
-        :param value: (undefined) Value to compare against the indexed field.
-        :param timeout: (integer in secs) How long the query should be allowed to run.
+        :param limit: Maximum number of keys to return.
+        :param timeout: (integer in secs) How long each query should be allowed to run.
         
-        :returns: List of (<data_bucket>, <data_key>, <value>) tuples
+        :returns: List of (<data_bucket>, <data_key>, {<field>: <value>})
+                  tuples -- via deferred
         """
         
-        if not self._client:
-            raise errors.IndexError("The index has not been added to " \
-                                    "a RiakClient instance.")
+        if not self._terms:
+            raise errors.IndexError("No index queries have been added.")
         
-        # Build key filter
-        key_filters = [["urldecode"],
-                       ["tokenize", "/", 2]]
-        
-        if self._type == "int":
-            key_filters.append(["string_to_int"])
-        elif self._type == "float":
-            key_filters.append(["string_to_float"])
-        elif self._type == "bool":
-            key_filters.append(["string_to_int"])
-            value = int(value)
+        if self._mode == "and":
+            combined = yield self._intersect(limit, timeout)
         else:
-            value = RiakObject._escval(value)
+            combined = yield self._unite(limit, timeout)
         
-        key_filters.append([compare_op, value])
+        defer.returnValue(combined)
+    
+    @defer.inlineCallbacks
+    def _intersect(self, limit, timeout):
+        """
+        Find the keys matched by every query.
+        """
         
-        # Create key filtered MapReduce job
-        idx_bucket = self.idx_bkt_form % {"bucket": self._bucket,
-                                          "field": self._field,
-                                          "key_prefix": self._prefix}
-        job = self._client.add({"bucket" : urllib.quote(idx_bucket),
-                                "key_filters" : key_filters})
+        try:
+            results = yield defer.gatherResults([index.query(compare_op, value,
+                                                             timeout)
+                                                 for index, compare_op, value
+                                                 in self._terms],
+                                                consumeErrors=True)
+        except defer.FirstError, e:
+            e.subFailure.raiseException()
         
-        # Use the built-in Riak identity reduce
-        job.reduce(["riak_kv_mapreduce", "reduce_identity"])
+        # Hash the smallest result and probe it with the others, smallest
+        # first, counting how many results each candidate key was found in.
+        order = sorted(range(len(results)), key=lambda pos: len(results[pos]))
+        rows = results[order[0]]
+        field = self._terms[order[0]][0]._field
+        matches = {}
+        hits = {}
+        for row in rows:
+            matches[(row[0], row[1])] = {field: row[2]}
+            hits[(row[0], row[1])] = 1
         
-        # Run the query and parse the results
-        try:
-            result = yield job.run(timeout)
-        except Exception, e:
-            raise errors.IndexError(str(e))
+        for found, pos in enumerate(order[1:], 1):
+            field = self._terms[pos][0]._field
+            remaining = 0
+            for row in results[pos]:
+                match_key = (row[0], row[1])
+                if hits.get(match_key) == found:
+                    matches[match_key][field] = row[2]
+                    hits[match_key] += 1
+                    remaining += 1
+            if not remaining:
+                defer.returnValue([])
         
-        decoded_result = []
-        for match in result:
-            x, data_bucket, prefix, y = urllib.unquote(match[0]).split("=", 3)
-            data_key, value = urllib.unquote(match[1]).split("/", 1)
-            value = RiakObject._unescval(value)
-            
-            if self._type == "int":
-                value = int(value)
-            elif self._type == "float":
-                value = float(value)
-            elif self._type == "bool":
-                value = bool(value)
+        combined = []
+        for row in rows:
+            if limit is not None and len(combined) >= limit:
+                break
             
-            decoded_result.append([data_bucket, prefix+"_"+data_key, value])
+            match_key = (row[0], row[1])
+            if hits[match_key] == len(results):
+                combined.append([row[0], row[1], matches[match_key]])
+                hits[match_key] = None
+        
+        defer.returnValue(combined)
+    
+    @defer.inlineCallbacks
+    def _unite(self, limit, timeout):
+        """
+        Find the keys matched by any query.
+        """
+        
+        try:
+            results = yield defer.gatherResults([index.query(compare_op, value,
+                                                             timeout)
+                                                 for index, compare_op, value
+                                                 in self._terms],
+                                                consumeErrors=True)
+        except defer.FirstError, e:
+            e.subFailure.raiseException()
+        
+        combined = []
+        found = {}
+        for term, rows in zip(self._terms, results):
+            for row in rows:
+                match_key = (row[0], row[1])
+                if not found.has_key(match_key):
+                    if limit is not None and len(combined) >= limit:
+                        continue
+                    found[match_key] = [row[0], row[1], {}]
+                    combined.append(found[match_key])
+                found[match_key][2][term[0]._field] = row[2]
         
-        defer.returnValue(decoded_result)
+        defer.returnValue(combined)
 
-# Install RiakObject via monkey patch
-riak.RiakObject = RiakObject
\ No newline at end of file
+# Install RiakObject and RiakBucket via monkey patch
+riak.RiakObject = RiakObject
+riak.RiakBucket = RiakBucket
\ No newline at end of file
@@ -53,4 +53,12 @@ class ErrorsTestCase(unittest.TestCase):
     def test_general_index_error(self):
         "Validate IndexError."
         err = errors.IndexError("Test error.")
-        self.assertEqual("Test error.", str(err))
\ No newline at end of file
+        self.assertEqual("Test error.", str(err))
+    
+    def test_index_maintenance_error(self):
+        "Validate IndexMaintenanceError."
+        err = errors.IndexMaintenanceError({"string" : KeyError("string"),
+                                            "integer" : ValueError("bad")})
+        self.assertEqual(["integer", "string"], sorted(err.failures.keys()))
+        self.assertEqual("Index maintenance failed for field(s): " +
+                         "integer (bad); string ('string')", str(err))
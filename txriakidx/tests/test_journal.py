@@ -0,0 +1,202 @@
+#!/usr/bin/python
+####################################################################
+# FILENAME: test_journal.py
+# PROJECT: Twisted Riak w/ Indexes
+# DESCRIPTION: Tests for txRiakIdx write-behind index journal
+#
+#
+########################################################################################
+# (C)2011 DigiTar, All Rights Reserved
+# Distributed under the BSD License
+# 
+# Redistribution and use in source and binary forms, with or without modification, 
+#    are permitted provided that the following conditions are met:
+#
+#        * Redistributions of source code must retain the above copyright notice, 
+#          this list of conditions and the following disclaimer.
+#        * Redistributions in binary form must reproduce the above copyright notice, 
+#          this list of conditions and the following disclaimer in the documentation 
+#          and/or other materials provided with the distribution.
+#        * Neither the name of DigiTar nor the names of its contributors may be
+#          used to endorse or promote products derived from this software without 
+#          specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY 
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES 
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT 
+# SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, 
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED 
+# TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR 
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN 
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH 
+# DAMAGE.
+#
+########################################################################################
+
+import os, json
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from txriakidx import journal
+
+
+class IndexJournalTestCase(unittest.TestCase):
+    """
+    Test cases for IndexJournal.
+    """
+    
+    def setUp(self):
+        self.path = self.mktemp()
+        self.applied = []
+        self.fail_keys = set()
+    
+    def apply_op(self, op):
+        if op["key"] in self.fail_keys:
+            self.fail_keys.remove(op["key"])
+            return defer.fail(Exception("Riak is down."))
+        self.applied.append((op["op"], op["key"]))
+        return defer.succeed(None)
+    
+    def new_journal(self):
+        jrnl = journal.IndexJournal(self.path, self.apply_op, retry_delay=0.01)
+        self.addCleanup(jrnl.stop)
+        return jrnl
+    
+    @defer.inlineCallbacks
+    def test_append_and_apply(self):
+        "Journaled operations are applied and the journal emptied."
+        jrnl = self.new_journal()
+        self.assertEqual(0, jrnl.start())
+        jrnl.append([{"op" : "delete", "bucket" : "idx", "key" : "k1/a"},
+                     {"op" : "put", "bucket" : "idx", "key" : "k1/b"}])
+        self.assertEqual(2, jrnl.pending())
+        
+        yield jrnl.flush()
+        self.assertEqual([("delete", "k1/a"), ("put", "k1/b")], self.applied)
+        self.assertEqual(0, jrnl.pending())
+        self.assertEqual(0, os.path.getsize(self.path))
+        self.assertEqual("2", open(self.path + ".checkpoint").read())
+    
+    @defer.inlineCallbacks
+    def test_last_operation_per_entry_wins(self):
+        "Only the last operation on an entry in a batch is applied."
+        jrnl = self.new_journal()
+        jrnl.start()
+        jrnl.append([{"op" : "put", "bucket" : "idx", "key" : "k1/a"},
+                     {"op" : "delete", "bucket" : "idx", "key" : "k1/a"},
+                     {"op" : "put", "bucket" : "idx", "key" : "k1/b"}])
+        
+        yield jrnl.flush()
+        self.assertEqual([("delete", "k1/a"), ("put", "k1/b")], self.applied)
+    
+    @defer.inlineCallbacks
+    def test_retry_failed_operation(self):
+        "Failed operations are retried until they're applied."
+        jrnl = self.new_journal()
+        jrnl.start()
+        self.fail_keys.add("k1/a")
+        jrnl.append([{"op" : "put", "bucket" : "idx", "key" : "k1/a"}])
+        
+        yield jrnl.flush()
+        self.assertEqual([("put", "k1/a")], self.applied)
+        self.assertEqual(1, len(self.flushLoggedErrors(Exception)))
+    
+    @defer.inlineCallbacks
+    def test_failing_operation_given_up(self):
+        "Operations that keep failing are moved aside and logged."
+        def apply_op(op):
+            if op["key"] == "k1/a":
+                return defer.fail(Exception("Bad request."))
+            return self.apply_op(op)
+        
+        jrnl = journal.IndexJournal(self.path, apply_op, retry_delay=0.01,
+                                    max_retries=2)
+        self.addCleanup(jrnl.stop)
+        jrnl.start()
+        jrnl.append([{"op" : "put", "bucket" : "idx", "key" : "k1/a"},
+                     {"op" : "put", "bucket" : "idx", "key" : "k2/a"}])
+        jrnl.append([{"op" : "put", "bucket" : "idx", "key" : "k3/a"}])
+        
+        yield jrnl.flush()
+        self.assertEqual([("put", "k2/a"), ("put", "k3/a")], self.applied)
+        self.assertEqual(0, jrnl.pending())
+        self.assertEqual("3", open(self.path + ".checkpoint").read())
+        dead = [json.loads(line) for line in open(self.path + ".dead")]
+        self.assertEqual(["k1/a"], [op["key"] for op in dead])
+        self.assertEqual(3, len(self.flushLoggedErrors(Exception)))
+    
+    @defer.inlineCallbacks
+    def test_replay_after_restart(self):
+        "Operations not applied before a crash are replayed on start."
+        f = open(self.path, "w")
+        f.write('{"seq": 1, "op": "put", "bucket": "idx", "key": "k1/a"}\n')
+        f.write('{"seq": 2, "op": "put", "bucket": "idx", "key": "k2/a"}\n')
+        f.write('{"seq": 3, "op": "put", "bu')
+        f.close()
+        open(self.path + ".checkpoint", "w").write("1")
+        
+        jrnl = self.new_journal()
+        self.assertEqual(1, jrnl.start())
+        yield jrnl.flush()
+        self.assertEqual([("put", "k2/a")], self.applied)
+        
+        # New operations continue the sequence
+        jrnl.append([{"op" : "put", "bucket" : "idx", "key" : "k3/a"}])
+        yield jrnl.flush()
+        self.assertEqual("3", open(self.path + ".checkpoint").read())
+    
+    @defer.inlineCallbacks
+    def test_append_after_torn_write(self):
+        "Operations appended after a torn write survive the next restart."
+        f = open(self.path, "w")
+        f.write('{"seq": 1, "op": "put", "bucket": "idx", "key": "k1/a"}\n')
+        f.write('{"op": "put", "buc')
+        f.close()
+        
+        jrnl = journal.IndexJournal(self.path, lambda op: defer.Deferred())
+        self.assertEqual(1, jrnl.start())
+        jrnl.append([{"op" : "delete", "bucket" : "idx", "key" : "k2/a"}])
+        jrnl.stop()
+        
+        jrnl = self.new_journal()
+        self.assertEqual(2, jrnl.start())
+        yield jrnl.flush()
+        self.assertEqual([("put", "k1/a"), ("delete", "k2/a")], self.applied)
+    
+    @defer.inlineCallbacks
+    def test_compact_while_busy(self):
+        "Applied operations are compacted out even if the journal never empties."
+        blocked = []
+        def apply_op(op):
+            d = defer.Deferred()
+            blocked.append(d)
+            return d
+        
+        @defer.inlineCallbacks
+        def apply_batch():
+            yield task.deferLater(reactor, 0, lambda: None)
+            batch = blocked[:]
+            del blocked[:]
+            for d in batch:
+                d.callback(None)
+            yield task.deferLater(reactor, 0, lambda: None)
+        
+        jrnl = journal.IndexJournal(self.path, apply_op, batch_size=2)
+        self.addCleanup(jrnl.stop)
+        jrnl.start()
+        jrnl.append([{"op" : "put", "bucket" : "idx", "key" : "k%d/a" % i}
+                     for i in range(6)])
+        
+        yield apply_batch()
+        self.assertEqual(4, jrnl.pending())
+        self.assertEqual(6, len(open(self.path).readlines()))
+        
+        # More operations keep arriving, but the applied ones are dropped
+        jrnl.append([{"op" : "put", "bucket" : "idx", "key" : "k6/a"}])
+        yield apply_batch()
+        self.assertEqual(3, jrnl.pending())
+        keys = [json.loads(line)["key"] for line in open(self.path)]
+        self.assertEqual(["k4/a", "k5/a", "k6/a"], keys)
+        
+        jrnl.stop()
+        self.assertEqual(3, self.new_journal().start())
@@ -35,9 +35,12 @@
 #
 ########################################################################################
 
-import urllib, copy, time
+import urllib, copy, time, json
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, task, reactor
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.web.client import ResponseDone
 from txriak import riak
 from txriakidx import riakidx
 from txriakidx import errors
@@ -281,6 +284,1072 @@ class RiakIndexTestCase(RiakIdxPseudoTestCase):
         yield self.assertFailure(idx1.query("my_bizarro_opprint", "test!"),
                                  errors.IndexError)
 
+    @defer.inlineCallbacks
+    def test_delete_entry(self):
+        "Test deleting index entries without fetching them first."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="string",
+                                 field_type="str")
+        self.client.add_index(idx1)
+        
+        obj = self.bucket.new("prefix_testkey", self.sample_record)
+        yield obj.store()
+        
+        idx_bucket = self.client.bucket(idx1._entry_bucket())
+        index_key = "testkey/" + urllib.quote(self.sample_record["string"])
+        obj_idx_test = yield idx_bucket.get(index_key)
+        self.assertTrue(obj_idx_test.exists())
+        
+        op = idx1._entry_op("delete", "testkey",
+                            urllib.quote(self.sample_record["string"]))
+        yield self.client._apply_index_op(op)
+        obj_idx_test = yield idx_bucket.get(index_key)
+        self.assertFalse(obj_idx_test.exists())
+        
+        # Deleting a missing entry isn't an error
+        yield self.client._apply_index_op(op)
+        obj = yield self.bucket.get("prefix_testkey")
+        yield obj.delete()
+        obj = yield self.bucket.get("prefix_testkey")
+        self.assertFalse(obj.exists())
+    
+    @defer.inlineCallbacks
+    def test_query_cache_invalidation(self):
+        "Test cached queries are invalidated by matching local writes only."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int",
+                                 cache_size=10)
+        self.client.add_index(idx1)
+        
+        yield self.bucket.new("prefix_key1", {"integer" : 3}).store()
+        
+        result = yield idx1.query("less_than", 4)
+        self.assertEqual([[u"test_bucket", u"prefix_key1", 3]], result)
+        result[0][2] = "mutated"
+        result = yield idx1.query("less_than", 4)
+        self.assertEqual([[u"test_bucket", u"prefix_key1", 3]], result)
+        self.assertEqual(1, idx1.get_cache_stats()["hits"])
+        self.assertEqual(1, idx1.get_cache_stats()["misses"])
+        
+        # A value outside the cached predicate leaves it cached
+        yield self.bucket.new("prefix_key2", {"integer" : 10}).store()
+        result = yield idx1.query("less_than", 4)
+        self.assertEqual(2, idx1.get_cache_stats()["hits"])
+        self.assertEqual(0, idx1.get_cache_stats()["invalidations"])
+        
+        # A matching value drops it
+        yield self.bucket.new("prefix_key3", {"integer" : 2}).store()
+        result = yield idx1.query("less_than", 4)
+        self.assertEqual(sorted([[u"test_bucket", u"prefix_key1", 3],
+                                 [u"test_bucket", u"prefix_key3", 2]]),
+                         sorted(result))
+        self.assertEqual(1, idx1.get_cache_stats()["invalidations"])
+        self.assertEqual(2, idx1.get_cache_stats()["misses"])
+        
+        # So does deleting a key that matched
+        obj = yield self.bucket.get("prefix_key1")
+        yield obj.delete()
+        result = yield idx1.query("less_than", 4)
+        self.assertEqual([[u"test_bucket", u"prefix_key3", 2]], result)
+        self.assertEqual(3, idx1.get_cache_stats()["misses"])
+    
+    @defer.inlineCallbacks
+    def test_query_cache_eviction(self):
+        "Test the query cache's LRU size bound and TTL."
+        clock = [1000.0]
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="string",
+                                 field_type="str",
+                                 cache_size=2,
+                                 cache_ttl=30)
+        idx1._cache._clock = lambda: clock[0]
+        self.client.add_index(idx1)
+        self.assertEqual(None, riakidx.RiakIndex("b", "p", "f").get_cache_stats())
+        
+        yield idx1.query("eq", "a")
+        yield idx1.query("eq", "b")
+        yield idx1.query("eq", "a")
+        yield idx1.query("eq", "c")
+        stats = idx1.get_cache_stats()
+        self.assertEqual(1, stats["evictions"])
+        self.assertEqual(2, stats["size"])
+        
+        # "b" was least recently used
+        yield idx1.query("eq", "b")
+        self.assertEqual(1, idx1.get_cache_stats()["hits"])
+        self.assertEqual(4, idx1.get_cache_stats()["misses"])
+        
+        clock[0] += 30
+        yield idx1.query("eq", "b")
+        self.assertEqual(1, idx1.get_cache_stats()["expirations"])
+        self.assertEqual(5, idx1.get_cache_stats()["misses"])
+        
+        idx1.clear_cache()
+        self.assertEqual(0, idx1.get_cache_stats()["size"])
+    
+    @defer.inlineCallbacks
+    def test_query_coalesced(self):
+        "Test identical concurrent queries share one MapReduce job."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int")
+        self.client.add_index(idx1)
+        yield self.bucket.new("prefix_key1", {"integer" : 3}).store()
+        
+        jobs = []
+        run_query = idx1._run_query
+        def counting_run_query(*args):
+            jobs.append(args)
+            return run_query(*args)
+        idx1._run_query = counting_run_query
+        
+        results = yield defer.gatherResults([idx1.query("eq", 3),
+                                             idx1.query("eq", 3),
+                                             idx1.query("eq", 3),
+                                             idx1.query("eq", 4)])
+        self.assertEqual(2, len(jobs))
+        self.assertEqual([[u"test_bucket", u"prefix_key1", 3]], results[0])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+        self.assertEqual([], results[3])
+        results[0][0][2] = "mutated"
+        self.assertEqual(3, results[1][0][2])
+        self.assertEqual({}, idx1._inflight)
+        
+        # Failures reach every caller
+        d1 = idx1.query("bogus_op", 3)
+        d2 = idx1.query("bogus_op", 3)
+        yield self.assertFailure(d1, errors.IndexError)
+        yield self.assertFailure(d2, errors.IndexError)
+        self.assertEqual(3, len(jobs))
+    
+    @defer.inlineCallbacks
+    def test_query_paged(self):
+        "Test sorting and paging query results."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int")
+        self.client.add_index(idx1)
+        
+        test_keys = {"testkey" : 12,
+                     "key1" : 3,
+                     "key2" : 10,
+                     "key3" : 3,
+                     "key4" : -1}
+        for key in test_keys.keys():
+            yield self.bucket.new("prefix_" + key,
+                                  {"integer" : test_keys[key]}).store()
+        
+        result = yield idx1.query("less_than", 100, order="asc")
+        self.assertEqual([[u"test_bucket", u"prefix_key4", -1],
+                          [u"test_bucket", u"prefix_key1", 3],
+                          [u"test_bucket", u"prefix_key3", 3],
+                          [u"test_bucket", u"prefix_key2", 10],
+                          [u"test_bucket", u"prefix_testkey", 12]], result)
+        
+        result = yield idx1.query("less_than", 100, order="desc", limit=2)
+        self.assertEqual([[u"test_bucket", u"prefix_testkey", 12],
+                          [u"test_bucket", u"prefix_key2", 10]], result)
+        
+        result = yield idx1.query("less_than", 100, limit=2, offset=1)
+        self.assertEqual([[u"test_bucket", u"prefix_key1", 3],
+                          [u"test_bucket", u"prefix_key3", 3]], result)
+        
+        # Walk the pages with a cursor
+        pages = []
+        after = None
+        while True:
+            page = yield idx1.query("greater_than", 0, limit=2, after=after)
+            if not page:
+                break
+            pages.append(page)
+            after = page[-1]
+        self.assertEqual([[[u"test_bucket", u"prefix_key1", 3],
+                           [u"test_bucket", u"prefix_key3", 3]],
+                          [[u"test_bucket", u"prefix_key2", 10],
+                           [u"test_bucket", u"prefix_testkey", 12]]], pages)
+        
+        yield self.assertFailure(idx1.query("eq", 3, order="up"),
+                                 errors.IndexError)
+    
+    @defer.inlineCallbacks
+    def test_count_and_exists(self):
+        "Test counting and checking for matches without fetching keys."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int")
+        self.client.add_index(idx1)
+        
+        test_keys = {"key1" : 3,
+                     "key2" : 3,
+                     "key3" : 4,
+                     "key4" : 5}
+        for key in test_keys.keys():
+            yield self.bucket.new("prefix_" + key,
+                                  {"integer" : test_keys[key]}).store()
+        
+        count = yield idx1.count("less_than_eq", 4)
+        self.assertEqual(3, count)
+        count = yield idx1.count("greater_than", 10)
+        self.assertEqual(0, count)
+        
+        found = yield idx1.exists("eq", 5)
+        self.assertTrue(found)
+        found = yield idx1.exists("eq", 6)
+        self.assertFalse(found)
+        
+        yield self.assertFailure(idx1.count("bogus_op", 3), errors.IndexError)
+    
+    @defer.inlineCallbacks
+    def test_query_objects(self):
+        "Test querying the index for the matching data documents."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int")
+        self.client.add_index(idx1)
+        
+        test_keys = {"key1" : 3,
+                     "key2" : 3,
+                     "key3" : 4}
+        for key in test_keys.keys():
+            yield self.bucket.new("prefix_" + key,
+                                  {"integer" : test_keys[key],
+                                   "string" : key}).store()
+        
+        result = yield idx1.query_objects("eq", 3)
+        self.assertEqual(sorted([[u"test_bucket", u"prefix_key1",
+                                  {"integer" : 3, "string" : u"key1"}],
+                                 [u"test_bucket", u"prefix_key2",
+                                  {"integer" : 3, "string" : u"key2"}]]),
+                         sorted(result))
+        
+        result = yield idx1.query_objects(riakidx.Match("greater_than", 3),
+                                          fields=["string", "missing"])
+        self.assertEqual([[u"test_bucket", u"prefix_key3",
+                           {"string" : u"key3"}]], result)
+    
+    @defer.inlineCallbacks
+    def test_query_include_fields(self):
+        "Test covering indexes return included fields from their entries."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int",
+                                 include_fields=["string", "float"])
+        self.client.add_index(idx1)
+        
+        test_keys = {"key1" : 3,
+                     "key2" : 4,
+                     "key3" : 5}
+        for key in test_keys.keys():
+            yield self.bucket.new("prefix_" + key,
+                                  {"integer" : test_keys[key],
+                                   "string" : key}).store()
+        
+        idx_bucket = self.client.bucket(idx1._entry_bucket())
+        entry = yield idx_bucket.get("key1/3")
+        self.assertEqual({"string" : "key1", "float" : None}, entry.get_data())
+        
+        result = yield idx1.query("less_than", 5)
+        self.assertEqual(sorted([[u"test_bucket", u"prefix_key1", 3,
+                                  {"string" : u"key1", "float" : None}],
+                                 [u"test_bucket", u"prefix_key2", 4,
+                                  {"string" : u"key2", "float" : None}]]),
+                         sorted(result))
+        
+        result = yield idx1.query("greater_than", 0, order="desc", limit=2)
+        self.assertEqual([[u"test_bucket", u"prefix_key3", 5,
+                           {"string" : u"key3", "float" : None}],
+                          [u"test_bucket", u"prefix_key2", 4,
+                           {"string" : u"key2", "float" : None}]], result)
+        
+        # Changing only an included field rewrites the entry in place
+        obj = yield self.bucket.get("prefix_key1")
+        obj.set_data({"integer" : 3, "string" : "key1", "float" : 1.5})
+        yield obj.store()
+        self.assertEqual(["integer"], obj.get_reindexed_fields())
+        result = yield idx1.query("eq", 3)
+        self.assertEqual([[u"test_bucket", u"prefix_key1", 3,
+                           {"string" : u"key1", "float" : 1.5}]], result)
+        
+        obj.set_data({"integer" : 3, "string" : "key1", "float" : 1.5,
+                      "other" : True})
+        yield obj.store()
+        self.assertEqual([], obj.get_reindexed_fields())
+        
+        rows = []
+        yield idx1.query_stream("eq", 4, rows.append)
+        self.assertEqual([[u"test_bucket", u"prefix_key2", 4,
+                           {"string" : u"key2", "float" : None}]], rows)
+    
+    @defer.inlineCallbacks
+    def test_query_compound(self):
+        "Test compound indexes over several fields."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field=["string", "integer"],
+                                 field_type=["str", "int"])
+        self.client.add_index(idx1)
+        self.assertEqual("idx=test_bucket=prefix=string+integer",
+                         idx1._entry_bucket())
+        self.assertRaises(errors.IndexError, riakidx.RiakIndex,
+                          "b", "p", ["a", "b"], ["str"])
+        
+        test_keys = {"key1" : ("bob/x", 3),
+                     "key2" : ("bob/x", 30),
+                     "key3" : ("amy", 4),
+                     "key4" : ("bob/x", 5)}
+        for key in test_keys.keys():
+            yield self.bucket.new("prefix_" + key,
+                                  {"string" : test_keys[key][0],
+                                   "integer" : test_keys[key][1]}).store()
+        
+        idx_bucket = self.client.bucket(idx1._entry_bucket())
+        entry = yield idx_bucket.get("key1/bob%2Fx/3")
+        self.assertTrue(entry.exists())
+        
+        # Equality on the leading field, range on the next
+        result = yield idx1.query("less_than", ("bob/x", 10))
+        self.assertEqual(sorted([[u"test_bucket", u"prefix_key1", (u"bob/x", 3)],
+                                 [u"test_bucket", u"prefix_key4", (u"bob/x", 5)]]),
+                         sorted(result))
+        
+        result = yield idx1.query("eq", "amy")
+        self.assertEqual([[u"test_bucket", u"prefix_key3", (u"amy", 4)]], result)
+        
+        result = yield idx1.query(riakidx.Between(("bob/x", 4), ("bob/x", 40)),
+                                  order="desc")
+        self.assertEqual([[u"test_bucket", u"prefix_key2", (u"bob/x", 30)],
+                          [u"test_bucket", u"prefix_key4", (u"bob/x", 5)]], result)
+        
+        result = yield idx1.query("greater_than", ("a",), limit=2)
+        self.assertEqual([[u"test_bucket", u"prefix_key3", (u"amy", 4)],
+                          [u"test_bucket", u"prefix_key1", (u"bob/x", 3)]], result)
+        result = yield idx1.query("greater_than", ("a",), limit=2,
+                                  after=result[-1])
+        self.assertEqual([[u"test_bucket", u"prefix_key4", (u"bob/x", 5)],
+                          [u"test_bucket", u"prefix_key2", (u"bob/x", 30)]], result)
+        
+        # Changing either field moves the entry
+        obj = yield self.bucket.get("prefix_key1")
+        obj.set_data({"string" : "amy", "integer" : 3})
+        yield obj.store()
+        count = yield idx1.count("eq", "amy")
+        self.assertEqual(2, count)
+        
+        yield self.assertFailure(idx1.query("eq", ("a", 1, 2)),
+                                 errors.IndexError)
+        yield self.assertFailure(idx1.query(riakidx.Between(("a", 1), ("b", 2))),
+                                 errors.IndexError)
+    
+    def test_sortable_encoding(self):
+        "Test sortable int and float encodings keep numeric order."
+        ints = [-10**19, -5, -1, 0, 1, 5, 10**19]
+        encoded = [riakidx._encode_sortable_int(i) for i in ints]
+        self.assertEqual(sorted(encoded), encoded)
+        self.assertEqual(ints, [riakidx._decode_sortable_int(e) for e in encoded])
+        self.assertRaises(ValueError, riakidx._encode_sortable_int, 10**20)
+        self.assertRaises(ValueError, riakidx._encode_sortable_int, 1.5)
+        
+        floats = [-1e300, -3.5, -1e-300, 0.0, 1e-300, 2.5, 4.1, 1e300]
+        encoded = [riakidx._encode_sortable_float(f) for f in floats]
+        self.assertEqual(sorted(encoded), encoded)
+        self.assertEqual(floats, [riakidx._decode_sortable_float(e) for e in encoded])
+    
+    @defer.inlineCallbacks
+    def test_query_sortable(self):
+        "Test querying indexes stored with the sortable encoding."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int",
+                                 sortable=True)
+        idx2 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="float",
+                                 field_type="float",
+                                 sortable=True)
+        self.client.add_index(idx1)
+        self.client.add_index(idx2)
+        self.assertEqual("idxv2=test_bucket=prefix=integer", idx1._entry_bucket())
+        
+        test_keys = {"key1" : (-20, -2.5),
+                     "key2" : (3, 0.5),
+                     "key3" : (10, 11.0),
+                     "key4" : (200, 1e10)}
+        for key in test_keys.keys():
+            yield self.bucket.new("prefix_" + key,
+                                  {"integer" : test_keys[key][0],
+                                   "float" : test_keys[key][1]}).store()
+        
+        idx_bucket = self.client.bucket(idx1._entry_bucket())
+        entry = yield idx_bucket.get("key2/p00000000000000000003")
+        self.assertTrue(entry.exists())
+        
+        # No string_to_int step; values compare as strings
+        self.assertEqual([["urldecode"], ["tokenize", "/", 2],
+                          ["less_than", "p00000000000000000010"]],
+                         idx1._query_inputs(*idx1._bind_query("less_than", 10))["key_filters"])
+        
+        result = yield idx1.query("less_than", 10)
+        self.assertEqual(sorted([[u"test_bucket", u"prefix_key1", -20],
+                                 [u"test_bucket", u"prefix_key2", 3]]),
+                         sorted(result))
+        
+        result = yield idx2.query(riakidx.Between(0.0, 100.0))
+        self.assertEqual(sorted([[u"test_bucket", u"prefix_key2", 0.5],
+                                 [u"test_bucket", u"prefix_key3", 11.0]]),
+                         sorted(result))
+        
+        result = yield idx1.query("greater_than", -100, order="desc", limit=2)
+        self.assertEqual([[u"test_bucket", u"prefix_key4", 200],
+                          [u"test_bucket", u"prefix_key3", 10]], result)
+        result = yield idx1.query("greater_than", -100, order="desc", limit=2,
+                                  after=result[-1])
+        self.assertEqual([[u"test_bucket", u"prefix_key2", 3],
+                          [u"test_bucket", u"prefix_key1", -20]], result)
+    
+    @defer.inlineCallbacks
+    def test_query_native(self):
+        "Test querying indexes kept in Riak's native secondary indexes."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int",
+                                 backend="native")
+        idx2 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="string",
+                                 field_type="str",
+                                 backend="native")
+        self.client.add_index(idx1)
+        self.client.add_index(idx2)
+        self.assertEqual("X-Riak-Index-integer_int",
+                         self.client._index_plans[("test_bucket", "prefix")][0].header)
+        self.assertFalse(self.client._entry_indexes.has_key(idx1._entry_bucket()))
+        
+        test_keys = {"key1" : (-20, "apple"),
+                     "key2" : (3, "b,c"),
+                     "key3" : (10, "cherry"),
+                     "key4" : (200, "cherry")}
+        for key in test_keys.keys():
+            obj = yield self.bucket.new("prefix_" + key,
+                                        {"integer" : test_keys[key][0],
+                                         "string" : test_keys[key][1]}).store()
+            self.assertEqual(["integer", "string"],
+                             sorted(obj.get_reindexed_fields()))
+        
+        # No entry keys are written
+        idx_bucket = self.client.bucket(idx1._entry_bucket())
+        entry = yield idx_bucket.get("key2/3")
+        self.assertFalse(entry.exists())
+        
+        result = yield idx2.query("eq", "cherry")
+        self.assertEqual(sorted([[u"test_bucket", u"prefix_key3", "cherry"],
+                                 [u"test_bucket", u"prefix_key4", "cherry"]]),
+                         sorted(result))
+        
+        result = yield idx1.query("less_than", 10)
+        self.assertEqual(sorted([[u"test_bucket", u"prefix_key1", -20],
+                                 [u"test_bucket", u"prefix_key2", 3]]),
+                         sorted(result))
+        
+        result = yield idx2.query("greater_than", "b,c")
+        self.assertEqual(2, len(result))
+        result = yield idx2.query(riakidx.Between("b", "c"))
+        self.assertEqual([[u"test_bucket", u"prefix_key2", "b,c"]], result)
+        
+        result = yield idx1.query("greater_than", -100, order="desc", limit=2)
+        self.assertEqual([[u"test_bucket", u"prefix_key4", 200],
+                          [u"test_bucket", u"prefix_key3", 10]], result)
+        result = yield idx1.query("greater_than", -100, order="desc", limit=2,
+                                  after=result[-1])
+        self.assertEqual([[u"test_bucket", u"prefix_key2", 3],
+                          [u"test_bucket", u"prefix_key1", -20]], result)
+        
+        count = yield idx1.count("greater_than_eq", 3)
+        self.assertEqual(3, count)
+        found = yield idx2.exists("eq", "durian")
+        self.assertFalse(found)
+        
+        result = yield idx1.query_objects("eq", 3, fields=["string"])
+        self.assertEqual([[u"test_bucket", u"prefix_key2", {u"string" : u"b,c"}]],
+                         result)
+        
+        # The index values move with the key
+        obj = yield self.bucket.get("prefix_key3")
+        obj.set_data({"integer" : 11, "string" : "cherry"})
+        yield obj.store()
+        self.assertEqual(["integer"], obj.get_reindexed_fields())
+        result = yield idx1.query("eq", 10)
+        self.assertEqual([], result)
+        
+        yield self.assertFailure(idx2.query("less_than", "b"), errors.IndexError)
+        yield self.assertFailure(idx2.query("starts_with", "b"), errors.IndexError)
+        
+        # Native indexes can't be compound
+        self.assertRaises(errors.IndexError, self.client.add_index,
+                          riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                            key_prefix="prefix",
+                                            indexed_field=["integer", "string"],
+                                            field_type=["int", "str"],
+                                            backend="native"))
+    
+    @defer.inlineCallbacks
+    def test_query_sharded(self):
+        "Test spreading index entries over shards and querying them all."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int",
+                                 shards=3)
+        self.client.add_index(idx1)
+        self.assertEqual(["idx=test_bucket=prefix=integer=shard0",
+                          "idx=test_bucket=prefix=integer=shard1",
+                          "idx=test_bucket=prefix=integer=shard2"],
+                         idx1._shard_buckets())
+        for idx_bucket in idx1._shard_buckets():
+            self.assertTrue(self.client._entry_indexes[idx_bucket] is idx1)
+        
+        test_keys = {"key1" : 5, "key2" : 1, "key3" : 4, "key4" : 2}
+        shards = set()
+        for key in test_keys.keys():
+            yield self.bucket.new("prefix_" + key,
+                                  {"integer" : test_keys[key]}).store()
+            shard = idx1._shard_of(key)
+            shards.add(shard)
+            entry = yield self.client.bucket(idx1._shard_buckets()[shard]).get(key + "/" + str(test_keys[key]))
+            self.assertTrue(entry.exists())
+        self.assertTrue(len(shards) > 1)
+        
+        result = yield idx1.query("greater_than", 1)
+        self.assertEqual(sorted([[u"test_bucket", u"prefix_key1", 5],
+                                 [u"test_bucket", u"prefix_key3", 4],
+                                 [u"test_bucket", u"prefix_key4", 2]]),
+                         sorted(result))
+        
+        # Pages are merged across shards
+        result = yield idx1.query("greater_than", 0, limit=2)
+        self.assertEqual([[u"test_bucket", u"prefix_key2", 1],
+                          [u"test_bucket", u"prefix_key4", 2]], result)
+        result = yield idx1.query("greater_than", 0, limit=2, after=result[-1])
+        self.assertEqual([[u"test_bucket", u"prefix_key3", 4],
+                          [u"test_bucket", u"prefix_key1", 5]], result)
+        result = yield idx1.query("greater_than", 0, order="desc", offset=1, limit=2)
+        self.assertEqual([[u"test_bucket", u"prefix_key3", 4],
+                          [u"test_bucket", u"prefix_key4", 2]], result)
+        
+        count = yield idx1.count("less_than", 5)
+        self.assertEqual(3, count)
+        found = yield idx1.exists("eq", 4)
+        self.assertTrue(found)
+        found = yield idx1.exists("eq", 3)
+        self.assertFalse(found)
+        
+        rows = []
+        count = yield idx1.query_stream("greater_than_eq", 0, rows.append)
+        self.assertEqual(4, count)
+        self.assertEqual(sorted(["prefix_key1", "prefix_key2",
+                                 "prefix_key3", "prefix_key4"]),
+                         sorted([row[1] for row in rows]))
+        
+        result = yield idx1.query_objects("eq", 2)
+        self.assertEqual([[u"test_bucket", u"prefix_key4", {u"integer" : 2}]],
+                         result)
+        
+        self.assertRaises(errors.IndexError, riakidx.RiakIndex,
+                          self.bucket.get_name(), "prefix", "integer", "int",
+                          shards=0)
+    
+    @defer.inlineCallbacks
+    def test_query_partitioned(self):
+        "Test range partitioned indexes prune, query and drop partitions."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int",
+                                 partition_width=100)
+        idx2 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="float",
+                                 field_type="float",
+                                 partition_bounds=[0.0, 10.0],
+                                 sortable=True)
+        self.client.add_index(idx1)
+        self.client.add_index(idx2)
+        
+        test_keys = {"key1" : (-20, -2.5),
+                     "key2" : (30, 0.5),
+                     "key3" : (150, 11.0),
+                     "key4" : (420, 12.5)}
+        for key in test_keys.keys():
+            yield self.bucket.new("prefix_" + key,
+                                  {"integer" : test_keys[key][0],
+                                   "float" : test_keys[key][1]}).store()
+        
+        entry = yield self.client.bucket("idx=test_bucket=prefix=integer=part1").get("key3/150")
+        self.assertTrue(entry.exists())
+        entry = yield self.client.bucket("idxv2=test_bucket=prefix=float=part2").get("key4/" + riakidx._encode_sortable_float(12.5))
+        self.assertTrue(entry.exists())
+        
+        partitions = yield idx1.get_partitions()
+        self.assertEqual([(-1, -100, 0), (0, 0, 100), (1, 100, 200), (4, 400, 500)],
+                         partitions)
+        partitions = yield idx2.get_partitions()
+        self.assertEqual([(0, None, 0.0), (1, 0.0, 10.0), (2, 10.0, None)],
+                         partitions)
+        
+        # Only the partitions that can match are searched
+        buckets = yield idx1._query_buckets(*idx1._bind_query("less_than", 100))
+        self.assertEqual(["idx=test_bucket=prefix=integer=part-1",
+                          "idx=test_bucket=prefix=integer=part0",
+                          "idx=test_bucket=prefix=integer=part1"], buckets)
+        buckets = yield idx1._query_buckets(*idx1._bind_query(riakidx.Match("greater_than", 120) &
+                                                              riakidx.Match("less_than", 300),
+                                                              None))
+        self.assertEqual(["idx=test_bucket=prefix=integer=part1"], buckets)
+        buckets = yield idx2._query_buckets(*idx2._bind_query("eq", 5.0))
+        self.assertEqual(["idxv2=test_bucket=prefix=float=part1"], buckets)
+        
+        result = yield idx1.query("less_than", 100)
+        self.assertEqual(sorted([[u"test_bucket", u"prefix_key1", -20],
+                                 [u"test_bucket", u"prefix_key2", 30]]),
+                         sorted(result))
+        result = yield idx2.query("greater_than", 0.0, order="desc", limit=2)
+        self.assertEqual([[u"test_bucket", u"prefix_key4", 12.5],
+                          [u"test_bucket", u"prefix_key3", 11.0]], result)
+        count = yield idx1.count("greater_than", 0)
+        self.assertEqual(3, count)
+        
+        # Moving a value moves its entry to the matching partition
+        obj = yield self.bucket.get("prefix_key2")
+        obj.set_data({"integer" : 130, "float" : 0.5})
+        yield obj.store()
+        result = yield idx1.query(riakidx.Between(100, 199))
+        self.assertEqual(sorted([[u"test_bucket", u"prefix_key2", 130],
+                                 [u"test_bucket", u"prefix_key3", 150]]),
+                         sorted(result))
+        
+        deleted = yield idx1.drop_partition(1)
+        self.assertEqual(2, deleted)
+        partitions = yield idx1.get_partitions()
+        self.assertEqual([-1, 0, 4], [partition[0] for partition in partitions])
+        result = yield idx1.query("greater_than", 0)
+        self.assertEqual([[u"test_bucket", u"prefix_key4", 420]], result)
+        
+        # The data keys are left alone
+        obj = yield self.bucket.get("prefix_key3")
+        self.assertTrue(obj.exists())
+        
+        # The registry is cached, so partitions other clients register
+        # only show up once it's listed again
+        client2 = riakidx.RiakClient()
+        idx3 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int",
+                                 partition_width=100)
+        client2.add_index(idx3)
+        yield client2.bucket(self.bucket.get_name()).new("prefix_testkey",
+                                                         {"integer" : 750,
+                                                          "float" : 1.0}).store()
+        partitions = yield idx1.get_partitions()
+        self.assertEqual([-1, 0, 4], [partition[0] for partition in partitions])
+        partitions = yield idx1.get_partitions(refresh=True)
+        self.assertEqual([-1, 0, 4, 7], [partition[0] for partition in partitions])
+        
+        # Partitions this client writes to are added to the cached registry
+        obj = yield self.bucket.get("prefix_testkey")
+        obj.set_data({"integer" : 950, "float" : 1.0})
+        yield obj.store()
+        partitions = yield idx1.get_partitions()
+        self.assertEqual([-1, 0, 4, 7, 9], [partition[0] for partition in partitions])
+        
+        # Writing to a partition another client dropped registers it again
+        # once the client's own registration has expired
+        yield idx3.drop_partition(9)
+        self.client.index_marker_ttl = 0
+        obj.set_data({"integer" : 960, "float" : 1.0})
+        yield obj.store()
+        partitions = yield idx1.get_partitions(refresh=True)
+        self.assertEqual([-1, 0, 4, 7, 9], [partition[0] for partition in partitions])
+        
+        self.assertRaises(errors.IndexError, riakidx.RiakIndex,
+                          self.bucket.get_name(), "prefix", "string", "str",
+                          partition_width=10)
+        self.assertRaises(errors.IndexError, riakidx.RiakIndex,
+                          self.bucket.get_name(), "prefix", "integer", "int",
+                          partition_bounds=[10, 5])
+    
+    @defer.inlineCallbacks
+    def test_mirrored_index(self):
+        "Test answering queries from an in-memory mirror of the index."
+        idx1 = riakidx.MirroredIndex(bucket=self.bucket.get_name(),
+                                     key_prefix="prefix",
+                                     indexed_field="integer",
+                                     field_type="int")
+        idx2 = riakidx.MirroredIndex(bucket=self.bucket.get_name(),
+                                     key_prefix="prefix",
+                                     indexed_field="string",
+                                     field_type="str")
+        self.client.add_index(idx1)
+        self.client.add_index(idx2)
+        
+        test_keys = {"key1" : (5, "apple"),
+                     "key2" : (1, "apricot"),
+                     "key3" : (5, "banana")}
+        for key in test_keys.keys():
+            yield self.bucket.new("prefix_" + key,
+                                  {"integer" : test_keys[key][0],
+                                   "string" : test_keys[key][1]}).store()
+        
+        self.assertEqual(None, idx1.get_mirror_stats()["age"])
+        count = yield idx1.start()
+        self.assertEqual(3, count)
+        yield idx2.start()
+        
+        result = yield idx1.query("greater_than_eq", 5)
+        self.assertEqual([[u"test_bucket", u"prefix_key1", 5],
+                          [u"test_bucket", u"prefix_key3", 5]], result)
+        result = yield idx1.query(riakidx.Between(0, 4) | riakidx.Match("eq", 5),
+                                  order="desc", limit=2)
+        self.assertEqual([[u"test_bucket", u"prefix_key3", 5],
+                          [u"test_bucket", u"prefix_key1", 5]], result)
+        result = yield idx2.query("starts_with", "ap")
+        self.assertEqual([[u"test_bucket", u"prefix_key1", u"apple"],
+                          [u"test_bucket", u"prefix_key2", u"apricot"]], result)
+        count = yield idx1.count("neq", 5)
+        self.assertEqual(1, count)
+        
+        # Local writes update the mirror straight away
+        obj = yield self.bucket.get("prefix_key1")
+        obj.set_data({"integer" : 7, "string" : "apple"})
+        yield obj.store()
+        result = yield idx1.query("eq", 5)
+        self.assertEqual([[u"test_bucket", u"prefix_key3", 5]], result)
+        yield obj.delete()
+        found = yield idx1.exists("eq", 7)
+        self.assertFalse(found)
+        
+        # Other writers are picked up by the next resync
+        other = riakidx.RiakClient()
+        entry = yield other.bucket(idx1._entry_bucket()).new("key4/9", None).store()
+        result = yield idx1.query("eq", 9)
+        self.assertEqual([], result)
+        count = yield idx1.resync()
+        self.assertEqual(3, count)
+        result = yield idx1.query("eq", 9)
+        self.assertEqual([[u"test_bucket", u"prefix_key4", 9]], result)
+        yield entry.delete()
+        
+        stats = idx1.get_mirror_stats()
+        self.assertEqual(3, stats["entries"])
+        self.assertEqual(0, stats["updates"])
+        self.assertTrue(stats["bytes"] > 0)
+        self.assertTrue(stats["age"] >= 0)
+        
+        idx1.stop()
+        idx2.stop()
+        self.assertRaises(errors.IndexError, riakidx.MirroredIndex,
+                          self.bucket.get_name(), "prefix", "integer", "int",
+                          backend="native")
+    
+    @defer.inlineCallbacks
+    def test_mirrored_index_snapshot(self):
+        "Test starting a mirrored index from a snapshot file."
+        path = self.mktemp()
+        idx1 = riakidx.MirroredIndex(bucket=self.bucket.get_name(),
+                                     key_prefix="prefix",
+                                     indexed_field="integer",
+                                     field_type="int",
+                                     snapshot_path=path)
+        self.client.add_index(idx1)
+        
+        test_keys = {"key1" : 5, "key2" : -1, "key3" : 12}
+        for key in test_keys.keys():
+            yield self.bucket.new("prefix_" + key,
+                                  {"integer" : test_keys[key]}).store()
+        count = yield idx1.start()
+        self.assertEqual(3, count)
+        count = yield idx1.stop()
+        self.assertEqual(3, count)
+        
+        # Changes while the index is stopped
+        yield self.bucket.new("prefix_key4", {"integer" : 7}).store()
+        obj = yield self.bucket.get("prefix_key1")
+        yield obj.delete()
+        
+        # A restart answers from the snapshot straight away, and picks up
+        # the changes from the reload started in the background
+        client2 = riakidx.RiakClient()
+        idx2 = riakidx.MirroredIndex(bucket=self.bucket.get_name(),
+                                     key_prefix="prefix",
+                                     indexed_field="integer",
+                                     field_type="int",
+                                     snapshot_path=path)
+        client2.add_index(idx2)
+        count = yield idx2.start()
+        self.assertEqual(3, count)
+        result = yield idx2.query("greater_than", 0)
+        self.assertEqual([[u"test_bucket", u"prefix_key1", 5],
+                          [u"test_bucket", u"prefix_key3", 12]], result)
+        count = yield idx2.resync()
+        self.assertEqual(3, count)
+        result = yield idx2.query("greater_than", 0)
+        self.assertEqual([[u"test_bucket", u"prefix_key4", 7],
+                          [u"test_bucket", u"prefix_key3", 12]], result)
+        yield idx2.stop()
+        
+        idx3 = riakidx.MirroredIndex(bucket=self.bucket.get_name(),
+                                     key_prefix="prefix",
+                                     indexed_field="integer",
+                                     field_type="int",
+                                     snapshot_path=path)
+        self.assertTrue(idx3.load_snapshot())
+        self.assertEqual(idx2._values, idx3._values)
+        self.assertEqual(idx2._keys, idx3._keys)
+        
+        # Snapshots of other indexes and damaged snapshots are ignored
+        idx4 = riakidx.MirroredIndex(bucket=self.bucket.get_name(),
+                                     key_prefix="prefix",
+                                     indexed_field="float",
+                                     field_type="float")
+        self.assertFalse(idx4.load_snapshot(path))
+        data = open(path, "rb").read()
+        open(path, "wb").write(data[:-3])
+        self.assertFalse(idx3.load_snapshot())
+    
+    def test_predicate_key_filters(self):
+        "Test compiling predicate expressions into key filters."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int")
+        chain = [["urldecode"], ["tokenize", "/", 2], ["string_to_int"]]
+        
+        pred = riakidx.Match("greater_than_eq", 100) & \
+               riakidx.Match("less_than", 500)
+        self.assertEqual([["and",
+                           chain + [["greater_than_eq", 100]],
+                           chain + [["less_than", 500]]]],
+                         idx1._query_inputs(pred, None)["key_filters"])
+        
+        pred = riakidx.Or(riakidx.Match("eq", 1), riakidx.Match("eq", 2),
+                          ~riakidx.Between(3, 9, inclusive=False))
+        self.assertEqual([["or",
+                           chain + [["eq", 1]],
+                           [["or",
+                             chain + [["eq", 2]],
+                             [["not", chain + [["between", 3, 9, False]]]]]]]],
+                         idx1._query_inputs(pred, None)["key_filters"])
+        
+        # Values are converted for the index's datatype
+        idx2 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="string",
+                                 field_type="str")
+        pred, value = idx2._bind_query(riakidx.Match("eq", "a/b") |
+                                       riakidx.Match("eq", "c"), None)
+        self.assertEqual(riakidx.Or(riakidx.Match("eq", "a%2Fb"),
+                                    riakidx.Match("eq", "c")), pred)
+        self.assertTrue(pred._matches("c"))
+        self.assertFalse(pred._matches("d"))
+        self.assertEqual(None, riakidx.Match("similar_to", "x")._matches("y"))
+    
+    @defer.inlineCallbacks
+    def test_query_predicate(self):
+        "Test querying the index with a predicate expression."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int",
+                                 cache_size=10)
+        self.client.add_index(idx1)
+        
+        test_keys = {"key1" : 100,
+                     "key2" : 250,
+                     "key3" : 499,
+                     "key4" : 500}
+        for key in test_keys.keys():
+            yield self.bucket.new("prefix_" + key,
+                                  {"integer" : test_keys[key]}).store()
+        
+        pred = riakidx.Match("greater_than_eq", 100) & \
+               riakidx.Match("less_than", 500) & \
+               ~riakidx.Match("eq", 250)
+        result = yield idx1.query(pred)
+        self.assertEqual(sorted([[u"test_bucket", u"prefix_key1", 100],
+                                 [u"test_bucket", u"prefix_key3", 499]]),
+                         sorted(result))
+        
+        count = yield idx1.count(riakidx.Between(250, 500))
+        self.assertEqual(3, count)
+        
+        # Writes outside the predicate leave the cached result alone
+        yield self.bucket.new("prefix_testkey", {"integer" : 250}).store()
+        result = yield idx1.query(pred)
+        self.assertEqual(1, idx1.get_cache_stats()["hits"])
+        obj = yield self.bucket.get("prefix_testkey")
+        obj.set_data({"integer" : 300})
+        yield obj.store()
+        result = yield idx1.query(pred)
+        self.assertEqual(1, idx1.get_cache_stats()["hits"])
+        self.assertEqual(3, len(result))
+    
+    def test_multipart_parser(self):
+        "Test parsing multipart bodies split at arbitrary points."
+        stream = "--abc\r\nContent-Type: application/json\r\n\r\n" \
+                 "{\"data\": [1]}\r\n--abc\r\n" \
+                 "Content-Type: application/json\r\n\r\n" \
+                 "{\"data\": [2, 3]}\r\n--abc--\r\n"
+        for size in [1, 3, 7, len(stream)]:
+            parser = riakidx._MultipartParser("abc")
+            bodies = []
+            for i in range(0, len(stream), size):
+                bodies.extend(parser.feed(stream[i:i+size]))
+            self.assertEqual(['{"data": [1]}', '{"data": [2, 3]}'], bodies)
+    
+    def test_query_stream_receiver_fired_deferreds(self):
+        "Test feeding a large part to a consumer returning fired Deferreds."
+        rows = []
+        def consumer(row):
+            rows.append(row)
+            return defer.succeed(None)
+        
+        finished = defer.Deferred()
+        receiver = riakidx._QueryStreamReceiver("abc", lambda row: row,
+                                                consumer, finished)
+        receiver.makeConnection(proto_helpers.StringTransport())
+        receiver.dataReceived("--abc\r\nContent-Type: application/json\r\n\r\n" +
+                              json.dumps({"data" : range(5000)}) +
+                              "\r\n--abc--\r\n")
+        receiver.connectionLost(failure.Failure(ResponseDone()))
+        
+        self.assertEqual(range(5000), rows)
+        self.assertEqual(5000, self.successResultOf(finished))
+        self.assertEqual("producing", receiver.transport.producerState)
+    
+    @defer.inlineCallbacks
+    def test_query_stream(self):
+        "Test streaming query matches to a consumer."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int")
+        self.client.add_index(idx1)
+        
+        test_keys = {"key1" : 3,
+                     "key2" : 3,
+                     "key3" : 3,
+                     "key4" : 4}
+        for key in test_keys.keys():
+            yield self.bucket.new("prefix_" + key,
+                                  {"integer" : test_keys[key]}).store()
+        
+        # A consumer returning Deferreds is fed one row at a time
+        rows = []
+        busy = []
+        def consumer(row):
+            self.assertEqual([], busy)
+            busy.append(row)
+            def done():
+                busy.remove(row)
+                rows.append(row)
+            return task.deferLater(reactor, 0.01, done)
+        
+        count = yield idx1.query_stream("eq", 3, consumer)
+        self.assertEqual(3, count)
+        self.assertEqual(sorted([[u"test_bucket", u"prefix_key1", 3],
+                                 [u"test_bucket", u"prefix_key2", 3],
+                                 [u"test_bucket", u"prefix_key3", 3]]),
+                         sorted(rows))
+        
+        rows = []
+        count = yield idx1.query_stream("greater_than", 5, rows.append)
+        self.assertEqual(0, count)
+        
+        # Consumer errors stop the stream
+        def bad_consumer(row):
+            raise ValueError("bad row")
+        d = idx1.query_stream("eq", 3, bad_consumer)
+        yield self.assertFailure(d, ValueError)
+        
+        d = idx1.query_stream("bogus_op", 3, rows.append)
+        yield self.assertFailure(d, errors.IndexError)
+    
+    @defer.inlineCallbacks
+    def test_multi_index_query(self):
+        "Test intersecting and uniting queries on different indexes."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="string",
+                                 field_type="str")
+        idx2 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int")
+        self.client.add_index(idx1)
+        self.client.add_index(idx2)
+        
+        test_keys = {"key1" : ("bob", 3),
+                     "key2" : ("bob", 30),
+                     "key3" : ("amy", 4),
+                     "key4" : ("bob", 5)}
+        for key in test_keys.keys():
+            yield self.bucket.new("prefix_" + key,
+                                  {"string" : test_keys[key][0],
+                                   "integer" : test_keys[key][1]}).store()
+        
+        query = riakidx.MultiIndexQuery("and")
+        query.add(idx1, "eq", "bob").add(idx2, "less_than", 10)
+        result = yield query.run()
+        self.assertEqual(sorted([[u"test_bucket", u"prefix_key1",
+                                  {"string" : u"bob", "integer" : 3}],
+                                 [u"test_bucket", u"prefix_key4",
+                                  {"string" : u"bob", "integer" : 5}]]),
+                         sorted(result))
+        
+        result = yield query.run(limit=1)
+        self.assertEqual(1, len(result))
+        
+        # One job per query whatever order they were added in, with no
+        # extra count jobs
+        def count(*args, **kwargs):
+            self.fail("count() shouldn't be called.")
+        idx1.count = idx2.count = count
+        query = riakidx.MultiIndexQuery("and")
+        query.add(idx2, "less_than", 100).add(idx1, "eq", "amy")
+        result = yield query.run()
+        self.assertEqual([[u"test_bucket", u"prefix_key3",
+                           {"string" : u"amy", "integer" : 4}]], result)
+        query = riakidx.MultiIndexQuery("and")
+        query.add(idx2, "less_than", 100).add(idx1, "eq", "nobody")
+        result = yield query.run()
+        self.assertEqual([], result)
+        del idx1.count, idx2.count
+        
+        query = riakidx.MultiIndexQuery("or")
+        query.add(idx1, "eq", "amy").add(idx2, riakidx.Match("greater_than", 10))
+        result = yield query.run()
+        self.assertEqual(sorted([[u"test_bucket", u"prefix_key2",
+                                  {"integer" : 30}],
+                                 [u"test_bucket", u"prefix_key3",
+                                  {"string" : u"amy"}]]),
+                         sorted(result))
+        
+        query = riakidx.MultiIndexQuery("and")
+        query.add(idx1, "eq", "bob").add(idx2, "bogus_op", 10)
+        yield self.assertFailure(query.run(), errors.IndexError)
+        self.assertRaises(errors.IndexError, riakidx.MultiIndexQuery, "xor")
+
 class RiakClientTestCase(RiakIdxPseudoTestCase):
     """
     Tests cases for RiakClient
@@ -303,12 +1372,139 @@ class RiakClientTestCase(RiakIdxPseudoTestCase):
         self.assertEqual(idx._client, self.client)
         self.assertEqual(idx, self.client._indexes[bucket+"=testpref"]["field_1"])
     
+    def test_add_index_compiles_plan(self):
+        "Adding indexes compiles the per-store dispatch plan."
+        bucket = self.bucket.get_name()
+        idx1 = riakidx.RiakIndex(bucket=bucket,
+                                 key_prefix="testpref",
+                                 indexed_field="field_2",
+                                 field_type="int")
+        idx2 = riakidx.RiakIndex(bucket=bucket,
+                                 key_prefix="testpref",
+                                 indexed_field="field_1",
+                                 field_type="str")
+        self.client.add_index(idx1)
+        self.client.add_index(idx2)
+        
+        plans = self.client._index_plans[(bucket, "testpref")]
+        self.assertEqual(["field_1", "field_2"], [plan.field for plan in plans])
+        self.assertEqual([idx2, idx1], [plan.index for plan in plans])
+        self.assertEqual("idx=test_bucket=testpref=field_1", plans[0].idx_bucket)
+        self.assertEqual("/riak/idx%3Dtest_bucket%3Dtestpref%3Dfield_1/",
+                         plans[0].path_prefix)
+        self.assertEqual("int", plans[1].type)
+        
+        obj = self.bucket.new("testpref_key1", {"field_1" : "a/b",
+                                                "field_2" : 5})
+        self.assertEqual(("key1", plans), obj._get_plans())
+        self.assertEqual({"field_1" : "a%2Fb", "field_2" : "5"},
+                         obj._index_values(obj.get_data()))
+    
     def test_add_index_failed(self):
         "Add an invalid index to the client...fails."
         idx = "this ain't an index"
         self.assertRaises(errors.IndexError, self.client.add_index, idx)
     
 
+    @defer.inlineCallbacks
+    def test_store_many(self):
+        "Store many keys with indexes in one batch."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int")
+        self.client.add_index(idx1)
+        
+        items = [("prefix_key%d" % i, {"integer" : i}) for i in range(1, 5)]
+        results = yield self.client.store_many(self.bucket.get_name(),
+                                               iter(items), concurrency=2)
+        
+        self.assertEqual([key for key, data in items],
+                         [key for key, success, obj in results])
+        for key, success, obj in results:
+            self.assertTrue(success)
+            self.assertEqual(key, obj.get_key())
+        
+        result = yield idx1.query("less_than", 3)
+        expected_result = sorted([[u"test_bucket", u"prefix_key1", 1],
+                                  [u"test_bucket", u"prefix_key2", 2]])
+        self.assertEqual(expected_result, sorted(result))
+    
+    @defer.inlineCallbacks
+    def test_store_many_index_errors(self):
+        "Index failures in a batch either stop it or are collected."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int")
+        self.client.add_index(idx1)
+        items = [("prefix_key1", {"integer" : 1}),
+                 ("prefix_key2", {"string" : "no integer"}),
+                 ("prefix_key3", {"integer" : 3})]
+        
+        yield self.assertFailure(self.bucket.store_many(items, concurrency=1),
+                                 errors.IndexMaintenanceError)
+        obj_test = yield self.bucket.get("prefix_key3")
+        self.assertFalse(obj_test.exists())
+        
+        results = yield self.bucket.store_many(items, concurrency=1,
+                                               collect_index_errors=True)
+        self.assertEqual([True, False, True],
+                         [success for key, success, obj in results])
+        self.assertTrue(isinstance(results[1][2], errors.IndexMaintenanceError))
+        obj_test = yield self.bucket.get("prefix_key3")
+        self.assertTrue(obj_test.exists())
+
+    @defer.inlineCallbacks
+    def test_delete_many(self):
+        "Delete many keys and their indexes in one batch."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int")
+        idx2 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="string",
+                                 field_type="str")
+        self.client.add_index(idx1)
+        self.client.add_index(idx2)
+        
+        items = [("prefix_key%d" % i, {"integer" : i, "string" : "test!"}) \
+                 for i in range(1, 5)]
+        yield self.bucket.store_many(items)
+        
+        # key2 is passed in by the caller, key5 doesn't exist
+        keys = ["prefix_key1", "prefix_key2", "prefix_key3", "prefix_key5"]
+        results = yield self.client.delete_many(self.bucket.get_name(), keys,
+                                                documents={"prefix_key2" : items[1][1]},
+                                                concurrency=2)
+        self.assertEqual(keys, [key for key, success, obj in results])
+        self.assertEqual([True] * 4, [success for key, success, obj in results])
+        
+        for key in keys:
+            obj_test = yield self.bucket.get(key)
+            self.assertFalse(obj_test.exists())
+        
+        result = yield idx2.query("eq", "test!")
+        self.assertEqual([[u"test_bucket", u"prefix_key4", u"test!"]], result)
+        result = yield idx1.query("less_than", 10)
+        self.assertEqual([[u"test_bucket", u"prefix_key4", 4]], result)
+    
+    @defer.inlineCallbacks
+    def test_get_many(self):
+        "Fetch many keys concurrently."
+        items = [("prefix_key%d" % i, {"integer" : i}) for i in range(1, 5)]
+        yield self.bucket.store_many(items)
+        
+        keys = ["prefix_key3", "prefix_key5", "prefix_key1", "prefix_testkey"]
+        objects, missing = yield self.client.get_many(self.bucket.get_name(),
+                                                      keys, concurrency=2)
+        self.assertEqual(["prefix_key3", "prefix_key1"],
+                         [obj.get_key() for obj in objects])
+        self.assertEqual([{"integer" : 3}, {"integer" : 1}],
+                         [obj.get_data() for obj in objects])
+        self.assertEqual(["prefix_key5", "prefix_testkey"], missing)
+
 class RiakObjectTestCase(RiakIdxPseudoTestCase):
     """
     Test cases for RiakObject
@@ -416,6 +1612,35 @@ class RiakObjectTestCase(RiakIdxPseudoTestCase):
         self.assertEqual("testkey", key)
         self.assertEqual(str(self.sample_record["integer"]), val)
     
+    @defer.inlineCallbacks
+    def test_store_index_entry_raw(self):
+        "Index entries written by the raw writer hold a null value and a link."
+        idx = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                key_prefix="prefix",
+                                indexed_field="string",
+                                field_type="str")
+        self.client.add_index(idx)
+        
+        op = idx._entry_op("put", "testkey", riakidx.RiakObject._escval("a/b c"))
+        self.assertEqual('</riak/test_bucket/prefix_testkey>; riaktag="test_bucket"',
+                         op["link"])
+        self.assertEqual("/riak/idx%3Dtest_bucket%3Dprefix%3Dstring/testkey%2Fa%252Fb%2520c",
+                         op["path"])
+        yield self.client._apply_index_op(op)
+        
+        idx_bucket = self.client.bucket(idx._entry_bucket())
+        obj_idx_test = yield idx_bucket.get("testkey/" + riakidx.RiakObject._escval("a/b c"))
+        self.assertTrue(obj_idx_test.exists())
+        self.assertEqual(None, obj_idx_test.get_data())
+        self.assertEqual("text/json", obj_idx_test.get_content_type())
+        
+        link = obj_idx_test.get_links()[0]
+        self.assertEqual(link.get_key(), "prefix_testkey")
+        self.assertEqual(link.get_bucket(), self.bucket.get_name())
+        
+        yield self.client._apply_index_op(idx._entry_op("delete", "testkey",
+                                                        riakidx.RiakObject._escval("a/b c")))
+    
     def test_escape_field_value(self):
         "Test escaping index field values."
         field_val = "my_utterly/obfuscated!key="
@@ -538,6 +1763,35 @@ class RiakObjectTestCase(RiakIdxPseudoTestCase):
         obj_idx_test = yield idx_bucket.get(index_key_old)
         self.assertFalse(obj_idx_test.exists())
     
+    @defer.inlineCallbacks
+    def test_store_index_new_set_data(self):
+        "Test storing a new key whose data was replaced before the first store."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="string",
+                                 field_type="str")
+        self.client.add_index(idx1)
+        
+        obj = self.bucket.new("prefix_testkey", self.sample_record)
+        updated_record = copy.deepcopy(self.sample_record)
+        updated_record["integer"] = 7
+        obj.set_data(updated_record)
+        yield obj.store()
+        
+        self.assertEqual(["string"], obj.get_reindexed_fields())
+        
+        index_bucket = self.idx_bkt_form % {"bucket" : self.bucket.get_name(),
+                                            "field" : "string",
+                                            "key_prefix" : "prefix"}
+        index_key = self.idx_key_form % {"key" : "testkey",
+                                         "field_value" : urllib.quote(self.sample_record["string"])}
+        idx_bucket = self.client.bucket(index_bucket)
+        obj_idx_test = yield idx_bucket.get(index_key)
+        self.assertTrue(obj_idx_test.exists())
+        
+        results = yield idx1.query("eq", self.sample_record["string"])
+        self.assertEqual(["prefix_testkey"], [r[1] for r in results])
+    
     @defer.inlineCallbacks
     def test_store_index_previndex_previndexmissing(self):
         "Test updating a key and index, but the old index key is missing."
@@ -758,3 +2012,190 @@ class RiakObjectTestCase(RiakIdxPseudoTestCase):
         idx_bucket = self.client.bucket(index_bucket)
         obj_idx_test = yield idx_bucket.get(index_key)
         self.assertFalse(obj_idx_test.exists())
+    
+    @defer.inlineCallbacks
+    def test_store_index_concurrency_limit(self):
+        "Test storing a key with more indexed fields than the request cap."
+        self.client = riakidx.RiakClient(index_concurrency=2)
+        self.bucket = self.client.bucket("test_bucket")
+        
+        fields = {"string" : "str", "integer" : "int",
+                  "float" : "float", "unicode" : "unicode"}
+        for field in fields.keys():
+            self.client.add_index(riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                                    key_prefix="prefix",
+                                                    indexed_field=field,
+                                                    field_type=fields[field]))
+        
+        obj = self.bucket.new("prefix_testkey", self.sample_record)
+        yield obj.store()
+        
+        # Validate every index was created
+        for field in fields.keys():
+            index_bucket = self.idx_bkt_form % {"bucket" : self.bucket.get_name(),
+                                                "field" : field,
+                                                "key_prefix" : "prefix"}
+            index_key = self.idx_key_form % {"key" : "testkey",
+                                             "field_value" : riakidx.RiakObject._escval(self.sample_record[field])}
+            idx_bucket = self.client.bucket(index_bucket)
+            obj_idx_test = yield idx_bucket.get(index_key)
+            self.assertTrue(obj_idx_test.exists())
+    
+    @defer.inlineCallbacks
+    def test_store_index_failure_aggregated(self):
+        "Test failed index fields are reported together after the others finish."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="string",
+                                 field_type="str")
+        idx2 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="missing",
+                                 field_type="str")
+        self.client.add_index(idx1)
+        self.client.add_index(idx2)
+        
+        obj = self.bucket.new("prefix_testkey", self.sample_record)
+        err = yield self.assertFailure(obj.store(), errors.IndexMaintenanceError)
+        self.assertEqual(["missing"], err.failures.keys())
+        
+        # The healthy field was still indexed
+        index_bucket = self.idx_bkt_form % {"bucket" : self.bucket.get_name(),
+                                            "field" : "string",
+                                            "key_prefix" : "prefix"}
+        index_key = self.idx_key_form % {"key" : "testkey",
+                                         "field_value" : urllib.quote(self.sample_record["string"])}
+        idx_bucket = self.client.bucket(index_bucket)
+        obj_idx_test = yield idx_bucket.get(index_key)
+        self.assertTrue(obj_idx_test.exists())
+        
+        # Drop the index that can't be maintained so tearDown can clean up
+        del self.client._indexes[self.bucket.get_name()+"=prefix"]["missing"]
+    
+    @defer.inlineCallbacks
+    def check_unencodable_values(self, idx1):
+        "Fetch and store keys whose indexed value *idx1* can't encode."
+        self.client.add_index(idx1)
+        
+        # Written before the index existed
+        other = riakidx.RiakClient()
+        yield other.bucket(self.bucket.get_name()).new("prefix_key1",
+                                                       {"integer" : None}).store()
+        yield other.bucket(self.bucket.get_name()).new("prefix_key2",
+                                                       {"integer" : 3.5}).store()
+        
+        obj = yield self.bucket.get("prefix_key1")
+        self.assertEqual({"integer" : None}, obj.get_data())
+        obj = yield self.bucket.get("prefix_key2")
+        self.assertEqual({"integer" : 3.5}, obj.get_data())
+        
+        # The data is stored and the field reported
+        obj.set_data({"integer" : "abc"})
+        err = yield self.assertFailure(obj.store(), errors.IndexMaintenanceError)
+        self.assertEqual(["integer"], err.failures.keys())
+        self.assertTrue(err.failures["integer"].check(ValueError))
+        obj = yield self.bucket.get("prefix_key2")
+        self.assertEqual({"integer" : "abc"}, obj.get_data())
+        
+        result = yield idx1.query("greater_than", 0)
+        self.assertEqual([], result)
+    
+    def test_store_index_unencodable_sortable(self):
+        "Test values a sortable index can't encode don't break reads or writes."
+        return self.check_unencodable_values(riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                                               key_prefix="prefix",
+                                                               indexed_field="integer",
+                                                               field_type="int",
+                                                               sortable=True))
+    
+    def test_store_index_unencodable_native(self):
+        "Test values a native index can't encode don't break reads or writes."
+        return self.check_unencodable_values(riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                                               key_prefix="prefix",
+                                                               indexed_field="integer",
+                                                               field_type="int",
+                                                               backend="native"))
+    
+    @defer.inlineCallbacks
+    def test_store_index_unchanged_skipped(self):
+        "Test updating a key only rewrites indexes of fields that changed."
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="string",
+                                 field_type="str")
+        idx2 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="integer",
+                                 field_type="int")
+        self.client.add_index(idx1)
+        self.client.add_index(idx2)
+        
+        obj = self.bucket.new("prefix_testkey", self.sample_record)
+        yield obj.store()
+        self.assertEqual(["integer", "string"],
+                         sorted(obj.get_reindexed_fields()))
+        
+        # Update a field that isn't indexed
+        obj = yield self.bucket.get("prefix_testkey")
+        updated_record = copy.deepcopy(self.sample_record)
+        updated_record["float"] = 6.28
+        obj.set_data(updated_record)
+        yield obj.store()
+        self.assertEqual([], obj.get_reindexed_fields())
+        
+        # Update one indexed field in place
+        obj = yield self.bucket.get("prefix_testkey")
+        obj.get_data()["string"] = "testing!"
+        yield obj.store()
+        self.assertEqual(["string"], obj.get_reindexed_fields())
+        
+        index_bucket = self.idx_bkt_form % {"bucket" : self.bucket.get_name(),
+                                            "field" : "string",
+                                            "key_prefix" : "prefix"}
+        idx_bucket = self.client.bucket(index_bucket)
+        index_key = self.idx_key_form % {"key" : "testkey",
+                                         "field_value" : urllib.quote("testing!")}
+        obj_idx_test = yield idx_bucket.get(index_key)
+        self.assertTrue(obj_idx_test.exists())
+        index_key = self.idx_key_form % {"key" : "testkey",
+                                         "field_value" : urllib.quote(self.sample_record["string"])}
+        obj_idx_test = yield idx_bucket.get(index_key)
+        self.assertFalse(obj_idx_test.exists())
+        
+        index_bucket = self.idx_bkt_form % {"bucket" : self.bucket.get_name(),
+                                            "field" : "integer",
+                                            "key_prefix" : "prefix"}
+        idx_bucket = self.client.bucket(index_bucket)
+        index_key = self.idx_key_form % {"key" : "testkey",
+                                         "field_value" : urllib.quote(str(self.sample_record["integer"]))}
+        obj_idx_test = yield idx_bucket.get(index_key)
+        self.assertTrue(obj_idx_test.exists())
+    
+    @defer.inlineCallbacks
+    def test_store_index_journal(self):
+        "Test write-behind index maintenance through the journal."
+        self.client = riakidx.RiakClient(index_journal=self.mktemp())
+        self.bucket = self.client.bucket("test_bucket")
+        self.addCleanup(self.client.get_index_journal().stop)
+        idx1 = riakidx.RiakIndex(bucket=self.bucket.get_name(),
+                                 key_prefix="prefix",
+                                 indexed_field="string",
+                                 field_type="str")
+        self.client.add_index(idx1)
+        
+        obj = self.bucket.new("prefix_testkey", self.sample_record)
+        yield obj.store()
+        self.assertEqual(["string"], obj.get_reindexed_fields())
+        
+        obj.set_data(dict(self.sample_record, string="testing!"))
+        yield obj.store()
+        yield self.client.get_index_journal().flush()
+        
+        result = yield idx1.query("starts_with", "test")
+        self.assertEqual([[u"test_bucket", u"prefix_testkey", u"testing!"]],
+                         result)
+        
+        yield obj.delete()
+        yield self.client.get_index_journal().flush()
+        result = yield idx1.query("starts_with", "test")
+        self.assertEqual([], result)